@@ -0,0 +1,108 @@
+"""
+active_cells: compact representation of the grids of the Amazon Sediment
+Production Model as 1-D arrays over the active cells of the basin only, i.e.,
+the cells of the clone mask that are true, instead of over the full bounding
+box. The index of the active cells is computed once; full grids are gathered
+into vectors when they are read and vectors are scattered back into grids for
+the output.
+
+The factor functions of amazon_factors (with the numpy backend), the land cover
+stack and the fused kernel in rusle_kernel compute per cell and accept 1-D
+arrays as they are, so that compute and memory scale with the area of the
+basin rather than with that of its bounding box.
+
+"""
+
+# modules
+import numpy as np
+
+class ActiveCells(object):
+    '''
+ActiveCells: index of the active cells of a grid.
+
+    Input:
+    ======
+    mask:                   boolean array that is True for the active cells.
+
+'''
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype = bool)
+        self.shape = mask.shape
+        self.indices = np.flatnonzero(mask)
+        self.nr_cells = self.indices.size
+    #fed
+
+    @property
+    def fraction(self):
+        # fraction of the cells of the grid that is active
+        return self.nr_cells / float(max(1, int(np.prod(self.shape))))
+    #fed
+
+    def gather(self, data):
+        '''
+gather: returns the values of the active cells of the grid as a 1-D array;
+scalars are returned as they are.
+'''
+        if np.ndim(data) == 0:
+            return data
+        #fi
+        data = np.asarray(data)
+        if data.shape[-len(self.shape):] != self.shape:
+            raise ValueError('array of shape %s does not match the grid of shape %s' % \
+                (data.shape, self.shape))
+        #fi
+        # leading dimensions, e.g., land cover classes, are kept
+        return data.reshape(data.shape[:-len(self.shape)] + (-1,))[..., self.indices]
+    #fed
+
+    def scatter(self, values, out = None, fill_value = np.nan):
+        '''
+scatter: returns the full grid with the values at the active cells.
+
+    Input:
+    ======
+    values:                 1-D array with the value per active cell, or with
+                            leading dimensions;
+    out:                    optional grid that is filled in place, also if it
+                            is not contiguous; its inactive cells are left as
+                            they are;
+    fill_value:             value of the inactive cells of a new grid.
+
+    Output:
+    =======
+    out:                    the grid.
+
+'''
+        values = np.asarray(values)
+        if values.shape[-1] != self.nr_cells:
+            raise ValueError('%d values do not match the %d active cells' % \
+                (values.shape[-1], self.nr_cells))
+        #fi
+        if out is None:
+            out = np.full(values.shape[:-1] + self.shape, fill_value, \
+                dtype = np.result_type(values.dtype, np.min_scalar_type(fill_value)))
+        #fi
+        elif out.shape[-len(self.shape):] != self.shape:
+            raise ValueError('grid of shape %s does not match the grid of shape %s' % \
+                (out.shape, self.shape))
+        #fi
+        if out.flags.c_contiguous:
+            # the reshaped grid is a view, so that the values are set in place
+            out.reshape(out.shape[:-len(self.shape)] + (-1,))[..., self.indices] = values
+        else:
+            # reshaping would copy the grid, e.g., a slice of a larger array
+            out[(Ellipsis,) + np.unravel_index(self.indices, self.shape)] = values
+        #fi
+        return out
+    #fed
+
+    def gather_dict(self, data):
+        # gathers every array of the dictionary
+        return dict((name, self.gather(value)) for name, value in data.items())
+    #fed
+
+    def report(self):
+        print('Active cells: %d of %d (%.1f%%) of the grid' % \
+            (self.nr_cells, int(np.prod(self.shape)), 100.0 * self.fraction))
+    #fed
+#ssalc
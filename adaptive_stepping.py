@@ -0,0 +1,307 @@
+"""
+adaptive_stepping: adaptive time stepping of the routing of the Amazon
+Sediment Transport Model. The routing is driven by daily forcing and writes
+daily output, but the discharge changes slowly for most of the year. The
+controller therefore routes the water with internal steps of which the length
+follows from the state: several days when the storage changes little and the
+Courant number of the kinematic wave stays low, a day, or fractions of a day
+during floods.
+
+The internal steps are aligned with the output intervals: a step of several
+days starts at the start of an interval and covers whole intervals, with the
+mean lateral inflow over those intervals; steps shorter than an interval are
+the interval divided by a power of two. The output of the intervals within a
+longer step is interpolated linearly in time, so that the storage and the
+fluxes of every interval stay in balance with each other.
+
+After every step the local water balance of each cell is tested, as with
+testLocalWaterBalance of PCR-GLOBWB. Per output interval, the number of
+internal steps and the error of the water balance of the basin with the
+actual forcing of the interval are recorded for the report: within a longer
+step, the lateral inflow of the individual intervals is averaged, which
+shifts water between the intervals of the step but not out of it.
+
+The controller is not yet used by the routing of the transport model
+(routing_wb_dev); it is run standalone, e.g., by benchmark_kinematic.py, and
+the adaptiveTimeStepping setting of amazon_sediment_transport is off.
+
+The storage of a cell is the channel storage of the kinematic wave,
+alpha * Q ** beta * dx. All arrays are 1-D arrays over the cells of the
+topology, in double precision.
+
+"""
+
+# modules
+import time
+import numpy as np
+
+class AdaptiveStepController(object):
+    '''
+AdaptiveStepController: routes the discharge with the kinematic-wave solver
+over a number of output intervals with internal steps of variable length.
+
+    Input:
+    ======
+    solver:                 KinematicWaveSolver of the LDD;
+    output_interval:        length of the output interval [s], a day;
+    max_intervals:          maximum length of a step in output intervals;
+    max_subdivisions:       maximum number of times that the output interval
+                            is halved; the shortest step is
+                            output_interval / 2 ** max_subdivisions;
+    courant_criterion:      maximum Courant number of the kinematic wave,
+                            celerity * dt / dx, of the cells of which the
+                            storage changes;
+    storage_criterion:      maximum relative change of the storage of the
+                            cells per step;
+    min_storage:            storage [m3] below which changes are measured
+                            relative to this storage;
+    balance_tolerance:      relative error of the local water balance above
+                            which a warning is printed;
+    growth:                 maximum factor by which a step exceeds the
+                            previous one.
+
+'''
+    def __init__(self, solver, output_interval = 86400.0, max_intervals = 5, max_subdivisions = 6, \
+            courant_criterion = 10.0, storage_criterion = 0.2, min_storage = 1.0e3, \
+            balance_tolerance = 1.0e-6, growth = 2.0):
+        self.solver = solver
+        self.topology = solver.topology
+        self.output_interval = float(output_interval)
+        self.max_intervals = max(1, int(max_intervals))
+        self.max_subdivisions = max(1, int(max_subdivisions))
+        self.courant_criterion = courant_criterion
+        self.storage_criterion = storage_criterion
+        self.min_storage = min_storage
+        self.balance_tolerance = balance_tolerance
+        self.growth = growth
+        self.pits = self.topology.downstream_index < 0
+        self.reset_statistics()
+    #fed
+
+    @classmethod
+    def from_settings(cls, solver, settings):
+        # returns the controller with the settings of the routing, see
+        # set_general_settings of amazon_sediment_transport, or None if the
+        # adaptive time stepping is switched off, in which case the routing
+        # takes steps of the output interval
+        if not settings['adaptiveTimeStepping']:
+            return None
+        #fi
+        return cls(solver, output_interval = settings['timeSec'] * settings['duration'], \
+            max_intervals = settings['maxTimeStep'], max_subdivisions = settings['maxSubdivisions'], \
+            courant_criterion = settings['courantCriterion'], \
+            storage_criterion = settings['storageChangeCriterion'])
+    #fed
+
+    def reset_statistics(self):
+        self.nr_steps = 0
+        self.nr_rejected = 0
+        self.nr_balance_warnings = 0
+        self.max_local_error = 0.0
+        self.interval_steps = []
+        self.interval_errors = []
+        self.interval_storage = []
+        self.run_time = 0.0
+    #fed
+
+    def storage(self, discharge):
+        # the channel storage [m3] of the cells
+        return self.solver.alpha * discharge ** self.solver.beta * self.solver.channel_length
+    #fed
+
+    def propose(self, discharge, inflow, storage, lateral_inflow):
+        # returns the length of the step [s] from the rate of change of the
+        # storage and the Courant number of the cells of which the storage
+        # changes by more than the criterion over the longest step; where the
+        # discharge is steady, the wave does not need to be resolved
+        solver = self.solver
+        rate = np.abs(inflow + lateral_inflow * solver.channel_length - discharge)
+        rate /= np.maximum(storage, self.min_storage)
+        dt = self.max_intervals * self.output_interval
+        if np.max(rate) > 0:
+            dt = min(dt, self.storage_criterion / np.max(rate))
+        #fi
+        changing = (rate * self.max_intervals * self.output_interval > self.storage_criterion) & (discharge > 0)
+        if np.any(changing):
+            celerity = discharge[changing] ** (1 - solver.beta) / (solver.alpha[changing] * solver.beta)
+            dt = min(dt, self.courant_criterion / np.max(celerity / solver.channel_length[changing]))
+        #fi
+        return dt
+    #fed
+
+    def snap(self, dt, offset, remaining):
+        # returns the number of output intervals of the step, or zero and the
+        # number of halvings of the interval, given the time since the start
+        # of the interval and the number of intervals that remain
+        if offset == 0 and dt >= self.output_interval:
+            return min(int(dt // self.output_interval), self.max_intervals, remaining), 0
+        #fi
+        subdivisions = 1
+        while subdivisions < self.max_subdivisions and self.output_interval / 2 ** subdivisions > dt:
+            subdivisions += 1
+        #elihw
+        # a step ends at the end of the interval at the latest
+        while offset % (self.output_interval / 2 ** subdivisions) != 0:
+            subdivisions += 1
+        #elihw
+        return 0, subdivisions
+    #fed
+
+    def run(self, discharge, lateral_inflow, nr_intervals):
+        '''
+run: routes the discharge over the output intervals and yields, per interval,
+the interval, the discharge [m3/s] and the storage [m3] at its end.
+
+    Input:
+    ======
+    discharge:              discharge at the start [m3/s];
+    lateral_inflow:         function that returns the lateral inflow per unit
+                            channel length [m2/s] of an output interval;
+    nr_intervals:           number of output intervals.
+
+'''
+        discharge = np.maximum(np.asarray(discharge, dtype = np.float64), 0)
+        # the forcing of the intervals from the current one on is kept, so
+        # that it is read once
+        forcing = {}
+        def interval_forcing(index):
+            for key in [key for key in forcing if key < interval]:
+                del forcing[key]
+            #rof
+            if index not in forcing:
+                forcing[index] = np.broadcast_to(np.asarray(lateral_inflow(index), \
+                    dtype = np.float64), discharge.shape)
+            #fi
+            return forcing[index]
+        #fed
+        inflow = self.topology.upstream(discharge)
+        old_storage = self.storage(discharge)
+        interval = 0
+        offset = 0.0
+        previous_dt = self.output_interval
+        steps = 0.0
+        basin_error = 0.0
+        while interval < nr_intervals:
+            start_time = time.time()
+            dt = min(self.propose(discharge, inflow, old_storage, interval_forcing(interval)), \
+                self.growth * previous_dt)
+            nr_covered, subdivisions = self.snap(dt, offset, nr_intervals - interval)
+            while True:
+                if nr_covered > 0:
+                    dt = nr_covered * self.output_interval
+                    forcings = [interval_forcing(interval + i) for i in range(nr_covered)]
+                    mean_forcing = np.mean(forcings, axis = 0)
+                else:
+                    dt = self.output_interval / 2 ** subdivisions
+                    forcings = [interval_forcing(interval)]
+                    mean_forcing = forcings[0]
+                #fi
+                new_discharge = self.solver.route(discharge, mean_forcing, dt)
+                new_storage = self.storage(new_discharge)
+                change = np.max(np.abs(new_storage - old_storage) / \
+                    np.maximum(np.maximum(old_storage, new_storage), self.min_storage))
+                # reject a step that changes the storage by more than twice
+                # the criterion, unless it is the shortest step
+                if change <= 2 * self.storage_criterion or \
+                        (nr_covered == 0 and subdivisions >= self.max_subdivisions):
+                    break
+                #fi
+                self.nr_rejected += 1
+                if nr_covered > 1:
+                    nr_covered //= 2
+                elif nr_covered == 1:
+                    nr_covered, subdivisions = 0, 1
+                else:
+                    subdivisions += 1
+                #fi
+            #elihw
+            self.nr_steps += 1
+            previous_dt = dt
+            # fluxes of the step [m3/s] and the local water balance
+            inflow = self.solver.inflow
+            lateral = mean_forcing * self.solver.channel_length
+            self.test_local_balance(old_storage, new_storage, inflow, lateral, new_discharge, dt)
+            outflow = np.sum(new_discharge[self.pits])
+            self.run_time += time.time() - start_time
+            if nr_covered == 0:
+                # a part of the current interval
+                steps += 1
+                offset += dt
+                basin_error += np.sum(new_storage - old_storage) - \
+                    dt * (np.sum(forcings[0] * self.solver.channel_length) - outflow)
+                discharge = new_discharge
+                old_storage = new_storage
+                if offset >= self.output_interval:
+                    yield self.close_interval(interval, steps, basin_error, discharge, new_storage)
+                    interval += 1
+                    offset = 0.0
+                    steps = 0.0
+                    basin_error = 0.0
+                #fi
+            else:
+                # whole intervals, interpolated linearly in time
+                for i in range(nr_covered):
+                    weight = (i + 1) / float(nr_covered)
+                    storage = old_storage + weight * (new_storage - old_storage)
+                    basin_error = np.sum(new_storage - old_storage) / nr_covered - self.output_interval * \
+                        (np.sum(forcings[i] * self.solver.channel_length) - outflow)
+                    yield self.close_interval(interval, 1.0 / nr_covered, basin_error, \
+                        discharge + weight * (new_discharge - discharge), storage)
+                    interval += 1
+                #rof
+                discharge = new_discharge
+                old_storage = new_storage
+                basin_error = 0.0
+            #fi
+        #elihw
+    #fed
+
+    def test_local_balance(self, old_storage, new_storage, inflow, lateral, outflow, dt):
+        # tests the water balance of every cell over the step and prints a
+        # warning if the relative error exceeds the tolerance
+        error = np.abs(new_storage - old_storage - dt * (inflow + lateral - outflow))
+        scale = np.maximum(np.maximum(old_storage, new_storage), \
+            dt * (inflow + np.abs(lateral) + outflow))
+        relative_error = np.max(error / np.maximum(scale, self.min_storage))
+        self.max_local_error = max(self.max_local_error, relative_error)
+        if relative_error > self.balance_tolerance:
+            self.nr_balance_warnings += 1
+            print('Warning: local water balance error of %.2e after step %d of %.0f s' % \
+                (relative_error, self.nr_steps, dt))
+        #fi
+    #fed
+
+    def close_interval(self, interval, steps, basin_error, discharge, storage):
+        # records the statistics of the interval and returns its output
+        self.interval_steps.append(steps)
+        self.interval_errors.append(basin_error)
+        self.interval_storage.append(np.sum(storage))
+        return interval, discharge, storage
+    #fed
+
+    def report(self, per_interval = True):
+        # print the internal steps and the water balance error per output
+        # interval, and the totals of the run
+        relative_errors = np.abs(self.interval_errors) / np.maximum(self.interval_storage, self.min_storage)
+        if per_interval:
+            print('\t%8s %8s %12s %12s' % ('interval', 'steps', 'error [m3]', 'relative'))
+            for interval, steps in enumerate(self.interval_steps):
+                print('\t%8d %8.2f %12.4e %12.3e' % (interval + 1, steps, self.interval_errors[interval], \
+                    relative_errors[interval]))
+            #rof
+        #fi
+        nr_intervals = len(self.interval_steps)
+        print('Adaptive time stepping: %d internal step(s) over %d output interval(s), ' \
+            '%.2f steps per interval, %d rejected; %.3f s' % (self.nr_steps, nr_intervals, \
+            self.nr_steps / float(max(1, nr_intervals)), self.nr_rejected, self.run_time))
+        if nr_intervals > 0:
+            print('\twater balance error of the basin per interval, relative to its storage: ' \
+                'mean %.2e, maximum %.2e; largest local error %.2e' % \
+                (relative_errors.mean(), relative_errors.max(), self.max_local_error))
+        #fi
+        if self.nr_balance_warnings > 0:
+            print('Warning: the local water balance exceeded the tolerance of %.1e in %d step(s)' % \
+                (self.balance_tolerance, self.nr_balance_warnings))
+        #fi
+    #fed
+#ssalc
@@ -6,10 +6,76 @@ Amazon sediment Transport Model (PCR-GLOBWB-erosion and sedimentation module_.
 """
 
 # modules
-import pcraster as pcr
-import os
-outdname ='/scratch/safaa/output/1980/new_cover_fraction_run'
+import sys
+import functools
+try:
+    import pcraster as pcr
+except ImportError:
+    pcr = None
+#yrt
+import numpy_pcr
+import diagnostics
+
+# value used to replace missing values
+mv = -999.9
+
+# the backend that the factor functions use: 'pcraster' for PCRaster fields
+# or 'numpy' for arrays with NaN as missing values; the operations of the
+# active backend are held by ops
+_backend = 'pcraster' if pcr is not None else 'numpy'
+ops = pcr if pcr is not None else numpy_pcr
+
+def set_backend(backend):
+    '''
+set_backend: function that selects the backend of the factor functions.
+With the 'pcraster' backend, the functions take and return PCRaster fields
+and require a clone; with the 'numpy' backend, they take and return NumPy
+arrays (or floats) in which NaN denotes a missing value.
+
+    Input:
+    ======
+    backend:                name of the backend, 'pcraster' or 'numpy'.
 
+'''
+    global _backend, ops
+    if backend == 'pcraster':
+        if pcr is None:
+            sys.exit('Error: the pcraster backend is selected but pcraster cannot be imported')
+        #fi
+        ops = pcr
+    elif backend == 'numpy':
+        ops = numpy_pcr
+    else:
+        sys.exit('Error: unknown backend %s for the factor functions' % backend)
+    #fi
+    _backend = backend
+#fed
+
+def get_backend():
+    # return the name of the active backend
+    return _backend
+#fed
+
+def backend_function(func):
+    '''
+backend_function: decorator for the factor functions; with the numpy backend,
+array input is converted to masked arrays before the call and the result is
+returned as an array with NaN for missing values.
+'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _backend != 'numpy':
+            return func(*args, **kwargs)
+        #fi
+        args = [numpy_pcr.to_field(arg) for arg in args]
+        kwargs = dict((key, numpy_pcr.to_field(value)) \
+            for key, value in kwargs.items())
+        return numpy_pcr.to_array(func(*args, **kwargs))
+    #fed
+    return wrapper
+#fed
+
+@backend_function
 def compute_slope_length_factor(slope_length, slope_gradient):
     '''
 compute_slope_length_factor: function that returns the factor that corrects the 
@@ -31,7 +97,7 @@ unity (when the slope angle is 32 degrees or the slope 0.625).
 '''
 
     # compute the power gamma first, then return the slope factor
-    gamma = pcr.min(1.00, 1.183156498 * slope_gradient ** 0.351920534)
+    gamma = ops.min(1.00, 1.183156498 * slope_gradient ** 0.351920534)
     
     slope_length_factor = (slope_length / 22.13) ** gamma
     
@@ -40,6 +106,7 @@ unity (when the slope angle is 32 degrees or the slope 0.625).
     
 #fed
 
+@backend_function
 def compute_slope_steepness_factor(slope_gradient):
     '''
 compute_slope_steepness_factor: function that returns the factor that corrects 
@@ -59,17 +126,18 @@ Nearing (1997).
 
     # compute the slope angle from the gradient; this uses the default option
     # of PCRaster (e.g., radians)
-    slope_angle = pcr.atan(slope_gradient)
+    slope_angle = ops.atan(slope_gradient)
     slope_gradient= slope_gradient *100
 
     slope_steepness_factor = -1.5 + (17.0 / (1 + \
-            pcr.exp(2.3 - (6.1 * pcr.sin(slope_angle)))))
+            ops.exp(2.3 - (6.1 * ops.sin(slope_angle)))))
     
     # return the factor
     return slope_steepness_factor
     
 #fed
 
+@backend_function
 def compute_slope_factor(slope_length, slope_gradient):
     '''
 compute_slope_factor: function that returns the factor that corrects the 
@@ -98,6 +166,7 @@ the function for the slope steepness developed by Nearing (1997).
     
 #fed
 
+@backend_function
 def compute_conservation_factor(cover_fraction_info, P_factor_info, selected_slope):
     '''
 compute_conservation_factor: The function uses the global estimation of Pham
@@ -119,7 +188,7 @@ using the global method of Wener (1981).
                             conservation measures (1 if none).) 
 
 '''
-    P_factor = pcr.scalar(0)
+    P_factor = ops.scalar(0)
     # iterate over the cover fractions
     for key in cover_fraction_info.keys():
         if key == "croplands":
@@ -135,19 +204,21 @@ using the global method of Wener (1981).
     return P_factor 
 #fed
 
+@backend_function
 def compute_interception_fraction(cover_fraction_info, interception_info):
-    part_int0 = pcr.scalar(0)
+    part_int0 = ops.scalar(0)
     # iterate over the cover fractions
     for key in cover_fraction_info.keys():
         part_int0 = part_int0 \
                 + cover_fraction_info[key] * interception_info[key]
     #rof
-    part_int1 = pcr.max (0 , part_int0)
-    part_interception = pcr.min (1, part_int1)
+    part_int1 = ops.max (0 , part_int0)
+    part_interception = ops.min (1, part_int1)
     
     return part_interception
 #fed
 
+@backend_function
 def compute_annual_erosivity(rain_annual):
     '''
 compute_annual_erosivity: function to compute the annual erosvity based on the 
@@ -164,12 +235,13 @@ relationship of Renard and Freimund (1994).
 '''
 
     # compute the erosivity
-    return pcr.ifthenelse(rain_annual <= 850.0, \
+    return ops.ifthenelse(rain_annual <= 850.0, \
             0.0483 * rain_annual ** 1.61, \
             587.8 - 1.219 * rain_annual + 0.00415 * rain_annual ** 2)
 
 #fed
 
+@backend_function
 def partition_erosivity(rain_month, rain_annual, eros_annual):
     '''
 partition_erosivity: function to partition the annual erosvity into smaller 
@@ -192,8 +264,8 @@ rainfall and calculated according to Morgan (2005)
 
 '''
     # compute the erosivity
-    return pcr.ifthenelse(rain_annual > 0, \
-        rain_month / pcr.max(rain_month, rain_annual), 0) * eros_annual
+    return ops.ifthenelse(rain_annual > 0, \
+        rain_month / ops.max(rain_month, rain_annual), 0) * eros_annual
 #fed
 
 '''
@@ -214,20 +286,21 @@ and annual erosivity by Xihua Yang (2014)
     =======
     vegcover_factor:        vegetation cover (crop management)factor [1].
 '''
+@backend_function
 def compute_vegcover_factor2(ground_cover_fraction,R_month,R_year ):
     AEI = R_month/ R_year
     gc_tmp = -0.799 - 7.74 * ground_cover_fraction
-    pcr.report(gc_tmp, os.path.join(outdname, 'gc_tmp'))
+    diagnostics.emit('gc_tmp', gc_tmp)
     gcf_tmp=0.0449 * (ground_cover_fraction**2)
-    pcr.report(gcf_tmp, os.path.join(outdname, 'gcf_tmp'))
+    diagnostics.emit('gcf_tmp', gcf_tmp)
     c_tmp= (gc_tmp + gcf_tmp)
-    pcr.report(c_tmp, os.path.join(outdname, 'c_tmp'))
-    c_ex_tmp=pcr.exp(c_tmp)
-    c_ex_tmp= pcr.cover(c_ex_tmp, mv)
-    pcr.report(c_ex_tmp, os.path.join(outdname, 'c_ex_tmp'))
+    diagnostics.emit('c_tmp', c_tmp)
+    c_ex_tmp=ops.exp(c_tmp)
+    c_ex_tmp= ops.cover(c_ex_tmp, mv)
+    diagnostics.emit('c_ex_tmp', c_ex_tmp)
     c_factor = c_ex_tmp * AEI
-    c_factor= pcr.cover(c_factor, mv)
-    pcr.report(c_factor, os.path.join(outdname, 'c_factor'))
+    c_factor= ops.cover(c_factor, mv)
+    diagnostics.emit('c_factor', c_factor)
     return c_factor
 
 '''
@@ -249,14 +322,16 @@ air temperature during a period (e.g., month) is below the the melt rate.
                           the temperature is above freezing throughout.
 
 '''
+@backend_function
 def compute_melt_time_fraction(tmin, tmax, tmelt = 0.0):
     # compute the fractional melt time
-    melt_time_fraction = pcr.min(1.0, \
-            pcr.max(0, tmax - tmelt) / pcr.max(0.1, tmax - tmin))
+    melt_time_fraction = ops.min(1.0, \
+            ops.max(0, tmax - tmelt) / ops.max(0.1, tmax - tmin))
 
     return melt_time_fraction    
 #fed
 
+@backend_function
 def compute_kfact_monthly(kfact_annual, kfact_seasonal, melt_time_fraction):
     '''
 compute_kfact_monthly: function that computes the corrected, monthly erodibility 
@@ -267,6 +342,7 @@ based and the soil erodibility that applies on average over the year.
     return (melt_time_fraction * (kfact_seasonal - 1.0) + 1.0) * kfact_annual
 #fed
 
+@backend_function
 def return_default_soil_erodibility( \
         mass_fraction_sand, mass_fraction_silt, mass_fraction_clay,\
         organic_matter_content,\
@@ -296,19 +372,20 @@ the textural fractions as presented by Yang et al. (2003).
     dg = -3.5 * mass_fraction_sand - 2.0 * mass_fraction_silt - \
             0.5 * mass_fraction_clay
     # organic matter divided by clay content
-    omc = pcr.ifthenelse(mass_fraction_clay > 0.001, organic_matter_content / \
-            pcr.max(0.001, mass_fraction_clay), 0.0)
+    omc = ops.ifthenelse(mass_fraction_clay > 0.001, organic_matter_content / \
+            ops.max(0.001, mass_fraction_clay), 0.0)
     # get the exponential term
     e_omc = (-0.0021 * omc - 0.00037 * omc ** 2 - 4.02 * mass_fraction_clay + \
             1.72 * mass_fraction_clay ** 2)
     
     # computing the soil_erodibility
-    soil_erodibility = 0.0293 * (0.65 - dg + 0.24 * dg ** 2) * pcr.exp(e_omc)
+    soil_erodibility = 0.0293 * (0.65 - dg + 0.24 * dg ** 2) * ops.exp(e_omc)
     
     # return the soil erodibility
     return soil_erodibility
 #fed
 
+@backend_function
 def return_soil_erodibility_seasonality( \
         mass_fraction_sand, mass_fraction_silt, mass_fraction_clay):
     '''
@@ -330,23 +407,24 @@ values are based on the work by Hoch (2014).
 '''
 
     # setting the seasonality ratio of the soil erodibility factor
-    soil_erod_seasonality = pcr.scalar(1.44)
+    soil_erod_seasonality = ops.scalar(1.44)
 
     # subdivide the soil into coarse, medium and fine on the basis of texture
-    soil_erod_seasonality = pcr.ifthenelse(mass_fraction_clay > 0.35,\
-            pcr.scalar(1.17), soil_erod_seasonality)
-    soil_erod_seasonality = pcr.ifthenelse((mass_fraction_clay < 0.18) & \
+    soil_erod_seasonality = ops.ifthenelse(mass_fraction_clay > 0.35,\
+            ops.scalar(1.17), soil_erod_seasonality)
+    soil_erod_seasonality = ops.ifthenelse((mass_fraction_clay < 0.18) & \
                 (mass_fraction_sand > 0.65),\
-            pcr.scalar(4.50), soil_erod_seasonality)
-    soil_erod_seasonality = pcr.ifthenelse((mass_fraction_clay <= 0.35) & \
+            ops.scalar(4.50), soil_erod_seasonality)
+    soil_erod_seasonality = ops.ifthenelse((mass_fraction_clay <= 0.35) & \
                 (mass_fraction_sand <= 0.65),\
-            pcr.scalar(1.44), soil_erod_seasonality)  
+            ops.scalar(1.44), soil_erod_seasonality)  
 
     # return the seasonality of the soil erodibility
     return soil_erod_seasonality
 
 #fed
 
+@backend_function
 def compute_soil_loss( \
         erosivity_period, erodibility_period, \
         slope_factor, vegcover_factor, conservation_factor, CellArea):
@@ -379,7 +457,9 @@ method of Renard et al. (1997) as the product of the input factors.
             CellArea / 10000 
 #fed
 
-def compute_delivery_ratio(HydroCoeff, slope_gradient, Manning, slope_length):
+@backend_function
+def compute_delivery_ratio(HydroCoeff, slope_gradient, Manning, slope_length, \
+        alpha = 9.53, beta = 0.79):
     '''
 compute_sed_transport: function that computes the sediment transport based on 
 van Dijk work(2001) as the product of the input factors.
@@ -393,7 +473,9 @@ van Dijk work(2001) as the product of the input factors.
     Manning's roughness coeffecient: explained in the compute_Manning function
                                [s / m^1/3];
     slope_length:        
-
+    alpha, beta:               coefficient and exponent of the delivery ratio;
+                               floats or, with the numpy backend, arrays that
+                               broadcast, e.g., over ensemble members.
 
     Output:
     =======
@@ -402,26 +484,28 @@ van Dijk work(2001) as the product of the input factors.
                             [].
 
 '''   
-    alpha = pcr.scalar(9.53)
-    beta = pcr.scalar(0.79)
+    alpha = ops.scalar(alpha)
+    beta = ops.scalar(beta)
     slope_gradient_Perc = slope_gradient * 100
 
-    tmp0 = (HydroCoeff * pcr.sqrt(slope_gradient_Perc)) / (Manning*slope_length)
+    tmp0 = (HydroCoeff * ops.sqrt(slope_gradient_Perc)) / (Manning*slope_length)
     tmp1 = alpha *pow(tmp0 ,beta)
-    tmp2 = pcr.max(0, tmp1)
-    DeliveryRatio = pcr.min(1, tmp2)
+    tmp2 = ops.max(0, tmp1)
+    DeliveryRatio = ops.min(1, tmp2)
     return DeliveryRatio
 #fed
 
+@backend_function
 def compute_hydro_coeff(Qsurface, rain_month):
     tmp1 = Qsurface / rain_month
-    tmp2 = pcr.cover(tmp1, 0.0001)
-    tmp3 = pcr.max(0, tmp2)
-    HydroCoeff = pcr.min(1, tmp3)
+    tmp2 = ops.cover(tmp1, 0.0001)
+    tmp3 = ops.max(0, tmp2)
+    HydroCoeff = ops.min(1, tmp3)
     return HydroCoeff
 #fed
 
 
+@backend_function
 def Manning_n1(slope_gradient, Manning_n1_TBL):
     """
 Manning_n1: function to compute a scalar PCRaster field with the 
@@ -452,14 +536,16 @@ Manning_v3:
                        
 """
     slope_gradient_Perc = slope_gradient * 100
-    return pcr.lookupscalar(Manning_n1_TBL, slope_gradient_Perc)
+    return ops.lookupscalar(Manning_n1_TBL, slope_gradient_Perc)
 #fed
 
+@backend_function
 def Manning_v3(ndvi):
-    return pcr.ifthenelse(ndvi < 0, 0, ndvi)
+    return ops.ifthenelse(ndvi < 0, 0, ndvi)
 #fed
 
 
+@backend_function
 def Manning_n4(cover_fraction_info, manning_n_info):
     """
 get_manning_n: function to compute a scalar PCRaster field with the 
@@ -482,7 +568,7 @@ manning_n:              spatial scalar PCRaster field with the
                         cell-average Manning's n.
 """
     # set manning's n
-    manning_n = pcr.scalar(0)
+    manning_n = ops.scalar(0)
 
     # iterate over the cover fractions
     for key in cover_fraction_info.keys():
@@ -494,8 +580,9 @@ manning_n:              spatial scalar PCRaster field with the
     return manning_n
 #fed
     
-def compute_Manning(Mn1, Mn4, ndvi):
-    Mn2 = pcr.scalar(0.049)
+@backend_function
+def compute_Manning(Mn1, Mn4, ndvi, Mn2 = 0.049):
+    Mn2 = ops.scalar(Mn2)
     Mv3 = Manning_v3(ndvi)
 
     return Mn1 + Mn2 + Mv3 * Mn4
@@ -517,7 +604,106 @@ on Hoch (2014) as the product of the input factors.
                            [tonnes per period].
 
 '''
+@backend_function
 def compute_erosion(soil_loss, DeliveryRatio):
     Erosion = soil_loss * DeliveryRatio    
     return  Erosion
 #fed
+
+'''
+Split versions of the monthly factor functions: the sub-expressions of which
+all input is static (or annual) are computed once by a prefactor function and
+the monthly part only does the arithmetic that depends on the monthly input.
+The results equal those of the functions above, up to rounding.
+'''
+@backend_function
+def erosivity_prefactor(rain_annual):
+    # static part of partition_erosivity: the inverse of the annual rain, zero
+    # if there is no rain; for positive annual rain,
+    # rain_month / max(rain_month, rain_annual) equals min(rain_month / rain_annual, 1)
+    return ops.ifthenelse(rain_annual > 0, 1.0 / rain_annual, 0)
+#fed
+
+@backend_function
+def partition_erosivity_monthly(rain_month, inverse_rain_annual, eros_annual):
+    # monthly part of partition_erosivity
+    return ops.min(rain_month * inverse_rain_annual, 1.0) * eros_annual
+#fed
+
+@backend_function
+def vegcover_prefactor(R_year):
+    # static part of compute_vegcover_factor2: the inverse of the annual erosivity
+    return 1.0 / R_year
+#fed
+
+@backend_function
+def compute_vegcover_factor_monthly(ground_cover_fraction, R_month, inverse_R_year):
+    # monthly part of compute_vegcover_factor2; the intermediates are only
+    # computed separately if the diagnostics tap processes them
+    if diagnostics.is_active():
+        gc_tmp = -0.799 - 7.74 * ground_cover_fraction
+        diagnostics.emit('gc_tmp', gc_tmp)
+        gcf_tmp = 0.0449 * (ground_cover_fraction**2)
+        diagnostics.emit('gcf_tmp', gcf_tmp)
+        c_tmp = gc_tmp + gcf_tmp
+        diagnostics.emit('c_tmp', c_tmp)
+    else:
+        c_tmp = -0.799 - 7.74 * ground_cover_fraction + 0.0449 * (ground_cover_fraction**2)
+    #fi
+    c_ex_tmp = ops.cover(ops.exp(c_tmp), mv)
+    diagnostics.emit('c_ex_tmp', c_ex_tmp)
+    c_factor = ops.cover(c_ex_tmp * (R_month * inverse_R_year), mv)
+    diagnostics.emit('c_factor', c_factor)
+    return c_factor
+#fed
+
+@backend_function
+def kfact_prefactor(kfact_annual, kfact_seasonal):
+    # static part of compute_kfact_monthly: the seasonal amplitude of the erodibility
+    return (kfact_seasonal - 1.0) * kfact_annual
+#fed
+
+@backend_function
+def compute_kfact_monthly_split(kfact_annual, kfact_amplitude, melt_time_fraction):
+    # monthly part of compute_kfact_monthly
+    return melt_time_fraction * kfact_amplitude + kfact_annual
+#fed
+
+@backend_function
+def soil_loss_prefactor(slope_factor, conservation_factor, CellArea):
+    # static part of compute_soil_loss: slope and conservation factor and area in ha
+    return slope_factor * conservation_factor * CellArea / 10000
+#fed
+
+@backend_function
+def compute_soil_loss_monthly(erosivity_period, erodibility_period, vegcover_factor, \
+        soil_loss_static):
+    # monthly part of compute_soil_loss
+    return erosivity_period * erodibility_period * vegcover_factor * soil_loss_static
+#fed
+
+@backend_function
+def manning_prefactor(Mn1, Mn2 = 0.049):
+    # static part of compute_Manning: the Manning's n of the surface irregularities
+    # and of the fixed term Mn2
+    return Mn1 + ops.scalar(Mn2)
+#fed
+
+@backend_function
+def compute_Manning_monthly(manning_static, Mn4, ndvi):
+    # monthly part of compute_Manning
+    return manning_static + Manning_v3(ndvi) * Mn4
+#fed
+
+@backend_function
+def delivery_ratio_prefactor(slope_gradient, slope_length):
+    # static part of compute_delivery_ratio: sqrt(slope in %) / slope length
+    return ops.sqrt(slope_gradient * 100) / slope_length
+#fed
+
+@backend_function
+def compute_delivery_ratio_monthly(HydroCoeff, slope_term, Manning, alpha = 9.53, beta = 0.79):
+    # monthly part of compute_delivery_ratio
+    tmp0 = HydroCoeff * slope_term / Manning
+    return ops.min(1, ops.max(0, ops.scalar(alpha) * pow(tmp0, ops.scalar(beta))))
+#fed
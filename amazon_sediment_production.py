@@ -10,7 +10,7 @@ This is as well represented by the use of long-term monthly averages.
 
 """
 
-import os, sys, datetime, csv
+import os, sys, datetime, csv, atexit
 import numpy as np
 from pcraster import *
 from pcraster.framework import *
@@ -21,18 +21,37 @@ from spatialDataSet2PCR import spatialAttributes, spatialDataSet, setClone
 from ncRecipes_fixed import getNCDates
 from read_temporal_info_to_pcr import create_date_list, getTimedPCRData
 from zonalStatistics import zonal_statistics_pcr
-from convert2NetCDF import createNetCDF, data2NetCDF
+from netcdf_writer import BufferedNetCDFWriter
 
 # import functions that are part of our model
 from amazon_factors import *
+from rusle_kernel import compute_monthly_sediment, dynamic_inputs, \
+    static_inputs, kernel_outputs, parallel_block_rows
+from multiprocessing.pool import ThreadPool
+from active_cells import ActiveCells
+from factor_graph import FactorGraph
+from ensemble import MonteCarloEnsemble, sample_parameters
+from static_cache import StaticFactorCache
+from landcover_stack import CoverFractionStack, compute_conservation_factor_stack, \
+    compute_interception_fraction_stack, Manning_n4_stack
+from input_prefetch import InputPrefetcher
+from extent_check import ExtentValidator
+from gap_filling import NearestValidFiller
+from report_queue import ReportQueue
+import checkpoint
+from input_naming import TimestepNaming
+from collections import OrderedDict
+import amazon_factors, numpy_pcr, diagnostics, landcover_stack
 
 class RUSLE(DynamicModel):
-    def __init__(self, clone_pathname, mapdir, txtdir, outdir, startdate):
+    def __init__(self, clone_pathname, mapdir, txtdir, outdir, startdate, restart = False, \
+            input_naming = None, static_state = None):
         # Call the constructor of our parent class.
         DynamicModel.__init__(self)
 
         # Before do anything else, set the clone map to the map with supplied pathname
-        setclone(clone_filename)
+        setclone(clone_pathname)
+        self.clone_pathname = clone_pathname
         self.clone_mask = readmap(clone_pathname)
 
         # Input and output directories
@@ -42,13 +61,56 @@ class RUSLE(DynamicModel):
 
         # The date where our modelling starts
         self.startdate = startdate
+        # The naming scheme of the monthly and annual input maps
+        self.input_naming = input_naming if input_naming is not None else TimestepNaming()
+
+        # Checkpoints: on a restart, the run continues after the time step of the
+        # latest checkpoint in the checkpoint directory
+        self.checkpoint_dir = os.path.join(self.outputdir, 'checkpoints')
+        self.restart_state = None
+        if restart:
+            self.restart_state = checkpoint.latest_checkpoint(self.checkpoint_dir)
+            if self.restart_state is None:
+                print('No checkpoint found in %s, starting from the first time step' % self.checkpoint_dir)
+            #fi
+        #fi
+
+        # Static factors provided by the caller as arrays, e.g., shared by a
+        # scenario runner; if given, the static input is not read at all
+        self.static_state = static_state
+    #fed
+
+    # The first time step of the run: 1, or the one after the checkpoint on a restart
+    def first_timestep(self):
+        if self.restart_state is None:
+            return 1
+        #fi
+        return self.restart_state['timestep'] + 1
     #fed
 
     def initial(self):
         print('Initial Section Started')
         self.config_model()  
-        self.load_input_initial()
-        self.setup_model()  
+        if self.restart_state is None:
+            # checkpoints of an earlier run in the same output directory are stale
+            checkpoint.clear_checkpoints(self.checkpoint_dir)
+        else:
+            self.check_restart()
+        #fi
+        self.open_output()
+        if self.static_state is not None:
+            self.set_static_state(self.static_state)
+        elif self.restart_state is not None:
+            self.load_checkpoint()
+        elif not self.load_static_cache():
+            self.load_input_initial()
+            self.setup_model()  
+            self.store_static_cache()
+        #fi
+        self.finish_setup()
+        if self.restart_state is not None:
+            self.check_netcdf_positions()
+        #fi
         print('Initial Section Finished')
     #fed
 
@@ -56,17 +118,111 @@ class RUSLE(DynamicModel):
         print("Start model configuration")
         # Start with some options you can change as you wish
         self.tests = True            
+        # if True, only the input is tested, once when it is loaded, and not the
+        # factors computed from it
+        self.tests_inputs_only = False
         # Routing choice
         self.accufractionflux = False   
         self.accufraction = 0.9         
 
         # Model options
         self.apply_Pfactor = False   
+        # Computation engine: 'factors' evaluates the factor functions one by one,
+        # 'fused' computes SoilLoss, DelRatio and SedTrans in a single block-wise pass
+        self.engine = 'factors'
+        self.kernel_block_rows = 256
+        # Number of threads: the fused engine distributes blocks of rows over a
+        # pool of threads, the factors engine passes it on to PCRaster
+        self.kernel_workers = 1
+        # If True, the fused engine only computes the active cells of the clone
+        # mask, held as 1-D arrays; the cells outside the mask are missing
+        self.active_cells_only = False
+        # Monthly factors that are computed and reported: only the factors on which
+        # they depend are evaluated and only the input maps that these need are
+        # read; the fused engine computes all of SoilLoss, DelRatio and SedTrans
+        self.requested_outputs = ['R_month', 'K_month', 'C_month', 'P_month', 'SoilLoss', \
+            'Manning', 'HydroCff', 'DelRatio', 'SedTrans']
+        # If True, the sub-expressions of the monthly factors that only depend on
+        # static (or annual) factors are computed once, when the static factors
+        # are set up or the annual factors change, instead of every month
+        self.hoist_static = True
+
+        # Monte Carlo ensemble for uncertainty runs with ensemble_members members,
+        # 0 for none; the parameters of the members are varied with the relative
+        # spread (ensemble.default_spread if None). The mean and quantiles over
+        # the members of the ensemble outputs are written per month to NetCDF
+        # files, and those of the totals over the run to maps, in ensemble_dir
+        self.ensemble_members = 0
+        self.ensemble_seed = 1
+        self.ensemble_spread = None
+        self.ensemble_quantiles = [0.05, 0.5, 0.95]
+        self.ensemble_outputs = ['SoilLoss', 'SedTrans']
+        self.ensemble_dir = os.path.join(self.outputdir, 'ensemble')
+
+        # Static factor cache: the static factors are stored on disk and re-used
+        # as long as the input maps, text tables and factor code do not change
+        self.static_cache = True
+        self.static_cache_dir = os.path.join(os.getcwd(), 'static_cache')
+        self.static_factor_names = static_inputs + ['interception_fraction']
+
+        # Monthly input: the maps of the next time step(s) are read in the background
+        # while the current time step is computed; prefetch_depth sets how many.
+        # Off by default: readmap holds the GIL, so that the reading hardly overlaps
+        # with the computation (see benchmark_prefetch.py)
+        self.prefetch_inputs = False
+        self.prefetch_depth = 1
+        self.dynamic_mapnames = {'ndvi': 'ndvi0000', 'Qsurface': 'Qsurface', \
+            'tavg': 'tavg0000', 'tmax': 'tmax0000', 'tmin': 'tmin0000', \
+            'rain_month': 'Pre90000', 'ground_cover_fraction': 'cfr00000'}
+
+        # Monthly input of which the missing values are filled with the value of the
+        # nearest valid cell; the index of the donor cells is only rebuilt when the
+        # pattern of missing values changes. Missing rainfall that is not filled in
+        # this way is set to -999.9
+        self.nearest_fill_inputs = ['ndvi']
+        self.gap_fillers = dict((name, NearestValidFiller()) for name in self.nearest_fill_inputs)
+
+        # Annual factors: if the naming scheme provides an annual rainfall map per
+        # year, the annual rainfall and R_year are updated per calendar year; the
+        # factors of the last annual_window years are kept in memory
+        self.annual_window = 2
+        self.annual_factors = OrderedDict()
+        self.current_year = None
 
         # Reporting/output options
         self.yearly_reports = True   
         self.monthly_reports = True  
+        # Frequency in time steps at which each monthly map is written, 0 to skip it
+        self.monthly_report_frequency = {'R_month': 1, 'K_month': 1, 'C_month': 1, \
+            'P_month': 1, 'SoilLoss': 1, 'Manning': 1, 'HydroCff': 1, 'DelRatio': 1, \
+            'SedTrans': 1}
+        # Maps are written in the background by report_writers threads; the model
+        # waits if more than report_max_pending maps per writer are pending
+        self.report_writers = 2
+        self.report_max_pending = 4
         self.netcdf_output = True    
+        # NetCDF output is buffered per product for netcdf_buffer_size time steps
+        # and written to chunked variables compressed with zlib and shuffle
+        self.netcdf_buffer_size = 12
+        self.netcdf_chunk_shape = (12, 64, 64)
+        self.netcdf_complevel = 4
+        self.netcdf_shuffle = True
+
+        # Checkpoints are written every checkpoint_interval time steps, 0 for none;
+        # checkpoints_kept is the number of checkpoints that is kept on disk
+        self.checkpoint_interval = 6
+        self.checkpoints_kept = 2
+
+        # Diagnostics of the intermediate results of the factor functions; these
+        # are off for production runs. When switched on, either the full grids
+        # ('grid') or summary statistics ('summary') are written for the selected
+        # time steps (all if None) to the diagnostics directory
+        self.diagnostics = False
+        self.diagnostics_mode = 'summary'
+        self.diagnostics_timesteps = None
+        self.diagnostics_dir = os.path.join(self.outputdir, 'diagnostics')
+        diagnostics.configure(enabled = self.diagnostics, timesteps = self.diagnostics_timesteps, \
+            sink = self.diagnostics_dir if self.diagnostics else None, mode = self.diagnostics_mode)
 
         # Specify the data that we want to write to the netcdf file
         self.dataProducts = {}
@@ -76,7 +232,11 @@ class RUSLE(DynamicModel):
             'variable': 'DeliveryRatio','unit': 'non' }
         self.dataProducts['SoilLoss'] = {\
             'variable': 'SoilLoss','unit': 'tonnes per month' }
-        self.netcdf_init()
+        for key in list(self.dataProducts.keys()):
+            if key not in self.requested_outputs:
+                del self.dataProducts[key]
+            #fi
+        #rof
 
         print('Configuration is:')
         if self.accufractionflux:
@@ -85,6 +245,10 @@ class RUSLE(DynamicModel):
             print('\tRouting Function is Accuflux')
         #fi
         print('\tP factor is %s' % ("applied" if self.apply_Pfactor else "ignored"))            
+        print('\tEngine is %s' % self.engine)
+        if self.static_cache:
+            print('\tStatic factors are cached in %s' % self.static_cache_dir)
+        #fi
 
        
         print("\tWriting " + ", ".join(map(lambda x: x[0], filter(lambda x: x[1], list(zip( \
@@ -95,10 +259,18 @@ class RUSLE(DynamicModel):
         print("Finished model configuration")
     #fed
 
+    # Start the writers of the map and NetCDF output
+    def open_output(self):
+        self.report_queue = ReportQueue(self.write_map, \
+            nr_writers = self.report_writers, max_pending = self.report_max_pending)
+        atexit.register(self.report_queue.close)
+        self.netcdf_init()
+    #fed
+
     def setup_model(self):
         # add a function to compute the interception fraction
-        self.interception_fraction = compute_interception_fraction( \
-            self.cover_fraction_info, self.part_interception_info)
+        self.interception_fraction = self.array2field(compute_interception_fraction_stack( \
+            self.cover_stack, self.part_interception_info))
 
         print("Start computing overall yearly (not dynamic) factors")
         
@@ -112,14 +284,277 @@ class RUSLE(DynamicModel):
         self.R_year = compute_annual_erosivity((1.0 - self.interception_fraction) * self.rain_annual)
         mv = -999.9
         self.R_year = cover(self.R_year, mv)
-        self.P_month  = compute_conservation_factor(self.cover_fraction_info, self.P_factor_info,self.selected_slope)
+        self.P_month  = self.array2field(compute_conservation_factor_stack(self.cover_stack, \
+            self.P_factor_info, pcr2numpy(self.selected_slope, np.nan)))
         self.Manning_n1 = Manning_n1(self.slope_gradient, self.Manning_n1_TBL)
-        self.Manning_n4 = Manning_n4(self.cover_fraction_info, self.manning_n_info)
+        self.Manning_n4 = self.array2field(Manning_n4_stack(self.cover_stack, self.manning_n_info))
         print("Finished computing overall yearly (not dynamic) factors")
+    #fed
 
+    # Reporting and tests of the static factors, whether computed or taken from the cache
+    def finish_setup(self):
         # Report static (yearly) factors
-        map(self.report_yearly_result, ["LS", "K_year", "R_year"])
+        for factorname in ["LS", "K_year", "R_year"]:
+            self.report_yearly_result(factorname)
+        #rof
         self.check_extent()
+
+        # the monthly input that is read: all input of the fused kernel or the
+        # input on which the requested outputs depend
+        self.factor_graph = self.build_factor_graph()
+        if self.engine == 'fused':
+            self.dynamic_input_names = list(dynamic_inputs)
+        else:
+            self.dynamic_input_names = self.factor_graph.required_inputs(self.requested_outputs)
+            # compute the static prefactors once
+            self.factor_graph.evaluate(self.factor_graph.required_static(self.requested_outputs), \
+                None, lambda name: getattr(self, name))
+        #fi
+        if self.ensemble_members > 0:
+            self.dynamic_input_names = list(dynamic_inputs)
+            self.setup_ensemble()
+        #fi
+        print('Monthly input: %s' % ', '.join(self.dynamic_input_names))
+
+        # the fused engine works on arrays; convert the static factors once
+        if self.engine == 'fused':
+            if not hasattr(self, 'static_arrays'):
+                self.static_arrays = dict((name, pcr2numpy(getattr(self, name), np.nan)) \
+                    for name in static_inputs)
+            #fi
+            self.kernel_output = None
+            self.kernel_grids = None
+            self.active = None
+            nr_rows, nr_cols = pcr2numpy(self.clone_mask, 0).shape
+            if self.active_cells_only:
+                self.active = ActiveCells(pcr2numpy(self.clone_mask, 0) != 0)
+                self.active.report()
+                self.static_arrays = self.active.gather_dict(self.static_arrays)
+                # blocks of as many cells as kernel_block_rows rows of the grid
+                nr_rows = self.active.nr_cells
+                self.kernel_block_rows *= nr_cols
+            #fi
+            self.kernel_pool = None
+            if self.kernel_workers > 1:
+                self.kernel_pool = ThreadPool(self.kernel_workers)
+                self.kernel_block_rows = parallel_block_rows(nr_rows, \
+                    self.kernel_workers, self.kernel_block_rows)
+                print('Fused engine: %d threads, blocks of %d rows or cells' % \
+                    (self.kernel_workers, self.kernel_block_rows))
+            #fi
+        elif self.kernel_workers > 1:
+            # multi-threaded PCRaster operations, PCRaster 4.2 and later
+            try:
+                setnrcpus(self.kernel_workers)
+            except NameError:
+                print('Warning: this PCRaster version cannot use %d threads' % self.kernel_workers)
+            #yrt
+        #fi
+    #fed
+
+    # The monthly factor chain as a dependency graph: the static factors and the
+    # monthly input are input nodes, of which the values are the attributes of
+    # the model
+    def build_factor_graph(self):
+        graph = FactorGraph()
+        for name in static_inputs:
+            graph.add(name, kind = 'static')
+        #rof
+        for name in dynamic_inputs:
+            graph.add(name, kind = 'monthly')
+        #rof
+        graph.add('melt_time_fraction', compute_melt_time_fraction, ['tmin', 'tmax'])
+        graph.add('HydroCff', compute_hydro_coeff, ['Qsurface', 'rain_month'])
+        if self.hoist_static:
+            # static prefactors
+            graph.add('inverse_rain_annual', erosivity_prefactor, ['rain_annual'], kind = 'static')
+            graph.add('inverse_R_year', vegcover_prefactor, ['R_year'], kind = 'static')
+            graph.add('kfact_amplitude', kfact_prefactor, ['K_year', 'kfact_seasonal'], kind = 'static')
+            graph.add('soil_loss_static', soil_loss_prefactor, ['LS', 'P_month', 'CellArea'], \
+                kind = 'static')
+            graph.add('manning_static', manning_prefactor, ['Manning_n1'], kind = 'static')
+            graph.add('slope_term', delivery_ratio_prefactor, ['slope_gradient', 'slope_length'], \
+                kind = 'static')
+            # monthly remainders
+            graph.add('R_month', partition_erosivity_monthly, ['rain_month', 'inverse_rain_annual', 'R_year'])
+            graph.add('K_month', compute_kfact_monthly_split, ['K_year', 'kfact_amplitude', 'melt_time_fraction'])
+            graph.add('C_month', compute_vegcover_factor_monthly, \
+                ['ground_cover_fraction', 'R_month', 'inverse_R_year'])
+            graph.add('SoilLoss', compute_soil_loss_monthly, ['R_month', 'K_month', 'C_month', 'soil_loss_static'])
+            graph.add('Manning', compute_Manning_monthly, ['manning_static', 'Manning_n4', 'ndvi'])
+            graph.add('DelRatio', compute_delivery_ratio_monthly, ['HydroCff', 'slope_term', 'Manning'])
+        else:
+            graph.add('R_month', partition_erosivity, ['rain_month', 'rain_annual', 'R_year'])
+            graph.add('K_month', compute_kfact_monthly, ['K_year', 'kfact_seasonal', 'melt_time_fraction'])
+            graph.add('C_month', compute_vegcover_factor2, ['ground_cover_fraction', 'R_month', 'R_year'])
+            graph.add('SoilLoss', compute_soil_loss, ['R_month', 'K_month', 'LS', 'C_month', 'P_month', 'CellArea'])
+            graph.add('Manning', compute_Manning, ['Manning_n1', 'Manning_n4', 'ndvi'])
+            graph.add('DelRatio', compute_delivery_ratio, ['HydroCff', 'slope_gradient', 'Manning', 'slope_length'])
+        #fi
+        graph.add('SedTrans', compute_erosion, ['SoilLoss', 'DelRatio'])
+        return graph
+    #fed
+
+    # Set up the Monte Carlo ensemble over the active cells and its output
+    def setup_ensemble(self):
+        print('Setting up an ensemble of %d members' % self.ensemble_members)
+        self.ensemble_cells = ActiveCells(pcr2numpy(self.clone_mask, 0) != 0)
+        # the land cover is not held if the static factors were not computed
+        if not hasattr(self, 'cover_stack'):
+            self.cover_stack = self.load_landcovermaps( \
+                self.load_landcoverdata(self.check_txtfile("Landcover_n4.txt")).keys())
+            self.selected_slope = cover(self.rd_map('sel_slope'), mv)
+        #fi
+        tables = {'P_factor_info': self.load_landcoverdata(self.check_txtfile("P_factor.txt")), \
+            'part_interception_info': self.load_landcoverdata(self.check_txtfile("part_interception.txt"))}
+        self.ensemble = MonteCarloEnsemble(sample_parameters(self.ensemble_members, tables, \
+            spread = self.ensemble_spread, seed = self.ensemble_seed), \
+            quantiles = self.ensemble_quantiles, outputs = self.ensemble_outputs)
+        self.ensemble.setup_static( \
+            dict((name, self.ensemble_cells.gather(pcr2numpy(getattr(self, name), np.nan))) \
+                for name in static_inputs), \
+            CoverFractionStack.from_array(self.cover_stack.classes, \
+                self.ensemble_cells.gather(self.cover_stack.fractions)), \
+            self.ensemble_cells.gather(pcr2numpy(self.selected_slope, np.nan)))
+        # on a restart, the totals continue from the checkpoint; if they were
+        # not saved with it, the maps of the totals are named as partial
+        self.ensemble_totals_name = 'total'
+        if self.restart_state is not None and self.restart_state['timestep'] > 0 and \
+                not self.ensemble.restore_totals(checkpoint.load_checkpoint_arrays( \
+                self.checkpoint_dir, self.restart_state)):
+            print('Warning: the checkpoint holds no ensemble totals; the totals only ' \
+                'cover the time steps after timestep %d' % self.restart_state['timestep'])
+            self.ensemble_totals_name = 'partial_total'
+        #fi
+
+        if not os.path.isdir(self.ensemble_dir):
+            os.makedirs(self.ensemble_dir)
+        #fi
+        latitudes, longitudes = self.netcdf_coordinates()
+        self.ensemble_writers = {}
+        for name in self.ensemble_outputs:
+            unit = self.dataProducts[name]['unit'] if name in self.dataProducts else '-'
+            for statistic in self.ensemble.statistics:
+                varName = '%s_%s' % (name, statistic)
+                self.ensemble_writers[(name, statistic)] = BufferedNetCDFWriter( \
+                    os.path.join(self.ensemble_dir, '%s.nc' % varName), varName, unit, \
+                    longitudes, latitudes, buffer_size = self.netcdf_buffer_size, \
+                    chunk_shape = self.netcdf_chunk_shape, complevel = self.netcdf_complevel, \
+                    shuffle = self.netcdf_shuffle, MV = mv, append = self.restart_state is not None)
+            #rof
+        #rof
+        atexit.register(self.ensemble_close)
+    #fed
+
+    # Evaluate all members for the current time step and write the statistics
+    def compute_ensemble(self):
+        statistics = self.ensemble.evaluate(dict((name, \
+            self.ensemble_cells.gather(pcr2numpy(getattr(self, name), np.nan))) for name in dynamic_inputs))
+        for (name, statistic), writer in self.ensemble_writers.items():
+            writer.write(self.ensemble_cells.scatter(statistics[name][statistic]), \
+                posCnt = self.currentTimeStep() - 1, timeStamp = self.current_date)
+        #rof
+    #fed
+
+    # Write the statistics of the totals over the run and close the ensemble output
+    def ensemble_close(self):
+        if self.ensemble_members > 0 and self.ensemble_writers is not None:
+            for name, statistics in self.ensemble.total_statistics().items():
+                for statistic, values in statistics.items():
+                    self.report_queue.submit(os.path.join(self.ensemble_dir, '%s_%s_%s.map' % \
+                        (name, self.ensemble_totals_name, statistic)), self.ensemble_cells.scatter(values))
+                #rof
+            #rof
+            for writer in self.ensemble_writers.values():
+                writer.close()
+            #rof
+            self.ensemble_writers = None
+        #fi
+    #fed
+
+    # Returns the input files on which the static factors depend; keep this in
+    # line with the maps and tables read by load_input_initial
+    def static_input_files(self):
+        mapnames = ['globalbcat', 'LDD', 'cellarea_05min', 'slope05min_avgFrom30sec', \
+            'sel_slope', 'fsand_05deg', 'fsilt_05deg', 'fclay_05deg']
+        txtnames = ['Landcover_n4.txt', 'P_factor.txt', 'part_interception.txt', \
+            'ManningN1.txt']
+        mapnames += sorted(self.load_landcoverdata(self.check_txtfile('Landcover_n4.txt')).keys())
+        rain_annual_pathname = self.rain_annual_pathname()
+        if rain_annual_pathname is None:
+            rain_annual_pathname = self.map_pathname('Pan_90')
+        #fi
+        return [self.map_pathname(mapname) for mapname in mapnames] + [rain_annual_pathname] + \
+            [self.check_txtfile(txtname) for txtname in txtnames]
+    #fed
+
+    # Returns the pathname of the annual rainfall map of the first year of the run
+    # as resolved by the naming scheme, or None if the annual rainfall is the
+    # static map Pan_90, e.g., if the run has no start date
+    def rain_annual_pathname(self):
+        if self.startdate is None:
+            return None
+        #fi
+        mapname = self.input_naming.annual('rain_annual', 'Pan_90', self.startdate.year)
+        if mapname is None:
+            return None
+        #fi
+        pathname = os.path.join(self.mapdir, mapname)
+        if not os.path.isfile(pathname):
+            sys.exit("Error: map %s in %s does not exist" % (mapname, self.mapdir))
+        #fi
+        return pathname
+    #fed
+
+    # Returns the key of the static input and code, which identifies the static
+    # factors in the cache and in the checkpoints; it is computed once per run
+    def static_key(self):
+        if getattr(self, 'static_cache_key', None) is None:
+            self.factor_cache = StaticFactorCache(self.static_cache_dir, \
+                [amazon_factors.__file__, numpy_pcr.__file__, landcover_stack.__file__, __file__])
+            self.static_cache_key = self.factor_cache.compute_key(self.static_input_files())
+        #fi
+        return self.static_cache_key
+    #fed
+
+    # Try to get the static factors from the cache; returns True on a hit, in
+    # which case the input maps are not read and the factors not computed
+    def load_static_cache(self):
+        if not self.static_cache:
+            return False
+        #fi
+        key = self.static_key()
+        cached_factors = self.factor_cache.load(key, self.static_factor_names)
+        self.factor_cache.report()
+        if cached_factors is None:
+            return False
+        #fi
+        self.set_static_state(cached_factors)
+        return True
+    #fed
+
+    def store_static_cache(self):
+        if self.static_cache:
+            self.factor_cache.store(self.static_cache_key, self.static_state_arrays())
+        #fi
+    #fed
+
+    # Returns the static factors as a dictionary of arrays by name
+    def static_state_arrays(self):
+        return dict((name, pcr2numpy(getattr(self, name), np.nan)) \
+            for name in self.static_factor_names)
+    #fed
+
+    # Set the static factors from a dictionary of arrays by name, as returned by
+    # static_state_arrays; the arrays may be read-only (memory-mapped or shared)
+    def set_static_state(self, arrays):
+        for name in self.static_factor_names:
+            setattr(self, name, self.array2field(arrays[name]))
+        #rof
+        if self.engine == 'fused':
+            # the arrays are used directly
+            self.static_arrays = dict((name, arrays[name]) for name in static_inputs)
+        #fi
     #fed
 
     def dynamic(self):
@@ -127,27 +562,173 @@ class RUSLE(DynamicModel):
             print('Dynamic Section Starts')
         #fi
         self.calc_currentdate()
+        self.update_annual_factors()
+        diagnostics.set_timestep(self.currentTimeStep())
         self.load_input_dynamic()
+        if self.tests_inputs_only:
+            self.check_extent(self.dynamic_input_names)
+        #fi
 
         # Compute all dynamic factors
         print("Start computing monthly (dynamic) factors for timestep %d (date = %s)" % (self.currentTimeStep(), self.current_date))
-        self.R_month = partition_erosivity(self.rain_month, self.rain_annual,self.R_year)
-        self.melt_time_fraction = compute_melt_time_fraction(self.tmin, self.tmax)
-        self.K_month = compute_kfact_monthly(self.K_year, self.kfact_seasonal, self.melt_time_fraction)
-        self.C_month = compute_vegcover_factor2(self.ground_cover_fraction,self.R_month, self.R_year )
-        self.SoilLoss = compute_soil_loss(self.R_month, self.K_month, self.LS, self.C_month, self.P_month, self.CellArea)
-        self.Manning = compute_Manning(self.Manning_n1, self.Manning_n4, self.ndvi)
-        self.HydroCff = compute_hydro_coeff(self.Qsurface, self.rain_month)
-        self.DelRatio = compute_delivery_ratio(self.HydroCff, self.slope_gradient, self.Manning, self.slope_length)
-        self.SedTrans = \
-            compute_erosion(self.SoilLoss, self.DelRatio)
+        if self.engine == 'fused':
+            self.compute_fused_factors()
+            monthly_factors = [name for name in ['P_month', 'SoilLoss', 'DelRatio', 'SedTrans'] \
+                if name in self.requested_outputs]
+        else:
+            # evaluate the requested factors and the factors on which they depend
+            values = self.factor_graph.evaluate(self.requested_outputs, self.currentTimeStep(), \
+                lambda name: getattr(self, name))
+            for name, value in values.items():
+                setattr(self, name, value)
+            #rof
+            monthly_factors = list(self.requested_outputs)
+        #fi
+        if self.ensemble_members > 0:
+            self.compute_ensemble()
+        #fi
         print('Finished computing for timestep %d (date = %s)' % (self.currentTimeStep(), self.current_date))
 
         # Report dynamic factors
-        map(self.report_monthly_result, ["R_month", "K_month", "C_month", 'P_month','SoilLoss', 'Manning', 'HydroCff','DelRatio', 'SedTrans'])
+        for factorname in monthly_factors:
+            self.report_monthly_result(factorname)
+        #rof
         self.netcdf_writedata()
-        self.check_extent()
+        if not self.tests_inputs_only:
+            self.check_extent()
+        #fi
+        if self.checkpoint_interval > 0 and \
+                self.currentTimeStep() % self.checkpoint_interval == 0 and \
+                self.currentTimeStep() < self.nrTimeSteps():
+            self.save_checkpoint()
+        #fi
+        if self.currentTimeStep() == self.nrTimeSteps():
+            self.finish_run()
+        #fi
+    #fed
+
+    # Write a checkpoint after the current time step: the output is flushed
+    # first, the static factors are saved once and the checkpoint itself only
+    # holds the time step, the date and the output positions
+    def save_checkpoint(self):
+        self.netcdf_flush()
+        self.report_queue.flush()
+        if not checkpoint.static_state_saved(self.checkpoint_dir, self.static_factor_names, \
+                self.static_key()):
+            checkpoint.save_static_state(self.checkpoint_dir, self.static_state_arrays(), \
+                self.static_key())
+        #fi
+        # the number of time steps in every NetCDF file, checked on a restart
+        netcdf_positions = dict((filename, writer.timesteps_written()) \
+            for filename, writer in self.netcdf_files().items())
+        # the totals of the ensemble are saved with the checkpoint
+        arrays = self.ensemble.totals_state() if self.ensemble_members > 0 else None
+        checkpoint.save_checkpoint(self.checkpoint_dir, self.currentTimeStep(), \
+            {'date': self.current_date.strftime('%Y-%m-%d'), \
+            'netcdf_positions': netcdf_positions, 'static_key': self.static_key()}, keep = self.checkpoints_kept, arrays = arrays)
+        print('Checkpoint written for timestep %d (date = %s)' % (self.currentTimeStep(), self.current_date))
+    #fed
+
+    # Refuse a restart from a checkpoint that was written with other static
+    # input or code than that of this run
+    def check_restart(self):
+        if self.restart_state.get('static_key') != self.static_key():
+            sys.exit('Error: the checkpoint of timestep %d in %s was written with other input ' \
+                'or code, cannot restart' % (self.restart_state['timestep'], self.checkpoint_dir))
+        #fi
+    #fed
 
+    # Returns the open NetCDF writers of the run by the name of their file,
+    # relative to the output directory
+    def netcdf_files(self):
+        writers = list(self.netcdf_writers.values()) if self.netcdf_output else []
+        if self.ensemble_members > 0 and self.ensemble_writers is not None:
+            writers += list(self.ensemble_writers.values())
+        #fi
+        return dict((os.path.relpath(writer.filename, self.outputdir), writer) for writer in writers)
+    #fed
+
+    # On a restart, every NetCDF file of the checkpoint must hold at least the
+    # time steps up to the checkpoint; time steps after it are overwritten
+    def check_netcdf_positions(self):
+        writers = self.netcdf_files()
+        for filename, nr_timesteps in self.restart_state.get('netcdf_positions', {}).items():
+            if filename not in writers:
+                sys.exit('Error: %s of the checkpoint is not written by this run, cannot restart' % \
+                    filename)
+            #fi
+            if writers[filename].timesteps_written() < nr_timesteps:
+                sys.exit('Error: %s holds %d time step(s) instead of the %d of the checkpoint, cannot restart' % \
+                    (filename, writers[filename].timesteps_written(), nr_timesteps))
+            #fi
+        #rof
+    #fed
+
+    # Restore the static factors from the checkpoint directory on a restart
+    def load_checkpoint(self):
+        print('Restarting after timestep %d (date = %s)' % \
+            (self.restart_state['timestep'], self.restart_state['date']))
+        self.set_static_state(checkpoint.load_static_state(self.checkpoint_dir, \
+            self.static_factor_names, self.static_key()))
+    #fed
+
+    # Finalise the output at the end of the run
+    def finish_run(self):
+        self.netcdf_close()
+        self.ensemble_close()
+        self.report_queue.close()
+        for name in self.nearest_fill_inputs:
+            self.gap_fillers[name].report(name)
+        #rof
+        if hasattr(self, 'prefetcher'):
+            self.prefetcher.report()
+            self.prefetcher.close()
+        #fi
+        if self.engine != 'fused':
+            self.factor_graph.report()
+        #fi
+        if getattr(self, 'kernel_pool', None) is not None:
+            self.kernel_pool.close()
+            self.kernel_pool.join()
+        #fi
+        if self.diagnostics and self.diagnostics_mode == 'summary':
+            diagnostics.write_summaries(os.path.join(self.diagnostics_dir, 'summaries.csv'))
+        #fi
+    #fed
+
+    # Compute SoilLoss, DelRatio and SedTrans with the fused kernel; the output
+    # arrays of the previous time step are re-used
+    def compute_fused_factors(self):
+        dynamic_data = dict((name, self.engine_array(pcr2numpy(getattr(self, name), np.nan))) \
+            for name in dynamic_inputs)
+        self.kernel_output = compute_monthly_sediment(dynamic_data, self.static_arrays, \
+            block_rows = self.kernel_block_rows, out = self.kernel_output, pool = self.kernel_pool)
+        if self.active is not None:
+            # the active cells are scattered into grids that are re-used
+            if self.kernel_grids is None:
+                self.kernel_grids = dict((name, None) for name in kernel_outputs)
+            #fi
+            for name in kernel_outputs:
+                self.kernel_grids[name] = self.active.scatter(self.kernel_output[name], \
+                    out = self.kernel_grids[name])
+            #rof
+            grids = self.kernel_grids
+        else:
+            grids = self.kernel_output
+        #fi
+        for name in kernel_outputs:
+            setattr(self, name, self.array2field(grids[name]))
+        #rof
+    #fed
+
+    # Returns the array as used by the fused engine: the full grid or, with
+    # active_cells_only, the vector of the active cells
+    def engine_array(self, data):
+        if self.active is None:
+            return data
+        #fi
+        return self.active.gather(data)
+    #fed
 
     def load_input_initial(self):
         print('Start reading input files')
@@ -158,7 +739,9 @@ class RUSLE(DynamicModel):
         self.selected_slope = self.rd_map('sel_slope')
         mv = -999.9
         self.selected_slope= cover(self.selected_slope, mv)
-        self.rain_annual = self.rd_map('Pan_90')
+        # the annual rainfall of the first year if the naming scheme has annual maps
+        pathname = self.rain_annual_pathname()
+        self.rain_annual = self.rd_map('Pan_90') if pathname is None else readmap(pathname)
         # We replace any missing values in the rainfall map
         mv = -999.9
         self.rain_annual= cover(self.rain_annual, mv)
@@ -179,7 +762,7 @@ class RUSLE(DynamicModel):
         
 
         # ... then read in all the land cover maps.
-        self.cover_fraction_info = self.load_landcovermaps(mapnames)
+        self.cover_stack = self.load_landcovermaps(mapnames)
         self.Manning_n1_TBL = self.check_txtfile('ManningN1.txt')
         
         # Adjusting the input map data for our uses
@@ -192,34 +775,79 @@ class RUSLE(DynamicModel):
 
     def load_input_dynamic(self):
         print('Reading input files for timestep %d (date = %s)' % (self.currentTimeStep(), self.current_date))
-        ndvi = self.rd_map('ndvi0000')
-        qsurface = self.rd_map('Qsurface')
-        tavg = self.rd_map('tavg0000')
-        tmax = self.rd_map('tmax0000')
-        tmin = self.rd_map('tmin0000')
-        rain_month = self.rd_map('Pre90000')
-        self.ground_cover_fraction= self.rd_map('cfr00000')
-        
-        
+        if self.prefetch_inputs:
+            if not hasattr(self, 'prefetcher'):
+                self.prefetcher = InputPrefetcher(self.read_input_dynamic, \
+                    self.currentTimeStep(), self.nrTimeSteps(), depth = self.prefetch_depth)
+            #fi
+            input_data = self.prefetcher.get(self.currentTimeStep())
+        else:
+            input_data = self.read_input_dynamic(self.currentTimeStep())
+        #fi
+        for name in self.dynamic_input_names:
+            setattr(self, name, self.array2field(input_data[name]))
+        #rof
+        print('Finished reading input files for timestep %d (date = %s)' % (self.currentTimeStep(), self.current_date))
+    #fed
+
+    # Reads the monthly input maps for the time step as arrays and converts them
+    # to the units used by the model; this is called from the prefetch thread
+    # and therefore does not use the state of the framework
+    def read_input_dynamic(self, timestep):
+        input_data = {}
+        for name in self.input_mapvariables(self.dynamic_input_names):
+            mapname = self.dynamic_mapnames[name]
+            pathname = os.path.join(self.mapdir, \
+                self.input_naming.monthly(name, mapname, self.date_of_timestep(timestep), timestep))
+            if not os.path.isfile(pathname):
+                sys.exit("Error: map %s in %s does not exist" % (os.path.basename(pathname), self.mapdir))
+            #fi
+            input_data[name] = pcr2numpy(readmap(pathname), np.nan)
+        #rof
+
+        # We replace any missing values in the NDVI map (and others if so configured)
+        # by the value of the nearest cell with data
+        for name in self.nearest_fill_inputs:
+            if name in input_data:
+                input_data[name] = self.gap_fillers[name].fill(input_data[name])
+            #fi
+        #rof
+        return self.prepare_input_dynamic(input_data)
+    #fed
+
+    # Returns the variables of the input maps that are read for the monthly input
+    def input_mapvariables(self, names):
+        variables = set(names)
+        if 'tmax' in variables or 'tmin' in variables:
+            # both follow from the average temperature and the temperature range
+            variables.update(['tavg', 'tmax', 'tmin'])
+        #fi
+        return [name for name in self.dynamic_mapnames.keys() if name in variables]
+    #fed
+
+    # Converts the monthly input arrays, of the whole grid or of a tile, in place
+    # to the units used by the model
+    def prepare_input_dynamic(self, input_data):
         # We replace any missing values in the rainfall map
         mv = -999.9
-        self.rain_month = cover(rain_month, mv)
+        if 'rain_month' in input_data:
+            input_data['rain_month'][np.isnan(input_data['rain_month'])] = mv
+        #fi
 
         # The temperature (max and min) data were in °C * 10 but we need 
         # them in the equation in °C... so the temperature divided by 10.
-        half_tmprange = 0.5 * (tmax - tmin) / 10 
-        # to calculate the maximum and minimum temperature we use the average temperature
-        self.tmax = tavg + half_tmprange
-        self.tmin = tavg - half_tmprange
-
-        # We replace any missing values in the NDVI map
-        fillup_value = areamaximum(ndvi, spreadzone(nominal(uniqueid(defined(ndvi))), 0, 1))
-        self.ndvi = cover(ndvi, fillup_value)
+        if 'tavg' in input_data:
+            half_tmprange = 0.5 * (input_data['tmax'] - input_data['tmin']) / 10 
+            # to calculate the maximum and minimum temperature we use the average temperature
+            input_data['tmax'] = input_data['tavg'] + half_tmprange
+            input_data['tmin'] = input_data['tavg'] - half_tmprange
+        #fi
 
         # Convert the discharge from m/month to mm/month
-        self.Qsurface = qsurface *1000  
-        self.rain_month= self.rain_month 
-        print('Finished reading input files for timestep %d (date = %s)' % (self.currentTimeStep(), self.current_date))
+        if 'Qsurface' in input_data:
+            input_data['Qsurface'] *= 1000
+        #fi
+        return input_data
     #fed
 
     """
@@ -253,78 +881,139 @@ class RUSLE(DynamicModel):
     """
         For each land cover name in the supplied list, a map with that name is
         read from disk which contains the cover fraction data for the land cover
-        type. These maps are returned as a dictionary with the land cover name
-        as key and the map as value.
+        type. These maps are returned as a single stack of arrays, with the land
+        cover names as the index of the classes.
 
         NB: The fractions of all land covers should add up to one. If not, the
         maps for each type are multiplied by the amount that will make their sum 
         add up to the value one. 
     """
     def load_landcovermaps(self, mapnames):
-        # dictiomary with the maps of each land cover
-        cover_fraction_info = {}
-
-        # set map with the total fraction: we check here on complete coverage
-        # as these fractions may be used throughout the script and not
-        # only in the computation of Manning's n
-        total_vegetation_cover = scalar(0)
+        # stack with the fractions of each land cover
+        mapnames = list(mapnames)
+        cover_stack = CoverFractionStack(mapnames, pcr2numpy(self.clone_mask, 0).shape)
 
-        # iterate over the land cover classes and read each land cover map, and 
-        # compute the map with the sum of all land cover fractions.
+        # iterate over the land cover classes and read each land cover map
         for key in mapnames:
-            # add the fraction for the land cover denoted by key
-            cover_fraction_info[key] = self.rd_map(key)
-
-            # add the cover fraction to the total vegetation cover map
-            total_vegetation_cover = total_vegetation_cover \
-                + cover_fraction_info[key]
+            cover_stack.set_fraction(key, pcr2numpy(self.rd_map(key), np.nan))
         #rof
 
         # now, correct by dividing each land cover fraction by the total land cover fraction,
         # so that the total of the vegetation covers becomes unity. We do not process cells
         # for which no significant land cover data is available.
-        for key in cover_fraction_info.keys():        
-            cover_fraction_info[key] = ifthen(total_vegetation_cover > 1.0e-12, \
-                cover_fraction_info[key] / max(1.0e-12, total_vegetation_cover))
-        #rof
+        cover_stack.normalise()
 
-        return cover_fraction_info
+        return cover_stack
     #fed
 
     # Calculate date we are modelling in this timestep
     def calc_currentdate(self):
-        year = self.startdate.year
-        month = self.startdate.month + self.currentTimeStep() - 1
-        if month > 12:
-            month = month - 12
-            year = year + 1
-        #fi 
-        self.current_date = datetime.datetime(year, month, 1)
+        self.current_date = self.date_of_timestep(self.currentTimeStep())
+    #fed
+
+    # Returns the date of the month of the time step, for any number of years
+    def date_of_timestep(self, timestep):
+        months = self.startdate.month - 1 + timestep - 1
+        return datetime.datetime(self.startdate.year + months // 12, months % 12 + 1, 1)
+    #fed
+
+    # Update the annual rainfall and R_year when a new calendar year starts, if the
+    # naming scheme provides annual rainfall maps per year
+    def update_annual_factors(self):
+        year = self.current_date.year
+        if year == self.current_year:
+            return
+        #fi
+        self.current_year = year
+        mapname = self.input_naming.annual('rain_annual', 'Pan_90', year)
+        if mapname is None:
+            return
+        #fi
+        if year not in self.annual_factors:
+            print('Computing the annual factors for %d' % year)
+            pathname = os.path.join(self.mapdir, mapname)
+            if not os.path.isfile(pathname):
+                sys.exit("Error: map %s in %s does not exist" % (mapname, self.mapdir))
+            #fi
+            rain_annual = cover(readmap(pathname), mv)
+            R_year = cover(compute_annual_erosivity((1.0 - self.interception_fraction) * rain_annual), mv)
+            self.annual_factors[year] = {'rain_annual': rain_annual, 'R_year': R_year}
+            while len(self.annual_factors) > self.annual_window:
+                self.annual_factors.popitem(last = False)
+            #elihw
+        #fi
+        self.factor_graph.invalidate(self.annual_factors[year].keys())
+        for name, value in self.annual_factors[year].items():
+            setattr(self, name, value)
+            if name == 'rain_annual' and self.ensemble_members > 0:
+                self.ensemble.set_rain_annual(self.ensemble_cells.gather(pcr2numpy(value, np.nan)))
+            #fi
+            if self.engine == 'fused':
+                self.static_arrays[name] = self.engine_array(pcr2numpy(value, np.nan))
+            #fi
+        #rof
+        if self.yearly_reports:
+            self.submit_map(self.R_year, os.path.join(self.outputdir, 'R_%04d.map' % year))
+        #fi
     #fed
 
     def netcdf_init(self):
         if self.netcdf_output:
             self.MV = -999.9 # value to use for missing values
             ncAttributes = {} # add netcdf settings/attributes in here
-            latitudes = pcr2numpy(ycoordinate(boolean(1)), 0)[:, 0]
-            longitudes = pcr2numpy(xcoordinate(boolean(1)), 0)[0, :]
+            latitudes, longitudes = self.netcdf_coordinates()
+            # one writer, with an open file, per product for the whole run
+            self.netcdf_writers = {}
             for key in self.dataProducts.keys():
                 varName = self.dataProducts[key]['variable']
                 ncFileName = os.path.join(self.outputdir, '%s.nc' % varName) 
-                createNetCDF(ncFileName,\
-                    longitudes, latitudes, timedData = True, attributes = ncAttributes)
+                self.netcdf_writers[key] = BufferedNetCDFWriter(ncFileName, varName, \
+                    self.dataProducts[key]['unit'], longitudes, latitudes, \
+                    buffer_size = self.netcdf_buffer_size, chunk_shape = self.netcdf_chunk_shape, \
+                    complevel = self.netcdf_complevel, shuffle = self.netcdf_shuffle, \
+                    MV = self.MV, attributes = ncAttributes, \
+                    append = self.restart_state is not None)
             #rof
+            # make sure that the buffered output is written if the run stops early
+            atexit.register(self.netcdf_close)
         #fi
     #fed
 
+    # Returns the latitudes of the rows and the longitudes of the columns
+    def netcdf_coordinates(self):
+        latitudes = pcr2numpy(ycoordinate(boolean(1)), 0)[:, 0]
+        longitudes = pcr2numpy(xcoordinate(boolean(1)), 0)[0, :]
+        return latitudes, longitudes
+    #fed
+
     def netcdf_writedata(self):
         if self.netcdf_output:
             for key in self.dataProducts.keys():
                 variableArray = pcr2numpy(getattr(self, key), self.MV)
-                varName = self.dataProducts[key]['variable']
-                ncFileName = os.path.join(self.outputdir, '%s.nc' % varName)
-                data2NetCDF(ncFileName, varName,{'units': self.dataProducts[key]['unit']},\
-                    variableArray, posCnt = self.currentTimeStep() - 1, timeStamp = self.current_date, MV = self.MV)
+                self.netcdf_writers[key].write(variableArray, \
+                    posCnt = self.currentTimeStep() - 1, timeStamp = self.current_date)
+            #rof
+        #fi
+    #fed
+
+    # Write all buffered NetCDF output to disk, e.g., before a checkpoint
+    def netcdf_flush(self):
+        if self.netcdf_output:
+            for writer in self.netcdf_writers.values():
+                writer.flush()
+            #rof
+        #fi
+        if self.ensemble_members > 0:
+            for writer in self.ensemble_writers.values():
+                writer.flush()
+            #rof
+        #fi
+    #fed
+
+    def netcdf_close(self):
+        if self.netcdf_output:
+            for writer in self.netcdf_writers.values():
+                writer.close()
             #rof
         #fi
     #fed
@@ -335,8 +1024,8 @@ class RUSLE(DynamicModel):
                 print('Warning: %s has more than 8 characters, cannot use it as output name' % factorname)
             else:
                 if type(getattr(self, factorname)) is pcraster.Field:
-                    self.report(getattr(self, factorname), os.path.join(self.outputdir, factorname))
-                    print('Annual factor %s successfully written' % (factorname))
+                    self.submit_map(getattr(self, factorname), os.path.join(self.outputdir, factorname + '.map'))
+                    print('Annual factor %s queued for writing' % (factorname))
                 else:
                     print('Warning: self.%s not found in model class or is not a pcraster map' % (factorname))
                 #fi
@@ -345,14 +1034,16 @@ class RUSLE(DynamicModel):
     #fed
 
     def report_monthly_result(self, factorname):
-        if self.monthly_reports:
+        frequency = self.monthly_report_frequency.get(factorname, 0)
+        if self.monthly_reports and frequency > 0 and self.currentTimeStep() % frequency == 0:
             ts = self.currentTimeStep()
             if (len(factorname) > 8):
                 print('Warning: %s has more than 8 characters, cannot use it as output name' % factorname)
             else:
                 if type(getattr(self, factorname)) is pcraster.Field:
-                    self.report(getattr(self, factorname), os.path.join(self.outputdir, factorname))
-                    print('Factor %s successfully written for timestep %d' % (factorname, ts))
+                    self.submit_map(getattr(self, factorname), \
+                        generateNameT(os.path.join(self.outputdir, factorname), ts))
+                    print('Factor %s queued for writing for timestep %d' % (factorname, ts))
                 else:
                     print('Warning: self.%s not found or not a pcraster map for timestep %d' % (factorname, ts))
                 #fi
@@ -360,6 +1051,16 @@ class RUSLE(DynamicModel):
         #fi
     #fed
 
+    # Hand a snapshot of the map to the report queue; the map is written in the background
+    def submit_map(self, field, filename):
+        self.report_queue.submit(filename, pcr2numpy(field, np.nan))
+    #fed
+
+    # Write a snapshot to disk as a scalar PCRaster map; called by the report queue
+    def write_map(self, filename, data):
+        report(self.array2field(data), filename)
+    #fed
+
     def check_dir(self, pathname):
         if not os.path.isdir(pathname):
             sys.exit("Error: directory %s does not exist or is not a directory" % pathname)
@@ -381,6 +1082,22 @@ class RUSLE(DynamicModel):
         #fi
     #fed
 
+    # Converts an array with NaN as missing value to a scalar PCRaster map
+    def array2field(self, data):
+        return numpy2pcr(Scalar, np.ascontiguousarray(data, dtype = np.float32), np.nan)
+    #fed
+
+    # Returns the file name of the map as read by rd_map
+    def map_pathname(self, mapname):
+        pathname = os.path.join(self.mapdir, mapname)
+        for extension in ['.001', '.map']:
+            if os.path.isfile(pathname + extension):
+                return pathname + extension
+            #fi
+        #rof
+        sys.exit("Error: map %s in %s does not exist" % (mapname, self.mapdir))
+    #fed
+
     def check_txtfile(self, filename):
         pathname = os.path.join(self.txtdir, filename)
         if not os.path.isfile(pathname):
@@ -391,46 +1108,34 @@ class RUSLE(DynamicModel):
 
     # Test of the extent of all the data
     #
-    # iterate over all information in maps and check whether areas
-    # are missing over the clone
-    #       
-    # initialize here a counter of the pcraster maps encountered in
-    # the datasets read and keep a map where an error occurs;
-    # in this case, this is initialized as a nominal map with ID 0 and
-    # the counter starts at 1. Values once set, are not overwritten
-    def check_extent(self):
+    # iterate over the information in maps and check whether areas
+    # are missing over the clone; only the maps that changed since the
+    # last test are checked, by default all PCRaster maps of the model,
+    # or those of which the names are given
+    def check_extent(self, names = None):
         if self.tests:
-            var_cnt = 0
-            var_mv_id = ifthen(self.clone_mask, nominal(0))
-
-            # iterate over all variables and keep the maps
-            for variable_name in dir(self):
-                # test on type
-                if type(getattr(self, variable_name)) is pcraster.Field:
-                    #print(variable_name)
-                    # update the counter for the new PCRaster map
-                    var_cnt = var_cnt + 1
-
-                    # get a test mask 
-                    test_mask = ifthen(self.clone_mask, \
-                        defined(getattr(self, variable_name)))
-                        
-                    # update the map with IDs of maps with missing values
-                    var_mv_id = ifthenelse(pcrnot(test_mask) & \
-                        (var_mv_id == 0), nominal(var_cnt), var_mv_id)
-
-                    # print message if the minimum value in the test mask is zero
-                    if cellvalue(mapminimum(scalar(test_mask)), 1)[0] == 0:
-                        print('Warning: missing values were encountered in %d: %s' % \
-                            (var_cnt, variable_name))
-                    #fi
-                #fi
-            #rof
+            if not hasattr(self, 'extent_validator'):
+                self.extent_validator = ExtentValidator( \
+                    pcr2numpy(boolean(self.clone_mask), 0) == 1, \
+                    lambda field: pcr2numpy(defined(field), 0) == 1)
+            #fi
+            if names is None:
+                variables = dict((name, value) for name, value in vars(self).items() \
+                    if type(value) is pcraster.Field)
+            else:
+                variables = dict((name, getattr(self, name)) for name in names)
+            #fi
+            failures = self.extent_validator.validate(variables)
 
-            # if the maximum value of the map with identified IDs is not zero,
-            # then stop with the error
-            if cellvalue(mapmaximum(scalar(var_mv_id)), 1)[0] > 0:
+            # print a message per map with missing values
+            for variable_name, nr_missing, locations in failures:
+                print('Warning: %d missing values were encountered in %s, first at (row, col): %s' % \
+                    (nr_missing, variable_name, \
+                    ', '.join('(%d, %d)' % (row + 1, col + 1) for row, col in locations)))
+            #rof
 
+            # if any map has missing values, then stop with the error
+            if len(failures) > 0:
                 sys.exit('Error: missing values in input, cannot proceed!')
             #fi
         #fi
@@ -469,9 +1174,12 @@ if __name__ == "__main__":
     # the number of timesteps (months) our dynamic model should make.
     nrOfTimeSteps = 12
 
+    # restart from the latest checkpoint, if any, if the run is restarted
+    restart = '--restart' in sys.argv[1:]
+
     # initialize our modeland run it
-    myModel = RUSLE(clone_filename, mapdname, txtdname, outdname, startdate)
-    dynamicModel = DynamicFramework(myModel, nrOfTimeSteps)
+    myModel = RUSLE(clone_filename, mapdname, txtdname, outdname, startdate, restart = restart)
+    dynamicModel = DynamicFramework(myModel, nrOfTimeSteps, firstTimestep = myModel.first_timestep())
     dynamicModel.run()
 
     print('Hurray, Model Is Finished!')
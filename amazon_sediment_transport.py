@@ -16,8 +16,11 @@ import os, sys, datetime, calendar
 import pcraster as pcr
 import pcraster.framework as pcrm
 from time import gmtime, strftime
+import numpy as np
 
 from routing_wb_dev import pcrglobRoutingSediment
+from ldd_topology import LddTopology
+from floodplain_tables import FloodplainTables, channel_lengths, read_relZ
 
 ##################
 # Model settings #
@@ -28,8 +31,29 @@ def set_general_settings(startDate, endDate, currentYear, duration):
         'testLocalWaterBalance': True,\
         'getSurfaceWaterAttributes': True,\
         'outputPath': os.path.join('/scratch/safaa/sediment_transport_amazon_30arcmin_/without_reservoir/', strftime("%Y%m%d", gmtime())),\
+        #-directory of the cached topology of the LDD (LDD_topology.npz) and
+        # floodplain tables; None for the output path
+        'cachePath': None,\
         'duration': duration,\
         'timeSec': 86400,\
+        #-adaptive time stepping of the routing: the switch, the maximum step
+        # in output intervals, the maximum number of halvings of the interval
+        # and the criteria of the Courant number and the relative storage
+        # change, read by AdaptiveStepController.from_settings. The controller
+        # is only used standalone, e.g., by benchmark_kinematic.py; the switch
+        # stays off until the routing of routing_wb_dev uses the controller
+        'adaptiveTimeStepping': False,\
+        'maxTimeStep': 5,\
+        'maxSubdivisions': 6,\
+        'courantCriterion': 10.0,\
+        'storageChangeCriterion': 0.2,\
+        #-domain decomposition of the routing: the outlets of the sub-basins
+        # as (row, col) of the cells that drain into the confluences of the
+        # tributaries, each routed by a worker process; empty for a serial run
+        'subbasinOutlets': [],\
+        #-switch of the storage-depth-area tables of the floodplains, built
+        # by set_floodplainTables; off until routing_wb_dev uses the tables
+        'useFloodplainTables': False,\
         #-area fractions
         'areaFractions': [0.0,0.01,0.05,0.10,0.20,0.30,0.40,\
         0.50,0.60,0.70,0.80,0.90,1.00],\
@@ -111,6 +135,28 @@ def set_initialSettings(mapdir):
     return settings
 #fed
 
+#-floodplain tables
+def set_floodplainTables(generalSettings, mapSettings):
+    # returns the storage-depth-area tables of the floodplains; the tables and
+    # the topology of the LDD are built once and cached in the cache path, by
+    # default the output path, so that they are reused by the next runs
+    cachePath = generalSettings['cachePath']
+    if cachePath is None:
+        cachePath = generalSettings['outputPath']
+    #fi
+    if not os.path.isdir(cachePath):
+        os.makedirs(cachePath)
+    #fi
+    ldd = pcr.pcr2numpy(pcr.readmap(mapSettings['LDD']), 0)
+    topology = LddTopology.cached(ldd, os.path.join(cachePath, 'LDD_topology.npz'))
+    cellArea = topology.gather(pcr.pcr2numpy(pcr.readmap(mapSettings['cellArea']), np.nan))
+    relZ = read_relZ(mapSettings['relZFileName'], generalSettings['areaFractions'], topology.gather)
+    channelLength = channel_lengths(topology.cells.gather(ldd), cellArea)
+    return topology, FloodplainTables.cached(os.path.join(cachePath, 'floodplain_tables.npz'), \
+        relZ, generalSettings['areaFractions'], cellArea, channelLength, \
+        reduction = generalSettings['reductionKK'], criterion = generalSettings['criterionKK'])
+#fed
+
 def main():
     #-where to find stuff
     inputdir= None
@@ -132,6 +178,10 @@ def main():
 
     #-start
     pcr.setclone(cloneMapFileName)
+    if generalSettings['useFloodplainTables']:
+        generalSettings['lddTopology'], generalSettings['floodplainTables'] = \
+            set_floodplainTables(generalSettings, mapSettings)
+    #fi
     routingscheme = pcrglobRoutingSediment(startDate, endDate,\
         generalSettings, mapSettings, waterBodySettings, initialSettings)
     dynRouting = pcrm.DynamicFramework(routingscheme, lastTimeStep = int((endDate.toordinal() - startDate.toordinal()+1)/duration),\
@@ -0,0 +1,95 @@
+'''
+Benchmark of the fused RUSLE kernel on a synthetic grid: the monthly chain is
+computed with 1 to N threads and the time, speed-up and parallel efficiency
+are reported. The output of every run is compared with that of the run with a
+single thread, which it should equal exactly.
+
+Example:
+    python benchmark_kernel.py -r 4320 -c 4320 -w 1 2 4 8 16
+'''
+
+import sys, time
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from rusle_kernel import compute_monthly_sediment, kernel_outputs, parallel_block_rows
+
+def synthetic_data(shape, seed = 1):
+    # returns dictionaries with plausible monthly input and static factors,
+    # with missing values outside a circular basin
+    random = np.random.RandomState(seed)
+    def uniform(low, high):
+        return random.uniform(low, high, shape).astype(np.float32)
+    #fed
+    dynamic_data = {'rain_month': uniform(0, 400), 'tmin': uniform(-5, 20), \
+        'tmax': uniform(20, 35), 'ground_cover_fraction': uniform(0, 1), \
+        'ndvi': uniform(-0.1, 0.9), 'Qsurface': uniform(0, 200)}
+    static_data = {'rain_annual': uniform(500, 3500), 'R_year': uniform(1000, 20000), \
+        'K_year': uniform(0.01, 0.05), 'kfact_seasonal': uniform(1, 2), 'LS': uniform(0, 10), \
+        'P_month': uniform(0.2, 1), 'CellArea': uniform(7.5e7, 8.6e7), \
+        'Manning_n1': uniform(0.01, 0.1), 'Manning_n4': uniform(0.01, 0.4), \
+        'slope_gradient': uniform(0, 0.5), 'slope_length': uniform(100, 2000)}
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    outside = ((rows - shape[0] / 2.0) / shape[0]) ** 2 + ((cols - shape[1] / 2.0) / shape[1]) ** 2 > 0.25
+    for data in list(dynamic_data.values()) + list(static_data.values()):
+        data[outside] = np.nan
+    #rof
+    return dynamic_data, static_data
+#fed
+
+def time_kernel(dynamic_data, static_data, nr_workers, block_rows, repeats):
+    # returns the best time of the kernel with the number of threads and its output
+    shape = np.shape(static_data['LS'])
+    pool = ThreadPool(nr_workers) if nr_workers > 1 else None
+    block_rows = parallel_block_rows(shape[0], nr_workers, block_rows)
+    out = None
+    best_time = None
+    try:
+        for irepeat in range(repeats):
+            start_time = time.time()
+            out = compute_monthly_sediment(dynamic_data, static_data, \
+                block_rows = block_rows, out = out, pool = pool)
+            elapsed = time.time() - start_time
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        #rof
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        #fi
+    #yrt
+    return best_time, out
+#fed
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--rows', type = int, default = 2160, help = "Number of rows")
+    parser.add_argument('-c', '--cols', type = int, default = 2160, help = "Number of columns")
+    parser.add_argument('-w', '--workers', type = int, nargs = '+', default = [1, 2, 4, 8], \
+        help = "Numbers of threads")
+    parser.add_argument('-b', '--block-rows', type = int, default = 256, help = "Maximum rows per block")
+    parser.add_argument('-n', '--repeats', type = int, default = 3, help = "Repeats per number of threads")
+    args = parser.parse_args()
+
+    shape = (args.rows, args.cols)
+    dynamic_data, static_data = synthetic_data(shape)
+    print('Fused kernel on a %d x %d grid, best of %d' % (shape[0], shape[1], args.repeats))
+    print('%8s %10s %10s %10s %14s' % ('threads', 'time [s]', 'speed-up', 'efficiency', 'Mcells/s'))
+    reference_time, reference = time_kernel(dynamic_data, static_data, 1, args.block_rows, args.repeats)
+    for nr_workers in sorted(set([1] + args.workers)):
+        if nr_workers == 1:
+            elapsed, out = reference_time, reference
+        else:
+            elapsed, out = time_kernel(dynamic_data, static_data, nr_workers, args.block_rows, args.repeats)
+        #fi
+        for name in kernel_outputs:
+            if not np.array_equal(out[name], reference[name], equal_nan = True):
+                sys.exit('Error: %s with %d threads differs from the single-threaded result' % \
+                    (name, nr_workers))
+            #fi
+        #rof
+        print('%8d %10.3f %10.2f %9.0f%% %14.1f' % (nr_workers, elapsed, reference_time / elapsed, \
+            100.0 * reference_time / elapsed / nr_workers, shape[0] * shape[1] / elapsed / 1.0e6))
+    #rof
+#fi
@@ -0,0 +1,202 @@
+'''
+Validation and benchmark of the vectorized kinematic-wave solver on a
+synthetic LDD: a random drainage network that drains to a single outlet. The
+discharge is routed for a number of time steps with the solver and with a
+reference that solves the cells one by one, as the routing of PCR-GLOBWB by
+PCRaster kinematic does; if PCRaster is available, pcr.kinematic itself is
+compared as well. The largest relative difference and the time of both are
+reported, followed by the performance report of the solver.
+
+With -a, the adaptive time stepping is compared instead: a year of runoff with
+a seasonal cycle and a flood is routed with daily steps, with the adaptive
+controller and with a reference of 32 time slices per day, and the error of
+the discharge at the outlet with respect to the reference is reported for
+the daily and the adaptive steps.
+
+Example:
+    python benchmark_kinematic.py -r 360 -c 480 -n 10
+    python benchmark_kinematic.py -r 40 -c 50 -n 365 -a
+'''
+
+import sys, time
+from argparse import ArgumentParser
+import numpy as np
+
+from ldd_topology import LddTopology, ldd_offsets
+from kinematic_wave import KinematicWaveSolver, channel_alpha, min_discharge
+from adaptive_stepping import AdaptiveStepController
+
+def synthetic_ldd(shape, seed = 1):
+    # returns a random LDD that drains to a pit at the centre of the bottom row,
+    # grown as a random spanning tree from the outlet
+    random = np.random.RandomState(seed)
+    nr_rows, nr_cols = shape
+    ldd = np.zeros(shape, dtype = np.int8)
+    outlet = (nr_rows - 1, nr_cols // 2)
+    ldd[outlet] = 5
+    # direction from a neighbour back to the cell that it drains to
+    reverse = dict(((-row_offset, -col_offset), direction) \
+        for direction, (row_offset, col_offset) in ldd_offsets.items() if direction != 5)
+    front = [outlet]
+    while len(front) > 0:
+        index = random.randint(len(front))
+        row, col = front[index]
+        neighbours = [(row + row_offset, col + col_offset) for row_offset, col_offset in reverse.keys() \
+            if 0 <= row + row_offset < nr_rows and 0 <= col + col_offset < nr_cols and \
+            ldd[row + row_offset, col + col_offset] == 0]
+        if len(neighbours) == 0:
+            front[index] = front[-1]
+            front.pop()
+            continue
+        #fi
+        neighbour = neighbours[random.randint(len(neighbours))]
+        ldd[neighbour] = reverse[(neighbour[0] - row, neighbour[1] - col)]
+        front.append(neighbour)
+    #elihw
+    return ldd
+#fed
+
+def reference_route(topology, discharge, lateral_inflow, alpha, beta, channel_length, \
+        timestep, tolerance = 1.0e-12, max_iterations = 3000):
+    # the scheme of the solver, cell by cell in topological order
+    new_discharge = np.zeros_like(discharge)
+    inflow = np.zeros_like(discharge)
+    for cell in topology.order:
+        dt_dx = timestep / channel_length[cell]
+        rhs = max(0.0, dt_dx * inflow[cell] + alpha[cell] * discharge[cell] ** beta + \
+            timestep * lateral_inflow[cell])
+        Q = 0.0
+        if rhs > 0:
+            Qbar = max(0.5 * (inflow[cell] + discharge[cell]), min_discharge)
+            slope = alpha[cell] * beta * Qbar ** (beta - 1)
+            Q = max((dt_dx * inflow[cell] + slope * discharge[cell] + timestep * lateral_inflow[cell]) / \
+                (dt_dx + slope), min_discharge)
+            for iteration in range(max_iterations):
+                residual = dt_dx * Q + alpha[cell] * Q ** beta - rhs
+                Qnew = max(Q - residual / (dt_dx + alpha[cell] * beta * Q ** (beta - 1)), min_discharge)
+                converged = abs(Qnew - Q) <= tolerance * Qnew
+                Q = Qnew
+                if converged:
+                    break
+                #fi
+            #rof
+        #fi
+        new_discharge[cell] = Q
+        if topology.downstream_index[cell] >= 0:
+            inflow[topology.downstream_index[cell]] += Q
+        #fi
+    #rof
+    return new_discharge
+#fed
+
+def pcraster_route(ldd, topology, discharge, lateral_inflow, alpha, beta, channel_length, timestep):
+    # the routing with PCRaster kinematic, None if PCRaster is not available
+    try:
+        import pcraster as pcr
+    except ImportError:
+        return None
+    #yrt
+    pcr.setclone(ldd.shape[0], ldd.shape[1], 1.0, 0.0, 0.0)
+    def to_map(values):
+        return pcr.numpy2pcr(pcr.Scalar, topology.cells.scatter(values, fill_value = -999.9), -999.9)
+    #fed
+    result = pcr.kinematic(pcr.numpy2pcr(pcr.Ldd, ldd.astype(np.int32), 0), to_map(discharge), \
+        to_map(lateral_inflow), to_map(alpha), beta, 1, timestep, to_map(channel_length))
+    return topology.cells.gather(pcr.pcr2numpy(result, np.nan))
+#fed
+
+def adaptive_benchmark(topology, alpha, beta, channel_length, nr_days, random):
+    # routes a year of runoff with a seasonal cycle and a flood around day 200
+    # with daily steps, adaptive steps and a reference of 32 slices per day
+    runoff = random.uniform(0.5, 1.5, topology.nr_cells)
+    def lateral_inflow(day):
+        depth = 1.0e-3 * (1 + 0.8 * np.sin(2 * np.pi * day / 365.0)) + \
+            8.0e-3 * np.exp(-((day - 200) / 4.0) ** 2)
+        return depth * runoff / 86400.0 * 5.0e4 * 5.0e4 / channel_length
+    #fed
+    initial_discharge = topology.accuflux(lateral_inflow(0) * channel_length)
+    outlet = topology.downstream_index < 0
+    discharge = {}
+    for name, nr_time_slices in [('daily', 1), ('reference', 32)]:
+        solver = KinematicWaveSolver(topology, alpha, beta, channel_length)
+        Q = initial_discharge
+        discharge[name] = []
+        for day in range(nr_days):
+            Q = solver.route(Q, lateral_inflow(day), 86400.0, nr_time_slices)
+            discharge[name].append(Q[outlet])
+        #rof
+        if name == 'daily':
+            daily_time = solver.solve_time
+        #fi
+    #rof
+    controller = AdaptiveStepController(KinematicWaveSolver(topology, alpha, beta, channel_length))
+    discharge['adaptive'] = [Q[outlet] for day, Q, storage in \
+        controller.run(initial_discharge, lateral_inflow, nr_days)]
+    controller.report(per_interval = False)
+    reference = np.array(discharge['reference'])
+    print('Daily steps: %d steps, %.3f s; adaptive: %d steps, %.3f s' % \
+        (nr_days, daily_time, controller.nr_steps, controller.run_time))
+    for name in ['daily', 'adaptive']:
+        error = np.abs(np.array(discharge[name]) - reference) / reference
+        print('Relative error of the discharge at the outlet, %s steps: mean %.2e, maximum %.2e' % \
+            (name, error.mean(), error.max()))
+    #rof
+#fed
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--rows', type = int, default = 180, help = "Number of rows")
+    parser.add_argument('-c', '--cols', type = int, default = 240, help = "Number of columns")
+    parser.add_argument('-n', '--steps', type = int, default = 5, help = "Number of daily time steps")
+    parser.add_argument('-t', '--tolerance', type = float, default = 1.0e-10, \
+        help = "Relative tolerance of the solver")
+    parser.add_argument('-a', '--adaptive', action = 'store_true', \
+        help = "Compare the adaptive time stepping with daily steps")
+    args = parser.parse_args()
+
+    ldd = synthetic_ldd((args.rows, args.cols))
+    topology = LddTopology(ldd)
+    topology.report()
+    random = np.random.RandomState(2)
+    nr_cells = topology.nr_cells
+    beta = 0.6
+    channel_length = random.uniform(4.0e4, 7.0e4, nr_cells)
+    alpha = channel_alpha(0.04, random.uniform(10, 200, nr_cells), random.uniform(1.0e-5, 1.0e-3, nr_cells), beta)
+    if args.adaptive:
+        adaptive_benchmark(topology, alpha, beta, channel_length, args.steps, random)
+        sys.exit(0)
+    #fi
+    solver = KinematicWaveSolver(topology, alpha, beta, channel_length, tolerance = args.tolerance)
+    timestep = 86400.0
+    discharge = topology.accuflux(random.uniform(0, 2, nr_cells))
+    reference = discharge.copy()
+    reference_time = 0.0
+    max_difference = 0.0
+    max_pcraster_difference = None
+    for step in range(args.steps):
+        # runoff of a few mm per day spread over the channel length
+        lateral_inflow = random.uniform(0, 5.0e-3, nr_cells) / timestep * 5.0e4 * 5.0e4 / channel_length
+        start_time = time.time()
+        expected = reference_route(topology, reference, lateral_inflow, alpha, beta, channel_length, timestep)
+        reference_time += time.time() - start_time
+        pcraster_result = pcraster_route(ldd, topology, reference, lateral_inflow, alpha, beta, \
+            channel_length, timestep)
+        if pcraster_result is not None:
+            difference = np.max(np.abs(pcraster_result - expected) / np.maximum(expected, 1.0e-6))
+            max_pcraster_difference = max(max_pcraster_difference or 0.0, difference)
+        #fi
+        discharge = solver.route(discharge, lateral_inflow, timestep)
+        reference = expected
+        max_difference = max(max_difference, np.max(np.abs(discharge - expected) / np.maximum(expected, 1.0e-6)))
+    #rof
+    print('Reference (cell by cell): %.3f s; solver: %.3f s; speed-up %.1f' % \
+        (reference_time, solver.solve_time, reference_time / max(solver.solve_time, 1.0e-9)))
+    print('Largest relative difference with the reference: %.2e' % max_difference)
+    if max_pcraster_difference is not None:
+        print('Largest relative difference of pcr.kinematic with the reference: %.2e' % max_pcraster_difference)
+    #fi
+    solver.report()
+    if max_difference > 1.0e3 * args.tolerance:
+        sys.exit('Error: the solver differs from the reference by more than the tolerance allows')
+    #fi
+#fi
@@ -0,0 +1,110 @@
+'''
+Benchmark of the prefetching of the monthly input: the fused RUSLE kernel is
+run over a number of time steps of synthetic maps, reading the maps of every
+time step synchronously and with the reader thread of input_prefetch, and the
+time of the run, the time spent waiting for the input and the speed-up are
+reported. The maps are PCRaster maps read with readmap if PCRaster is
+installed, as in the model, and .npy files otherwise. The reading only
+overlaps with the kernel as far as the reader releases the GIL.
+
+Example:
+    python benchmark_prefetch.py -r 2160 -c 2160 -n 12
+'''
+
+import os, sys, time, shutil, tempfile
+from argparse import ArgumentParser
+import numpy as np
+try:
+    import pcraster as pcr
+except ImportError:
+    pcr = None
+#yrt
+
+from benchmark_kernel import synthetic_data
+from input_prefetch import InputPrefetcher
+from rusle_kernel import compute_monthly_sediment
+
+class MapReader(object):
+    '''
+MapReader: writes the synthetic monthly input of every time step to a
+directory and reads it back per time step, as RUSLE.read_input_dynamic.
+'''
+    def __init__(self, dynamic_data, nr_steps, directory):
+        self.names = sorted(dynamic_data.keys())
+        self.directory = directory
+        shape = np.shape(dynamic_data[self.names[0]])
+        if pcr is not None:
+            pcr.setclone(shape[0], shape[1], 1.0, 0.0, 0.0)
+        #fi
+        for step in range(1, nr_steps + 1):
+            for name in self.names:
+                data = dynamic_data[name] * (1 + 0.01 * step)
+                if pcr is not None:
+                    pcr.report(pcr.numpy2pcr(pcr.Scalar, data, np.nan), self.pathname(name, step))
+                else:
+                    np.save(self.pathname(name, step), data)
+                #fi
+            #rof
+        #rof
+    #fed
+
+    def pathname(self, name, step):
+        return os.path.join(self.directory, '%s_%04d.%s' % (name, step, 'map' if pcr is not None else 'npy'))
+    #fed
+
+    def __call__(self, step):
+        if pcr is not None:
+            return dict((name, pcr.pcr2numpy(pcr.readmap(self.pathname(name, step)), np.nan)) \
+                for name in self.names)
+        #fi
+        return dict((name, np.load(self.pathname(name, step))) for name in self.names)
+    #fed
+#ssalc
+
+def time_run(reader, static_data, nr_steps, mode):
+    # returns the time of the run and the time spent waiting for the input
+    start_time = time.time()
+    prefetcher = InputPrefetcher(reader, 1, nr_steps) if mode == 'thread' else None
+    wait_time = 0.0
+    out = None
+    try:
+        for step in range(1, nr_steps + 1):
+            start_wait = time.time()
+            dynamic_data = reader(step) if prefetcher is None else prefetcher.get(step)
+            wait_time += time.time() - start_wait
+            out = compute_monthly_sediment(dynamic_data, static_data, out = out)
+        #rof
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        #fi
+    #yrt
+    return time.time() - start_time, wait_time
+#fed
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--rows', type = int, default = 1080, help = "Number of rows")
+    parser.add_argument('-c', '--cols', type = int, default = 1080, help = "Number of columns")
+    parser.add_argument('-n', '--steps', type = int, default = 12, help = "Number of monthly time steps")
+    args = parser.parse_args()
+
+    dynamic_data, static_data = synthetic_data((args.rows, args.cols))
+    directory = tempfile.mkdtemp(prefix = 'prefetch_')
+    try:
+        reader = MapReader(dynamic_data, args.steps, directory)
+        print('Monthly input of %d x %d cells read as %s over %d time steps' % \
+            (args.rows, args.cols, 'PCRaster maps' if pcr is not None else '.npy files', args.steps))
+        print('%10s %10s %10s %10s' % ('prefetch', 'time [s]', 'wait [s]', 'speed-up'))
+        reference_time = None
+        for mode in ['none', 'thread']:
+            elapsed, wait_time = time_run(reader, static_data, args.steps, mode)
+            if reference_time is None:
+                reference_time = elapsed
+            #fi
+            print('%10s %10.2f %10.2f %10.2f' % (mode, elapsed, wait_time, reference_time / elapsed))
+        #rof
+    finally:
+        shutil.rmtree(directory)
+    #yrt
+#fi
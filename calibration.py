@@ -0,0 +1,456 @@
+'''
+Calibration of the coefficient alpha and the exponent beta of the delivery
+ratio (compute_delivery_ratio) against the sediment fluxes observed at the
+stations, as computed by extract_observations_for_stations.py.
+
+Everything upstream of the delivery ratio does not depend on alpha and beta:
+per month, the soil loss and the term
+    x = HydroCoeff * sqrt(slope in %) / (Manning * slope length),
+of which the delivery ratio is alpha * x ** beta, limited to [0, 1]. These are
+computed once with the factor functions of the model, for the cells upstream
+of the stations only, and cached on disk with ln(x) instead of x. A trial
+then only computes SoilLoss * min(1, alpha * exp(beta * ln(x))) for the cached
+cells and sums it per station with a matrix product with the upstream cells,
+so that it takes milliseconds instead of a model run and the extraction of the
+NetCDF output. An optimiser of scipy drives the trials.
+
+The flux of a station is the sum of the sediment transport (SedTrans) of its
+upstream cells, i.e., the sediment that reaches the streams, without the
+routing and deposition of the transport model. The ids of the stations map
+must be the station ids (id_station) of the observations.
+
+Example:
+    python calibration.py -s 1990-01 -e 1999-12 -l stations.map \\
+        -f sediment_flux_new_stations_updated.csv -o /scratch/calibration
+'''
+
+import os, sys, csv, json, time, hashlib, datetime
+from argparse import ArgumentParser
+import numpy as np
+from scipy import optimize
+
+import amazon_factors
+from amazon_factors import mv
+from active_cells import ActiveCells
+from static_cache import file_digest, source_pathname
+
+# outputs of the factor graph that are cached
+cached_factors = ['SoilLoss', 'HydroCff', 'Manning']
+
+def station_catchments(ldd, stations):
+    '''
+station_catchments: returns the ids of the stations and, per station, the mask
+of the cells upstream of the station, including the cell of the station.
+
+    Input:
+    ======
+    ldd:                    PCRaster field of the local drain direction;
+    stations:               PCRaster field with the nominal id of the station
+                            at its cell, zero or missing elsewhere.
+
+    Output:
+    =======
+    station_ids:            list of the station ids;
+    masks:                  boolean array (stations x rows x cols).
+
+'''
+    from pcraster import boolean, catchment, pcr2numpy
+    station_map = pcr2numpy(stations, 0).astype(np.int64)
+    station_ids = sorted(int(station_id) for station_id in np.unique(station_map) if station_id > 0)
+    masks = np.zeros((len(station_ids),) + station_map.shape, dtype = bool)
+    for istation, station_id in enumerate(station_ids):
+        masks[istation] = pcr2numpy(catchment(ldd, boolean(stations == station_id)), 0) == 1
+    #rof
+    return station_ids, masks
+#fed
+
+def read_observations(pathname, station_ids, dates):
+    '''
+read_observations: returns the observed monthly sediment flux per station and
+month in tonnes per month, NaN if there is no observation. The file is the
+output of extract_observations_for_stations.py, with the flux (sed_flux) in
+kg per month; the flux of a month is the mean over the records of the month.
+
+    Input:
+    ======
+    pathname:               semicolon-separated file with the columns
+                            id_station, year, month and sed_flux;
+    station_ids:            ids of the stations;
+    dates:                  dates of the months.
+
+    Output:
+    =======
+    observations:           array (stations x months).
+
+'''
+    if not os.path.isfile(pathname):
+        sys.exit('Error: observations file %s does not exist' % pathname)
+    #fi
+    station_index = dict((station_id, istation) for istation, station_id in enumerate(station_ids))
+    month_index = dict(((date.year, date.month), imonth) for imonth, date in enumerate(dates))
+    totals = np.zeros((len(station_ids), len(dates)))
+    counts = np.zeros((len(station_ids), len(dates)))
+    with open(pathname, 'r') as csvfile:
+        for row in csv.DictReader(csvfile, delimiter = ';'):
+            try:
+                station_id = int(row['id_station'])
+                key = (int(row['year']), int(row['month']))
+                flux = float(row['sed_flux'])
+            except (KeyError, ValueError):
+                continue
+            #yrt
+            if station_id in station_index and key in month_index and np.isfinite(flux):
+                totals[station_index[station_id], month_index[key]] += 1.0e-3 * flux
+                counts[station_index[station_id], month_index[key]] += 1
+            #fi
+        #rof
+    #htiw
+    with np.errstate(invalid = 'ignore'):
+        return np.where(counts > 0, totals / np.maximum(1, counts), np.nan)
+    #htiw
+#fed
+
+def calibration_cache_key(settings, input_files, code_files):
+    '''
+calibration_cache_key: returns the key of the calibration cache, a hash of the
+settings that define the cached months and cells, e.g., the period, the input
+directories and the naming scheme, and of the contents of the input files,
+e.g., the stations map, and of the code files.
+
+    Input:
+    ======
+    settings:               dictionary with the settings as strings;
+    input_files,
+    code_files:             lists of files of which the contents are hashed.
+
+    Output:
+    =======
+    key:                    hexadecimal key of the cache.
+
+'''
+    sha = hashlib.sha1()
+    sha.update(json.dumps(settings, sort_keys = True).encode('utf-8'))
+    for pathname in list(input_files) + [source_pathname(fn) for fn in code_files]:
+        if not os.path.isfile(pathname):
+            sys.exit('Error: %s cannot be hashed for the calibration cache' % pathname)
+        #fi
+        sha.update(file_digest(pathname).encode('ascii'))
+    #rof
+    return sha.hexdigest()
+#fed
+
+class CalibrationCache(object):
+    '''
+CalibrationCache: the parts of the sediment transport that do not depend on
+alpha and beta, for the cells upstream of the stations.
+
+    Input:
+    ======
+    soil_loss:              array (months x cells) of the soil loss, zero for
+                            missing values;
+    log_term:               array (months x cells) of ln(x), -inf for missing
+                            values and x = 0;
+    membership:             array (stations x cells) that is one for the
+                            cells upstream of a station;
+    station_ids:            ids of the stations;
+    dates:                  dates of the months.
+
+'''
+    def __init__(self, soil_loss, log_term, membership, station_ids, dates):
+        self.soil_loss = soil_loss
+        self.log_term = log_term
+        # a dense matrix: nested stations share most of their upstream cells
+        self.membership = np.asarray(membership, dtype = np.float32)
+        self.station_ids = list(station_ids)
+        self.dates = list(dates)
+        self.scratch = None
+    #fed
+
+    @property
+    def nr_cells(self):
+        return self.soil_loss.shape[1]
+    #fed
+
+    def save(self, pathname):
+        np.savez(pathname, soil_loss = self.soil_loss, log_term = self.log_term, \
+            membership = self.membership > 0, station_ids = np.array(self.station_ids), \
+            dates = np.array([date.strftime('%Y-%m') for date in self.dates]))
+    #fed
+
+    @classmethod
+    def load(cls, pathname):
+        data = np.load(pathname)
+        dates = [datetime.datetime.strptime(str(date), '%Y-%m') for date in data['dates']]
+        return cls(data['soil_loss'], data['log_term'], data['membership'], \
+            [int(station_id) for station_id in data['station_ids']], dates)
+    #fed
+
+    def select_months(self, months):
+        # restrict the cache to the months, e.g., the months with observations
+        self.soil_loss = np.ascontiguousarray(self.soil_loss[months])
+        self.log_term = np.ascontiguousarray(self.log_term[months])
+        self.dates = [self.dates[imonth] for imonth in np.flatnonzero(months)]
+        self.scratch = None
+    #fed
+
+    def station_fluxes(self, alpha, beta):
+        '''
+station_fluxes: returns the sediment flux per station and month [tonnes per
+month] for the delivery-ratio parameters, as an array (stations x months).
+'''
+        if self.scratch is None:
+            self.scratch = np.empty_like(self.log_term)
+        #fi
+        # alpha * x ** beta = exp(beta * ln(x) + ln(alpha)), which is positive
+        delivery_ratio = self.scratch
+        np.multiply(self.log_term, beta, out = delivery_ratio)
+        delivery_ratio += np.log(alpha)
+        np.exp(delivery_ratio, out = delivery_ratio)
+        np.minimum(delivery_ratio, 1, out = delivery_ratio)
+        delivery_ratio *= self.soil_loss
+        return self.membership.dot(delivery_ratio.T)
+    #fed
+#ssalc
+
+def build_cache(model, stations_pathname, nrOfTimeSteps):
+    '''
+build_cache: computes the calibration cache with the factor functions of the
+model, with the numpy backend, for the cells upstream of the stations.
+
+    Input:
+    ======
+    model:                  RUSLE instance of which the configuration sets the
+                            input, the dates and the naming of the maps;
+    stations_pathname:      map with the ids of the stations;
+    nrOfTimeSteps:          number of months from the start date of the model.
+
+    Output:
+    =======
+    cache:                  the CalibrationCache.
+
+'''
+    from pcraster import readmap, pcr2numpy, nominal
+    model.config_model()
+    if not model.load_static_cache():
+        model.load_input_initial()
+        model.setup_model()
+        model.store_static_cache()
+    #fi
+    if not os.path.isfile(stations_pathname):
+        sys.exit('Error: stations map %s does not exist' % stations_pathname)
+    #fi
+    station_ids, masks = station_catchments(model.rd_map('LDD'), nominal(readmap(stations_pathname)))
+    if len(station_ids) == 0:
+        sys.exit('Error: there are no stations in %s' % stations_pathname)
+    #fi
+    cells = ActiveCells(masks.any(axis = 0))
+    print('Calibration: %d station(s) with %d upstream cells' % (len(station_ids), cells.nr_cells))
+    membership = masks.reshape(len(station_ids), -1)[:, cells.indices]
+    static_data = cells.gather_dict(model.static_state_arrays())
+
+    graph = model.build_factor_graph()
+    model.dynamic_input_names = graph.required_inputs(cached_factors)
+    soil_loss = np.empty((nrOfTimeSteps, cells.nr_cells), dtype = np.float32)
+    log_term = np.empty((nrOfTimeSteps, cells.nr_cells), dtype = np.float32)
+    dates = []
+    current_year = None
+    backend = amazon_factors.get_backend()
+    amazon_factors.set_backend('numpy')
+    try:
+        slope_term = amazon_factors.delivery_ratio_prefactor(static_data['slope_gradient'], \
+            static_data['slope_length'])
+        for timestep in range(1, nrOfTimeSteps + 1):
+            date = model.date_of_timestep(timestep)
+            if date.year != current_year:
+                # the annual factors of the year, as RUSLE.update_annual_factors
+                current_year = date.year
+                mapname = model.input_naming.annual('rain_annual', 'Pan_90', current_year)
+                if mapname is not None:
+                    pathname = os.path.join(model.mapdir, mapname)
+                    if not os.path.isfile(pathname):
+                        sys.exit("Error: map %s in %s does not exist" % (mapname, model.mapdir))
+                    #fi
+                    rain_annual = cells.gather(pcr2numpy(readmap(pathname), mv))
+                    R_year = amazon_factors.compute_annual_erosivity( \
+                        (1.0 - static_data['interception_fraction']) * rain_annual)
+                    static_data['rain_annual'] = rain_annual
+                    static_data['R_year'] = np.where(np.isnan(R_year), mv, R_year)
+                    graph.invalidate(['rain_annual', 'R_year'])
+                #fi
+            #fi
+            monthly_data = cells.gather_dict(model.read_input_dynamic(timestep))
+            values = graph.evaluate(cached_factors, timestep, \
+                lambda name: monthly_data[name] if name in monthly_data else static_data[name])
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                term = values['HydroCff'] * slope_term / values['Manning']
+                missing = ~(np.isfinite(term) & np.isfinite(values['SoilLoss']))
+                log_term[timestep - 1] = np.where(missing | (term <= 0), -np.inf, np.log(term))
+            #htiw
+            soil_loss[timestep - 1] = np.where(missing, 0.0, values['SoilLoss'])
+            dates.append(date)
+            print('Cached month %d of %d (%s)' % (timestep, nrOfTimeSteps, date.strftime('%Y-%m')))
+        #rof
+    finally:
+        amazon_factors.set_backend(backend)
+    #yrt
+    return CalibrationCache(soil_loss, log_term, membership, station_ids, dates)
+#fed
+
+class Calibrator(object):
+    '''
+Calibrator: fits alpha and beta to the observations at the stations; the
+objective is the mean over the stations of the mean squared difference of
+the logarithms of the modelled and observed monthly fluxes, so that every
+station weighs equally, whatever its size.
+
+    Input:
+    ======
+    cache:                  the CalibrationCache;
+    observations:           observed fluxes (stations x months) in tonnes per
+                            month, NaN if there is no observation;
+    offset:                 flux in tonnes per month that is added to the
+                            modelled and observed fluxes before the logarithm.
+
+'''
+    def __init__(self, cache, observations, offset = 1.0):
+        observed = np.isfinite(observations)
+        stations = observed.any(axis = 1)
+        if not stations.any():
+            sys.exit('Error: there are no observations for the stations in the period of the cache')
+        #fi
+        # only the months with observations are evaluated
+        months = observed.any(axis = 0)
+        cache.select_months(months)
+        self.cache = cache
+        self.observed = observed[:, months]
+        self.log_observations = np.log(np.where(self.observed, observations[:, months], 0) + offset)
+        self.offset = offset
+        self.nr_observations = self.observed.sum(axis = 1)
+        self.station_weights = np.where(self.nr_observations > 0, \
+            1.0 / np.maximum(1, self.nr_observations), 0) / stations.sum()
+        self.nr_trials = 0
+        self.trial_time = 0.0
+    #fed
+
+    def objective(self, alpha, beta):
+        start_time = time.time()
+        fluxes = self.cache.station_fluxes(alpha, beta)
+        residuals = np.where(self.observed, np.log(fluxes + self.offset) - self.log_observations, 0)
+        value = float(np.dot(self.station_weights, (residuals ** 2).sum(axis = 1)))
+        self.nr_trials += 1
+        self.trial_time += time.time() - start_time
+        return value
+    #fed
+
+    def calibrate(self, alpha = 9.53, beta = 0.79, method = 'Nelder-Mead', tolerance = 1.0e-4):
+        '''
+calibrate: returns the calibrated alpha and beta and the value of the
+objective, starting from the given values; the optimiser works on ln(alpha)
+and beta, so that alpha stays positive.
+'''
+        result = optimize.minimize(lambda x: self.objective(np.exp(x[0]), x[1]), \
+            [np.log(alpha), beta], method = method, \
+            options = {'xatol': tolerance, 'fatol': tolerance} if method == 'Nelder-Mead' else {})
+        if not result.success:
+            print('Warning: the optimiser did not converge: %s' % result.message)
+        #fi
+        return float(np.exp(result.x[0])), float(result.x[1]), float(result.fun)
+    #fed
+
+    def report(self, alpha, beta, pathname = None):
+        # print and, optionally, write the mean observed and modelled fluxes per station
+        fluxes = self.cache.station_fluxes(alpha, beta)
+        print('Calibration: %d trials, %.2f ms per trial' % \
+            (self.nr_trials, 1000.0 * self.trial_time / max(1, self.nr_trials)))
+        print('\t%12s %8s %16s %16s %8s' % ('station', 'months', 'observed [t/m]', 'modelled [t/m]', 'ratio'))
+        rows = []
+        for istation, station_id in enumerate(self.cache.station_ids):
+            if self.nr_observations[istation] == 0:
+                continue
+            #fi
+            observed = np.exp(self.log_observations[istation][self.observed[istation]]).mean() - self.offset
+            modelled = fluxes[istation][self.observed[istation]].mean()
+            ratio = modelled / observed if observed > 0 else np.nan
+            print('\t%12d %8d %16.1f %16.1f %8.2f' % (station_id, self.nr_observations[istation], \
+                observed, modelled, ratio))
+            rows.append([station_id, self.nr_observations[istation], observed, modelled, ratio])
+        #rof
+        if pathname is not None:
+            with open(pathname, 'w') as csvfile:
+                writer = csv.writer(csvfile, delimiter = ';')
+                writer.writerow(['id_station', 'months', 'observed', 'modelled', 'ratio'])
+                writer.writerows(rows)
+            #htiw
+        #fi
+    #fed
+#ssalc
+
+if __name__ == "__main__":
+    from amazon_sediment_production import RUSLE
+    from production_driver import parse_month, months_between
+    from input_naming import TimestepNaming, DatedNaming
+
+    workdir = os.getcwd()
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--start', default = '1990-01', help = "First month of the calibration period, YYYY-MM")
+    parser.add_argument('-e', '--end', default = '1999-12', help = "Last month of the calibration period, YYYY-MM")
+    parser.add_argument('-n', '--naming', choices = ['timestep', 'dated'], default = 'dated', \
+        help = "Naming scheme of the input maps: by time step of the run or by date")
+    parser.add_argument('-m', '--mapdir', default = os.path.join(workdir, 'amazon_fine'), \
+        help = "Directory with the input maps")
+    parser.add_argument('-t', '--txtdir', default = os.path.join(workdir, 'txtdata'), \
+        help = "Directory with the text tables")
+    parser.add_argument('-c', '--clone', default = os.path.join(workdir, 'mapinput', 'amazon_5min_mask.map'), \
+        help = "Clone map")
+    parser.add_argument('-l', '--stations', required = True, help = "Map with the ids of the stations")
+    parser.add_argument('-f', '--observations', required = True, \
+        help = "Observed sediment fluxes, as written by extract_observations_for_stations.py")
+    parser.add_argument('-a', '--alpha', type = float, default = 9.53, help = "Initial alpha")
+    parser.add_argument('-b', '--beta', type = float, default = 0.79, help = "Initial beta")
+    parser.add_argument('-r', '--rebuild', action = "store_true", default = False, \
+        help = "Rebuild the cache of the upstream factors")
+    parser.add_argument('-o', '--outputdir', required = True, help = "Output directory name")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.outputdir):
+        try:
+            os.makedirs(args.outputdir)
+        except OSError:
+            sys.exit("Error: creation of the directory %s failed" % args.outputdir)
+        #yrt
+    #fi
+    startdate = parse_month(args.start)
+    nrOfTimeSteps = months_between(startdate, parse_month(args.end))
+    if nrOfTimeSteps < 1:
+        sys.exit('Error: the end date %s lies before the start date %s' % (args.end, args.start))
+    #fi
+    # the cache is keyed on the period, the stations and the input, so that a
+    # cache of other stations or input is not re-used
+    for pathname in [args.clone, args.stations]:
+        if not os.path.isfile(pathname):
+            sys.exit('Error: %s is not a file.' % pathname)
+        #fi
+    #rof
+    cache_key = calibration_cache_key({'start': args.start, 'end': args.end, \
+        'naming': args.naming, 'mapdir': os.path.abspath(args.mapdir), \
+        'txtdir': os.path.abspath(args.txtdir)}, [args.stations, args.clone], \
+        [amazon_factors.__file__, __file__])
+    cache_pathname = os.path.join(args.outputdir, 'calibration_cache_%s_%s_%s.npz' % \
+        (args.start, args.end, cache_key[:16]))
+    if os.path.isfile(cache_pathname) and not args.rebuild:
+        print('Reading the calibration cache %s' % cache_pathname)
+        cache = CalibrationCache.load(cache_pathname)
+    else:
+        naming = DatedNaming() if args.naming == 'dated' else TimestepNaming()
+        model = RUSLE(args.clone, args.mapdir, args.txtdir, args.outputdir, startdate, \
+            input_naming = naming)
+        cache = build_cache(model, args.stations, nrOfTimeSteps)
+        cache.save(cache_pathname)
+    #fi
+
+    calibrator = Calibrator(cache, read_observations(args.observations, cache.station_ids, cache.dates))
+    print('Objective with the initial parameters: %.4f' % calibrator.objective(args.alpha, args.beta))
+    alpha, beta, value = calibrator.calibrate(args.alpha, args.beta)
+    print('Calibrated parameters: alpha = %.4f, beta = %.4f, objective = %.4f' % (alpha, beta, value))
+    calibrator.report(alpha, beta, os.path.join(args.outputdir, 'calibration_stations.csv'))
+#fi
@@ -0,0 +1,167 @@
+"""
+checkpoint: checkpoints of a run of the Amazon Sediment Production Model, from
+which the run can be restarted. The static factors do not change during a run
+and are saved once as .npy files that are memory-mapped on a restart; every
+checkpoint itself is a small JSON file with the time step, the date and the
+positions of the output along the time dimension. State that changes during
+the run and that is too large for JSON, such as the totals of an ensemble, is
+saved with the checkpoint as an .npz file. The static state and every
+checkpoint record the key of the static input (see static_cache), so that a
+restart with other input or code is refused.
+
+"""
+
+# modules
+import os, sys, glob, json, shutil
+import numpy as np
+
+# names of the directory with the static state and of the checkpoint files
+_static_dirname = 'static'
+_checkpoint_pattern = 'checkpoint_%06d.json'
+_arrays_pattern = 'checkpoint_%06d.npz'
+
+def clear_checkpoints(checkpoint_dir):
+    # removes the static state and all checkpoints, e.g., those of an earlier
+    # run in the same output directory at the start of a new run
+    if os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+    #fi
+#fed
+
+def static_state_saved(checkpoint_dir, names, key = None):
+    # returns True if all static arrays have been saved for the static key
+    manifest_name = os.path.join(checkpoint_dir, _static_dirname, 'manifest.json')
+    if not os.path.isfile(manifest_name):
+        return False
+    #fi
+    with open(manifest_name, 'rt') as f:
+        manifest = json.load(f)
+    #htiw
+    return set(names) <= set(manifest['names']) and manifest.get('key') == key
+#fed
+
+def save_static_state(checkpoint_dir, arrays, key = None):
+    '''
+save_static_state: saves the static arrays of the run; this is done once, before
+the first checkpoint.
+
+    Input:
+    ======
+    checkpoint_dir:         directory with the checkpoints;
+    arrays:                 dictionary with the static arrays by name;
+    key:                    key of the static input from which the arrays
+                            were computed.
+
+'''
+    staticdir = os.path.join(checkpoint_dir, _static_dirname)
+    if not os.path.isdir(staticdir):
+        os.makedirs(staticdir)
+    #fi
+    for name, data in arrays.items():
+        np.save(os.path.join(staticdir, name + '.npy'), np.asarray(data))
+    #rof
+    # the manifest is written last, so that it only exists for a complete state
+    _write_json(os.path.join(staticdir, 'manifest.json'), \
+        {'names': sorted(arrays.keys()), 'key': key})
+#fed
+
+def load_static_state(checkpoint_dir, names, key = None):
+    # returns the static arrays as read-only memory-mapped arrays
+    if not static_state_saved(checkpoint_dir, names, key):
+        sys.exit('Error: the static state in %s is incomplete or belongs to other input, cannot restart' % \
+            checkpoint_dir)
+    #fi
+    staticdir = os.path.join(checkpoint_dir, _static_dirname)
+    return dict((name, np.load(os.path.join(staticdir, name + '.npy'), mmap_mode = 'r')) \
+        for name in names)
+#fed
+
+def save_checkpoint(checkpoint_dir, timestep, state, keep = 2, arrays = None):
+    '''
+save_checkpoint: writes the checkpoint of the time step and removes all but the
+last keep checkpoints.
+
+    Input:
+    ======
+    checkpoint_dir:         directory with the checkpoints;
+    timestep:               the last completed time step;
+    state:                  dictionary with the state of the run that can be
+                            written as JSON, e.g., the date, the output positions
+                            and the key of the static input;
+    keep:                   number of checkpoints that are kept;
+    arrays:                 optional dictionary with arrays by name that
+                            change during the run, e.g., running totals.
+
+'''
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    #fi
+    state = dict(state)
+    state['timestep'] = timestep
+    state['arrays'] = []
+    if arrays:
+        # the arrays are written before the JSON file, so that a checkpoint
+        # only exists with its arrays
+        filename = os.path.join(checkpoint_dir, _arrays_pattern % timestep)
+        tmpname = filename + '.tmp.npz'
+        np.savez(tmpname, **dict((name, np.asarray(data)) for name, data in arrays.items()))
+        if os.path.isfile(filename):
+            os.remove(filename)
+        #fi
+        os.rename(tmpname, filename)
+        state['arrays'] = sorted(arrays.keys())
+    #fi
+    _write_json(os.path.join(checkpoint_dir, _checkpoint_pattern % timestep), state)
+    for filename in checkpoint_files(checkpoint_dir)[:-max(1, keep)]:
+        os.remove(filename)
+        if os.path.isfile(os.path.splitext(filename)[0] + '.npz'):
+            os.remove(os.path.splitext(filename)[0] + '.npz')
+        #fi
+    #rof
+#fed
+
+def load_checkpoint_arrays(checkpoint_dir, state):
+    # returns the arrays saved with the checkpoint of the state, an empty
+    # dictionary for a checkpoint without arrays
+    if not state.get('arrays'):
+        return {}
+    #fi
+    filename = os.path.join(checkpoint_dir, _arrays_pattern % state['timestep'])
+    if not os.path.isfile(filename):
+        sys.exit('Error: the arrays of checkpoint %d are missing in %s, cannot restart' % \
+            (state['timestep'], checkpoint_dir))
+    #fi
+    with np.load(filename) as data:
+        return dict((name, data[name]) for name in state['arrays'])
+    #htiw
+#fed
+
+def checkpoint_files(checkpoint_dir):
+    # returns the checkpoint files in the order of their time step
+    return sorted(glob.glob(os.path.join(checkpoint_dir, _checkpoint_pattern.split('%')[0] + '*.json')))
+#fed
+
+def latest_checkpoint(checkpoint_dir):
+    # returns the state of the latest checkpoint or None if there is none
+    filenames = checkpoint_files(checkpoint_dir)
+    if len(filenames) == 0:
+        return None
+    #fi
+    with open(filenames[-1], 'rt') as f:
+        return json.load(f)
+    #htiw
+#fed
+
+def _write_json(filename, content):
+    # write via a temporary file, so that an interrupted write leaves no partial file
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wt') as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    #htiw
+    if os.path.isfile(filename):
+        os.remove(filename)
+    #fi
+    os.rename(tmpname, filename)
+#fed
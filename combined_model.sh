@@ -13,6 +13,8 @@ python mapprocessing/increase_resolution_to_5arcmin.py
 
 # Running the Amazon Sediment Production Model
 python amazon_sediment
+# or, for runs over several years with the input maps resolved by date:
+# python production_driver.py -s 1990-01 -e 1999-12 -n dated -o <output directory>
 
 # Use output of the Amazon Sediment Production Model as input to the Amazon sediment transport model to 
 # estimate the sediment transport in the Amazon river.
@@ -0,0 +1,163 @@
+"""
+diagnostics: gated channel for the intermediate results of the factor
+functions in amazon_factors. Functions emit named intermediates to the tap,
+which is off by default so that production runs do no diagnostic I/O at all.
+When the tap is switched on, it can be limited to specific time steps and
+either writes the full grids to a sink (a directory or a callable) or records
+summary statistics (minimum, maximum, mean and the number of missing cells).
+
+"""
+
+# modules
+import os, sys, csv, contextlib
+import numpy as np
+try:
+    import pcraster as pcr
+except ImportError:
+    pcr = None
+#yrt
+
+# state of the tap: switched off by default
+_settings = {\
+    'enabled': False,\
+    'timesteps': None,\
+    'sink': None,\
+    'mode': 'grid'}
+_current_timestep = None
+_summaries = []
+
+def configure(enabled = True, timesteps = None, sink = None, mode = 'grid'):
+    '''
+configure: function that switches the diagnostics tap on or off and sets how
+the emitted intermediates are processed.
+
+    Input:
+    ======
+    enabled:                switch of the tap;
+    timesteps:              optional collection of time steps for which the
+                            intermediates are processed, all if None;
+    sink:                   directory to which the full grids are written or a
+                            callable that is called with the name, time step
+                            and value of every intermediate; required for the
+                            mode 'grid';
+    mode:                   'grid' to write the full grids or 'summary' to
+                            record summary statistics only.
+
+'''
+    if mode not in ['grid', 'summary']:
+        sys.exit('Error: unknown mode %s for the diagnostics' % mode)
+    #fi
+    if enabled and mode == 'grid' and sink is None:
+        sys.exit('Error: the diagnostics need a sink to write the grids to')
+    #fi
+    if isinstance(sink, str) and not os.path.isdir(sink):
+        os.makedirs(sink)
+    #fi
+    _settings['enabled'] = enabled
+    _settings['timesteps'] = None if timesteps is None else set(timesteps)
+    _settings['sink'] = sink
+    _settings['mode'] = mode
+#fed
+
+def set_timestep(timestep):
+    # set the time step to which the emitted intermediates belong
+    global _current_timestep
+    _current_timestep = timestep
+#fed
+
+def is_active():
+    # returns True if the intermediates of the current time step are processed
+    if not _settings['enabled']:
+        return False
+    #fi
+    return _settings['timesteps'] is None or \
+        _current_timestep in _settings['timesteps']
+#fed
+
+@contextlib.contextmanager
+def suppressed():
+    # context in which the tap is off, e.g., while the chain is evaluated for
+    # the members of an ensemble, of which the intermediates are not wanted
+    enabled = _settings['enabled']
+    _settings['enabled'] = False
+    try:
+        yield
+    finally:
+        _settings['enabled'] = enabled
+    #yrt
+#fed
+
+def emit(name, value):
+    '''
+emit: function that passes a named intermediate to the tap; this does nothing
+unless the tap is on and the current time step is selected.
+
+    Input:
+    ======
+    name:                   name of the intermediate;
+    value:                  PCRaster field, array or float.
+
+'''
+    if not is_active():
+        return
+    #fi
+    if _settings['mode'] == 'summary':
+        _summaries.append(summarise(name, value))
+    elif callable(_settings['sink']):
+        _settings['sink'](name, _current_timestep, value)
+    else:
+        write_grid(name, value)
+    #fi
+#fed
+
+def _as_array(value):
+    # return the value as an array with NaN for missing values
+    if pcr is not None and isinstance(value, pcr.Field):
+        return pcr.pcr2numpy(value, np.nan)
+    #fi
+    return np.ma.filled(np.ma.asarray(value, dtype = np.float64), np.nan)
+#fed
+
+def summarise(name, value):
+    # return the summary statistics of the intermediate as a dictionary
+    data = _as_array(value)
+    valid = data[~np.isnan(data)]
+    summary = {'name': name, 'timestep': _current_timestep, \
+        'nan_count': int(data.size - valid.size)}
+    if valid.size > 0:
+        summary.update({'min': float(valid.min()), 'max': float(valid.max()), \
+            'mean': float(valid.mean())})
+    else:
+        summary.update({'min': np.nan, 'max': np.nan, 'mean': np.nan})
+    #fi
+    return summary
+#fed
+
+def write_grid(name, value):
+    # write the intermediate to the sink directory, as a PCRaster map for
+    # fields and as a .npy file otherwise
+    pathname = os.path.join(_settings['sink'], \
+        '%s_%04d' % (name, _current_timestep if _current_timestep is not None else 0))
+    if pcr is not None and isinstance(value, pcr.Field):
+        pcr.report(value, pathname + '.map')
+    else:
+        np.save(pathname + '.npy', _as_array(value))
+    #fi
+#fed
+
+def summaries():
+    # returns the summary statistics recorded so far
+    return list(_summaries)
+#fed
+
+def write_summaries(filename):
+    # write the summary statistics recorded so far to a csv file
+    fieldnames = ['timestep', 'name', 'min', 'max', 'mean', 'nan_count']
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames = fieldnames)
+        writer.writeheader()
+        for summary in _summaries:
+            writer.writerow(summary)
+        #rof
+    #htiw
+#fed
@@ -0,0 +1,289 @@
+"""
+ensemble: Monte Carlo ensemble of the monthly RUSLE chain of the Amazon
+Sediment Production Model for uncertainty runs. The uncertain parameters are
+sampled once per member; the factor functions of amazon_factors (with the
+numpy backend) broadcast over a leading member dimension, so that a single
+pass evaluates all members, sharing the monthly input and the static factors.
+Only summary statistics over the members, i.e., the mean and quantiles, are
+returned per month and for the totals over the run, rather than the grids of
+all members.
+
+All arrays are 1-D arrays over the active cells (see active_cells) with NaN as
+missing value; the members are processed in blocks of cells to bound the
+memory.
+
+"""
+
+# modules
+from collections import OrderedDict
+import numpy as np
+
+import amazon_factors, diagnostics
+from amazon_factors import mv
+from landcover_stack import compute_conservation_factor_stack, \
+    compute_interception_fraction_stack
+
+# nominal values of the scalar parameters
+nominal_parameters = OrderedDict([('alpha', 9.53), ('beta', 0.79), ('Mn2', 0.049)])
+# nominal seasonality ratios of the soil erodibility of fine, medium and coarse soils
+nominal_seasonality_ratios = (1.17, 1.44, 4.50)
+# default relative standard deviation of the parameters and of the values of
+# the land cover tables; the parameters are varied by a log-normal factor
+default_spread = {'alpha': 0.1, 'beta': 0.1, 'Mn2': 0.2, 'seasonality_ratios': 0.1, \
+    'P_factor_info': 0.2, 'part_interception_info': 0.2}
+# monthly outputs that can be summarised
+ensemble_outputs = ['R_month', 'K_month', 'C_month', 'SoilLoss', 'Manning', \
+    'DelRatio', 'SedTrans']
+
+def sample_parameters(nr_members, tables, spread = None, seed = 1):
+    '''
+sample_parameters: returns the parameters of all members; member 0 has the
+nominal values.
+
+    Input:
+    ======
+    nr_members:             number of members;
+    tables:                 dictionary with the land cover tables by name,
+                            P_factor_info and part_interception_info;
+    spread:                 dictionary with the relative standard deviation
+                            per parameter or table, default_spread by default;
+    seed:                   seed of the random numbers.
+
+    Output:
+    =======
+    parameters:             dictionary with an array (members) per scalar
+                            parameter, an array (members x 3) of the
+                            seasonality ratios and, per table, a dictionary
+                            with an array (members) per land cover class.
+
+'''
+    if spread is None:
+        spread = default_spread
+    #fi
+    random = np.random.RandomState(seed)
+    def factors(shape, name):
+        factor = np.exp(spread.get(name, 0.0) * random.standard_normal((nr_members,) + shape))
+        factor[0] = 1.0
+        return factor
+    #fed
+    parameters = {}
+    for name, value in nominal_parameters.items():
+        parameters[name] = value * factors((), name)
+    #rof
+    parameters['seasonality_ratios'] = np.array(nominal_seasonality_ratios) * \
+        factors((len(nominal_seasonality_ratios),), 'seasonality_ratios')
+    for name in ['P_factor_info', 'part_interception_info']:
+        keys = sorted(tables[name].keys())
+        table_factors = factors((len(keys),), name)
+        parameters[name] = dict((key, tables[name][key] * table_factors[:, ikey]) \
+            for ikey, key in enumerate(keys))
+    #rof
+    return parameters
+#fed
+
+class MonteCarloEnsemble(object):
+    '''
+MonteCarloEnsemble: evaluates the monthly chain for all members.
+
+    Input:
+    ======
+    parameters:             parameters of the members, see sample_parameters;
+    quantiles:              quantiles over the members that are returned
+                            besides the mean;
+    outputs:                names of the monthly outputs that are summarised;
+    cell_block:             number of cells per block.
+
+'''
+    def __init__(self, parameters, quantiles = (0.05, 0.5, 0.95), \
+            outputs = ('SoilLoss', 'SedTrans'), cell_block = 4096):
+        self.parameters = parameters
+        self.nr_members = len(parameters['alpha'])
+        self.quantiles = list(quantiles)
+        self.outputs = list(outputs)
+        for name in self.outputs:
+            if name not in ensemble_outputs:
+                raise ValueError('%s is not an output of the ensemble' % name)
+            #fi
+        #rof
+        self.cell_block = max(1, cell_block)
+        self.statistics = ['mean'] + ['q%03d' % int(round(100 * quantile)) for quantile in self.quantiles]
+        self.totals = None
+    #fed
+
+    def _member(self, name):
+        # parameter as a column that broadcasts over the cells
+        return self.parameters[name][:, np.newaxis]
+    #fed
+
+    def setup_static(self, static_data, cover_stack, selected_slope):
+        '''
+setup_static: computes the static factors that differ per member, as arrays
+(members x cells) in single precision.
+
+    Input:
+    ======
+    static_data:            dictionary with the static factors of the model
+                            over the active cells, including rain_annual;
+    cover_stack:            CoverFractionStack of the active cells;
+    selected_slope:         slope of the croplands over the active cells.
+
+'''
+        self.static_data = static_data
+        self.interception_fraction = compute_interception_fraction_stack(cover_stack, \
+            self.parameters['part_interception_info']).astype(np.float32)
+        self.P_month = compute_conservation_factor_stack(cover_stack, \
+            self.parameters['P_factor_info'], selected_slope).astype(np.float32)
+        # the seasonality class of every cell follows from the nominal ratio
+        kfact_seasonal = static_data['kfact_seasonal']
+        seasonality_class = np.argmin(np.abs(kfact_seasonal[np.newaxis, :] - \
+            np.array(nominal_seasonality_ratios)[:, np.newaxis]), axis = 0)
+        self.kfact_seasonal = self.parameters['seasonality_ratios'][:, seasonality_class].astype(np.float32)
+        self.kfact_seasonal[:, np.isnan(kfact_seasonal)] = np.nan
+        self.set_rain_annual(static_data['rain_annual'])
+    #fed
+
+    def set_rain_annual(self, rain_annual):
+        # computes the annual erosivity per member, e.g., when the annual rainfall changes
+        self.rain_annual = rain_annual
+        self.R_year = np.empty_like(self.interception_fraction)
+        for cells in self.cell_blocks():
+            R_year = self._evaluate_numpy(amazon_factors.compute_annual_erosivity, \
+                (1.0 - self.interception_fraction[:, cells]) * rain_annual[cells])
+            self.R_year[:, cells] = np.where(np.isnan(R_year), mv, R_year)
+        #rof
+    #fed
+
+    def cell_blocks(self):
+        nr_cells = self.interception_fraction.shape[1]
+        return [slice(start, min(start + self.cell_block, nr_cells)) \
+            for start in range(0, nr_cells, self.cell_block)]
+    #fed
+
+    def _evaluate_numpy(self, function, *args, **kwargs):
+        # evaluate a factor function with the numpy backend
+        backend = amazon_factors.get_backend()
+        amazon_factors.set_backend('numpy')
+        try:
+            with diagnostics.suppressed():
+                return function(*args, **kwargs)
+            #htiw
+        finally:
+            amazon_factors.set_backend(backend)
+        #yrt
+    #fed
+
+    def evaluate(self, monthly_data):
+        '''
+evaluate: evaluates the monthly chain for all members and returns the
+statistics of the outputs.
+
+    Input:
+    ======
+    monthly_data:           dictionary with the monthly input over the active
+                            cells (rain_month, tmin, tmax,
+                            ground_cover_fraction, ndvi, Qsurface).
+
+    Output:
+    =======
+    statistics:             dictionary with, per output, a dictionary with an
+                            array over the active cells per statistic.
+
+'''
+        nr_cells = self.interception_fraction.shape[1]
+        statistics = dict((name, dict((statistic, np.empty(nr_cells, dtype = np.float32)) \
+            for statistic in self.statistics)) for name in self.outputs)
+        if self.totals is None:
+            self.totals = dict((name, np.zeros((self.nr_members, nr_cells))) for name in self.outputs)
+        #fi
+        # the intermediates of the factor functions are members x cells
+        # arrays, which are not passed to the diagnostics
+        backend = amazon_factors.get_backend()
+        amazon_factors.set_backend('numpy')
+        try:
+            with diagnostics.suppressed():
+                for cells in self.cell_blocks():
+                    values = self._evaluate_block(monthly_data, cells)
+                    for name in self.outputs:
+                        self.totals[name][:, cells] += values[name]
+                        self._summarise(values[name], statistics[name], cells)
+                    #rof
+                #rof
+            #htiw
+        finally:
+            amazon_factors.set_backend(backend)
+        #yrt
+        return statistics
+    #fed
+
+    def _evaluate_block(self, monthly_data, cells):
+        # the monthly chain for a block of cells; arrays are members x cells
+        static = dict((name, value[cells]) for name, value in self.static_data.items())
+        monthly = dict((name, value[cells]) for name, value in monthly_data.items())
+        values = {}
+        values['R_month'] = amazon_factors.partition_erosivity(monthly['rain_month'], \
+            self.rain_annual[cells], self.R_year[:, cells])
+        melt_time_fraction = amazon_factors.compute_melt_time_fraction(monthly['tmin'], monthly['tmax'])
+        values['K_month'] = amazon_factors.compute_kfact_monthly(static['K_year'], \
+            self.kfact_seasonal[:, cells], melt_time_fraction)
+        values['C_month'] = amazon_factors.compute_vegcover_factor2(monthly['ground_cover_fraction'], \
+            values['R_month'], self.R_year[:, cells])
+        values['SoilLoss'] = amazon_factors.compute_soil_loss(values['R_month'], values['K_month'], \
+            static['LS'], values['C_month'], self.P_month[:, cells], static['CellArea'])
+        values['Manning'] = amazon_factors.compute_Manning(static['Manning_n1'], static['Manning_n4'], \
+            monthly['ndvi'], Mn2 = self._member('Mn2'))
+        HydroCff = amazon_factors.compute_hydro_coeff(monthly['Qsurface'], monthly['rain_month'])
+        values['DelRatio'] = amazon_factors.compute_delivery_ratio(HydroCff, static['slope_gradient'], \
+            values['Manning'], static['slope_length'], alpha = self._member('alpha'), \
+            beta = self._member('beta'))
+        values['SedTrans'] = amazon_factors.compute_erosion(values['SoilLoss'], values['DelRatio'])
+        # outputs that do not depend on a member parameter are broadcast
+        return dict((name, np.broadcast_to(values[name], (self.nr_members, cells.stop - cells.start))) \
+            for name in self.outputs)
+    #fed
+
+    def _summarise(self, values, statistics, cells):
+        # mean and quantiles over the members; cells that are missing for any
+        # member are missing
+        with np.errstate(invalid = 'ignore'):
+            statistics['mean'][cells] = values.mean(axis = 0)
+            quantile_values = np.percentile(values, [100 * quantile for quantile in self.quantiles], axis = 0)
+        #htiw
+        for statistic, quantile_value in zip(self.statistics[1:], quantile_values):
+            statistics[statistic][cells] = quantile_value
+        #rof
+    #fed
+
+    def totals_state(self):
+        # the totals over the months so far as arrays by name, for a checkpoint
+        if self.totals is None:
+            return {}
+        #fi
+        return dict(('ensemble_total_%s' % name, self.totals[name]) for name in self.outputs)
+    #fed
+
+    def restore_totals(self, arrays):
+        # restores the totals from a checkpoint; returns False if they are missing
+        names = ['ensemble_total_%s' % name for name in self.outputs]
+        if not all(name in arrays for name in names):
+            return False
+        #fi
+        self.totals = dict((name, np.array(arrays['ensemble_total_%s' % name], dtype = np.float64)) \
+            for name in self.outputs)
+        return True
+    #fed
+
+    def total_statistics(self):
+        # statistics over the members of the totals over all months so far
+        nr_cells = self.interception_fraction.shape[1]
+        statistics = dict((name, dict((statistic, np.empty(nr_cells, dtype = np.float32)) \
+            for statistic in self.statistics)) for name in self.outputs)
+        if self.totals is not None:
+            for name in self.outputs:
+                for cells in self.cell_blocks():
+                    self._summarise(self.totals[name][:, cells], statistics[name], cells)
+                #rof
+            #rof
+        #fi
+        return statistics
+    #fed
+#ssalc
@@ -0,0 +1,73 @@
+"""
+extent_check: incremental test of the extent of the data of the Amazon
+Sediment Production Model. Variables are only validated if they changed since
+the last check, i.e., if the attribute refers to another object than before;
+the test itself is a single comparison of the mask of defined cells with the
+clone mask. Failures are reported per variable with the number of missing
+cells and the locations of the first of these.
+
+"""
+
+# modules
+import numpy as np
+
+class ExtentValidator(object):
+    '''
+ExtentValidator: keeps track of the validated variables and tests the changed
+ones for missing values within the clone mask.
+
+    Input:
+    ======
+    clone_mask:             boolean array that is True for the cells of the
+                            clone;
+    defined_function:       function that returns, for a variable, a boolean
+                            array that is True where the variable is defined;
+    max_locations:          maximum number of locations reported per variable.
+
+'''
+    def __init__(self, clone_mask, defined_function, max_locations = 10):
+        self.clone_mask = np.asarray(clone_mask, dtype = bool)
+        self.defined_function = defined_function
+        self.max_locations = max_locations
+        # the objects that were validated last, per variable name
+        self.validated = {}
+        self.nr_validated = 0
+    #fed
+
+    def changed(self, variables):
+        # returns the names of the variables that changed since the last check
+        return [name for name, value in variables.items() \
+            if self.validated.get(name) is not value]
+    #fed
+
+    def validate(self, variables):
+        '''
+validate: tests the changed variables for missing values within the clone.
+
+    Input:
+    ======
+    variables:              dictionary with the variables by name.
+
+    Output:
+    =======
+    failures:               list of tuples with the name of the variable, the
+                            number of missing cells and an array with the
+                            (row, col) locations of the first missing cells.
+
+'''
+        failures = []
+        for name in sorted(self.changed(variables)):
+            value = variables[name]
+            missing = self.clone_mask & \
+                ~np.asarray(self.defined_function(value), dtype = bool)
+            nr_missing = int(np.count_nonzero(missing))
+            if nr_missing > 0:
+                failures.append((name, nr_missing, \
+                    np.argwhere(missing)[:self.max_locations]))
+            #fi
+            self.validated[name] = value
+            self.nr_validated += 1
+        #rof
+        return failures
+    #fed
+#ssalc
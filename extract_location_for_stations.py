@@ -15,9 +15,11 @@ from spatialDataSet2PCR import spatialAttributes, spatialDataSet, setClone
 from ncRecipes_fixed import getNCDates
 from read_temporal_info_to_pcr import create_date_list, getTimedPCRData
 from zonalStatistics import zonal_statistics_pcr
+from ldd_topology import LddTopology
 
 parser = ArgumentParser()
 parser.add_argument('-o', '--outputdir', help="Output directory name")
+parser.add_argument('-c', '--cachedir', help="Directory of the cached topology of the LDD, LDD_topology.npz; default the output directory")
 parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False, help="Verbose output")
 parser.add_argument('filenames',nargs='+')
 args = parser.parse_args()
@@ -43,6 +45,10 @@ if args.outputdir:
 else:
     outputdir = os.getcwd()
 #fi
+cachedir = args.cachedir if args.cachedir else outputdir
+if not os.path.isdir(cachedir):
+    sys.exit("Error: the cache directory %s does not exist" % cachedir)
+#fi
 
 mapdir = '/home/naffa002/projects/finalmodel/mapinput/halfdegree_maps'
 ldd_filename = os.path.join(mapdir,'LDD.map')
@@ -83,8 +89,11 @@ pcr.setclone(ldd_filename)
 ldd = pcr.readmap(ldd_filename)
 cellarea = 1.0e-6 * pcr.readmap(cellarea_filename)
 
-# get the upstream area
-upstream_area = pcr.accuflux(ldd, cellarea)
+# get the upstream area; the topology of the LDD is parsed once and saved in
+# the cache directory for the next runs, as by amazon_sediment_transport.py
+ldd_topology = LddTopology.cached(pcr.pcr2numpy(ldd, 0), os.path.join(cachedir, 'LDD_topology.npz'))
+upstream_area = ldd_topology.accuflux(pcr.pcr2numpy(cellarea, np.nan))
+upstream_area = pcr.numpy2pcr(pcr.Scalar, np.where(np.isnan(upstream_area), -999.9, upstream_area), -999.9)
 
 # compute the latitudes and longitudes
 latitudes = pcr.ycoordinate(pcr.boolean(1)) 
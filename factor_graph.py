@@ -0,0 +1,182 @@
+"""
+factor_graph: the factor chain of the Amazon Sediment Production Model as a
+declared dependency graph. Every node names the nodes it depends on and whether
+it is static or varies per time step (monthly); nodes without a function are
+inputs, of which the value is provided by the model. Only the nodes that are
+needed for the requested outputs are evaluated; their values are memoized per
+time step and, for static nodes, until they are invalidated, e.g., when the
+annual factors change. The time spent per node is recorded, so that the
+profile shows the computations that remain per time step.
+
+"""
+
+# modules
+import time
+from collections import OrderedDict
+
+# kinds of nodes
+node_kinds = ['static', 'monthly']
+
+class FactorNode(object):
+    '''
+FactorNode: node of the factor graph.
+
+    Input:
+    ======
+    name:                   name of the node;
+    function:               function that computes the value of the node from
+                            the values of its inputs, None for an input node;
+    inputs:                 names of the nodes that are passed to the function,
+                            in order;
+    kind:                   'static' or 'monthly'.
+
+'''
+    def __init__(self, name, function, inputs, kind):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.kind = kind
+    #fed
+#ssalc
+
+class FactorGraph(object):
+    '''
+FactorGraph: dependency graph of the factors; nodes are added in an order in
+which every node follows its inputs.
+'''
+    def __init__(self):
+        self.nodes = OrderedDict()
+        self.values = {}
+        self.timestep = None
+        self.evaluations = {}
+        self.times = {}
+        self.nr_timesteps = 0
+    #fed
+
+    def add(self, name, function = None, inputs = (), kind = 'monthly'):
+        # adds a node; static nodes can only depend on static nodes
+        if kind not in node_kinds:
+            raise ValueError('unknown kind %s of node %s' % (kind, name))
+        #fi
+        if name in self.nodes:
+            raise ValueError('node %s is defined twice' % name)
+        #fi
+        for input_name in inputs:
+            if input_name not in self.nodes:
+                raise ValueError('input %s of node %s is not defined' % (input_name, name))
+            #fi
+            if kind == 'static' and self.nodes[input_name].kind != 'static':
+                raise ValueError('static node %s depends on monthly node %s' % (name, input_name))
+            #fi
+        #rof
+        self.nodes[name] = FactorNode(name, function, inputs, kind)
+    #fed
+
+    def required(self, outputs):
+        '''
+required: returns the names of all nodes needed for the outputs, in the order
+of the graph.
+'''
+        needed = set()
+        pending = list(outputs)
+        while len(pending) > 0:
+            name = pending.pop()
+            if name not in self.nodes:
+                raise KeyError('no node %s in the factor graph' % name)
+            #fi
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.nodes[name].inputs)
+            #fi
+        #elihw
+        return [name for name in self.nodes.keys() if name in needed]
+    #fed
+
+    def required_inputs(self, outputs, kind = 'monthly'):
+        # returns the names of the input nodes of the kind needed for the outputs
+        return [name for name in self.required(outputs) \
+            if self.nodes[name].function is None and self.nodes[name].kind == kind]
+    #fed
+
+    def required_static(self, outputs):
+        # returns the names of the computed static nodes needed for the outputs
+        return [name for name in self.required(outputs) \
+            if self.nodes[name].function is not None and self.nodes[name].kind == 'static']
+    #fed
+
+    def invalidate(self, names):
+        # removes the memoized values of the nodes and of all nodes that depend on them
+        invalid = set(names)
+        for name, node in self.nodes.items():
+            if name in invalid or len(invalid.intersection(node.inputs)) > 0:
+                invalid.add(name)
+                self.values.pop(name, None)
+            #fi
+        #rof
+    #fed
+
+    def evaluate(self, outputs, timestep, resolve):
+        '''
+evaluate: returns the values of the outputs for the time step.
+
+    Input:
+    ======
+    outputs:                names of the nodes to evaluate;
+    timestep:               time step; the memoized values of the monthly
+                            nodes of another time step are discarded; None
+                            to evaluate static nodes only;
+    resolve:                function that returns the value of an input node
+                            by its name.
+
+    Output:
+    =======
+    values:                 dictionary with the value per output.
+
+'''
+        if timestep != self.timestep:
+            self.timestep = timestep
+            self.nr_timesteps += 1
+            for name, node in self.nodes.items():
+                if node.kind == 'monthly':
+                    self.values.pop(name, None)
+                #fi
+            #rof
+        #fi
+        return OrderedDict((name, self._evaluate(name, resolve)) for name in outputs)
+    #fed
+
+    def _evaluate(self, name, resolve):
+        if name in self.values:
+            return self.values[name]
+        #fi
+        node = self.nodes[name]
+        if node.function is None:
+            # inputs are resolved every time, static inputs may be updated by the model
+            return resolve(name)
+        #fi
+        args = [self._evaluate(input_name, resolve) for input_name in node.inputs]
+        start_time = time.time()
+        value = node.function(*args)
+        self.times[name] = self.times.get(name, 0.0) + time.time() - start_time
+        self.evaluations[name] = self.evaluations.get(name, 0) + 1
+        self.values[name] = value
+        return value
+    #fed
+
+    def report(self):
+        # print the profile: how often every node was computed and the time it took
+        print('Factor graph profile:')
+        print('\t%-22s %-8s %6s %10s %12s' % ('node', 'kind', 'count', 'total [s]', 'per call [s]'))
+        total_times = dict((kind, 0.0) for kind in node_kinds)
+        for name, node in self.nodes.items():
+            if name in self.evaluations:
+                print('\t%-22s %-8s %6d %10.3f %12.4f' % (name, node.kind, self.evaluations[name], \
+                    self.times[name], self.times[name] / self.evaluations[name]))
+                total_times[node.kind] += self.times[name]
+            #fi
+        #rof
+        print('\tstatic: %.3f s in total; monthly: %.3f s in total, %.3f s per time step' % \
+            (total_times['static'], total_times['monthly'], \
+            total_times['monthly'] / max(1, self.nr_timesteps)))
+    #fed
+#ssalc
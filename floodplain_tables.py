@@ -0,0 +1,369 @@
+"""
+floodplain_tables: precomputed storage-depth-area tables of the floodplains of
+the Amazon Sediment Transport Model. The flood volume, i.e., the water storage
+in excess of the channel storage, is distributed over the floodplain with the
+smooth transitions of Kavetski and Kuczera (2007) between the area fractions
+of which the relative elevation above the floodplain is given by the dzRel
+maps, as in the routing of PCR-GLOBWB. The flooded fraction follows from the
+area fraction of which the flood volume is nearest to the actual volume, with
+its slopes and smoothing interval. This relation is fixed per cell, so that
+the volumes halfway between the area fractions and the parameters of the
+nearest area fraction are tabulated once per cell; a time step then finds the
+nearest area fraction by comparison with the halfway volumes, vectorized over
+the cells, instead of testing every area fraction, and evaluates the
+transition for it only, which gives the same fraction as evaluating the
+relation directly. The flood depth and the wetted perimeter of the floodplain
+are derived from the fraction, so that the flood volume is kept exactly.
+
+All arrays are 1-D arrays over the cells (see active_cells), or arrays
+(area fractions x cells), in double precision.
+
+"""
+
+# modules
+import os, sys, hashlib
+import numpy as np
+
+def kk_parameters(relZ, area_fractions, cell_area, reduction):
+    '''
+kk_parameters: returns the flood volumes at the area fractions and the slopes
+and smoothing intervals of the transitions, as in PCR-GLOBWB.
+
+    Input:
+    ======
+    relZ:                   array (area fractions x cells) with the relative
+                            elevation above the floodplain [m] at which each
+                            area fraction is flooded, zero for the first;
+    area_fractions:         the area fractions, increasing from 0 to 1;
+    cell_area:              cell area [m2];
+    reduction:              reduction parameter of the smoothing interval
+                            (reductionKK).
+
+    Output:
+    =======
+    flood_volume, k_slope, m_interval: arrays (area fractions x cells).
+
+'''
+    nr_fractions = len(area_fractions)
+    flood_volume = np.zeros((nr_fractions,) + np.shape(cell_area))
+    k_slope = np.zeros_like(flood_volume)
+    m_interval = np.zeros_like(flood_volume)
+    for ifraction in range(1, nr_fractions):
+        flood_volume[ifraction] = flood_volume[ifraction - 1] + \
+            0.5 * (area_fractions[ifraction] + area_fractions[ifraction - 1]) * \
+            (relZ[ifraction] - relZ[ifraction - 1]) * cell_area
+        k_slope[ifraction - 1] = (area_fractions[ifraction] - area_fractions[ifraction - 1]) / \
+            np.maximum(0.001, flood_volume[ifraction] - flood_volume[ifraction - 1])
+    #rof
+    for ifraction in range(1, nr_fractions):
+        if ifraction < nr_fractions - 1:
+            m_interval[ifraction] = 0.5 * reduction * np.minimum( \
+                flood_volume[ifraction + 1] - flood_volume[ifraction], \
+                flood_volume[ifraction] - flood_volume[ifraction - 1])
+        else:
+            m_interval[ifraction] = 0.5 * reduction * (flood_volume[ifraction] - flood_volume[ifraction - 1])
+        #fi
+    #rof
+    return flood_volume, k_slope, m_interval
+#fed
+
+def flooded_fraction(volume, flood_volume, k_slope, m_interval, area_fractions, cell_area, criterion):
+    '''
+flooded_fraction: returns the flooded fraction and the flood depth [m] for the
+flood volume [m3], with the smoothing of Kavetski and Kuczera (2007) around
+the nearest area fraction, as returnFloodedFraction of PCR-GLOBWB; see
+kk_parameters for the other input and criterion is criterionKK.
+'''
+    nr_fractions = len(area_fractions)
+    # find the nearest area fraction, with its slopes and smoothing interval
+    delta_min = flood_volume[nr_fractions - 1].copy()
+    y_i = np.ones_like(volume)
+    k_lower = np.zeros_like(volume)
+    k_upper = np.zeros_like(volume)
+    m_int = np.zeros_like(volume)
+    for ifraction in range(nr_fractions - 1, 0, -1):
+        delta = volume - flood_volume[ifraction]
+        nearer = np.abs(delta) < np.abs(delta_min)
+        delta_min = np.where(nearer, delta, delta_min)
+        y_i = np.where(nearer, area_fractions[ifraction], y_i)
+        k_lower = np.where(nearer, k_slope[ifraction - 1], k_lower)
+        k_upper = np.where(nearer, k_slope[ifraction], k_upper)
+        m_int = np.where(nearer, m_interval[ifraction], m_int)
+    #rof
+    fraction = np.where(volume > 0, \
+        kk_transition(delta_min, y_i, k_lower, k_upper, m_int, criterion), 0)
+    return fraction, flood_depth(volume, fraction, cell_area)
+#fed
+
+def kk_transition(delta, y_i, k_lower, k_upper, m_int, criterion):
+    # the flooded fraction at the distance delta [m3] from the volume of the
+    # nearest area fraction y_i: the integrals of the logistic functions of
+    # the scaled distance within the criterion and linear beyond it
+    delta_scaled = np.where(delta < 0, -1.0, 1.0) * np.minimum(criterion, np.abs(delta / np.maximum(1, m_int)))
+    log_int = np.log(np.exp(-delta_scaled) + 1)
+    smooth = np.abs(delta_scaled) < criterion
+    fraction = np.where(smooth, \
+        y_i - k_lower * m_int * log_int + k_upper * m_int * (delta_scaled + log_int), \
+        y_i + np.where(delta < 0, k_lower, k_upper) * delta)
+    return np.clip(fraction, 0, 1)
+#fed
+
+def flood_depth(volume, fraction, cell_area):
+    # flood depth [m] of the flooded fraction; missing if the fraction is
+    # missing and zero if the cell is not flooded
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(fraction > 0, volume / (fraction * cell_area), np.where(np.isnan(fraction), np.nan, 0))
+    #htiw
+#fed
+
+def floodplain_perimeter(fraction, depth, cell_area, channel_length):
+    # wetted perimeter [m] of the floodplain: the flooded width, i.e., the
+    # flooded area per unit channel length, and its two sides
+    return np.where(fraction > 0, fraction * cell_area / channel_length + 2 * depth, \
+        np.where(np.isnan(fraction), np.nan, 0))
+#fed
+
+def channel_lengths(ldd, cell_area):
+    # length [m] of the channel per cell from the LDD directions: the side of
+    # the cell, times the square root of two for diagonal directions
+    ldd = np.asarray(ldd)
+    diagonal = (ldd == 1) | (ldd == 3) | (ldd == 7) | (ldd == 9)
+    return np.sqrt(cell_area) * np.where(diagonal, np.sqrt(2.0), 1.0)
+#fed
+
+def read_relZ(relZ_filename, area_fractions, gather):
+    '''
+read_relZ: reads the relative elevations of the area fractions, except the
+first, from the maps named by relZ_filename % (100 * fraction), e.g.,
+dzRel0005.map, and returns them as an array (area fractions x cells).
+
+    Input:
+    ======
+    relZ_filename:          root of the file names (relZFileName);
+    area_fractions:         the area fractions;
+    gather:                 function that returns the values of the cells from
+                            a 2-D array, e.g., LddTopology.gather.
+
+'''
+    from pcraster import readmap, pcr2numpy
+    relZ = None
+    for ifraction in range(1, len(area_fractions)):
+        pathname = relZ_filename % int(round(100 * area_fractions[ifraction]))
+        if not os.path.isfile(pathname):
+            sys.exit('Error: map %s does not exist' % pathname)
+        #fi
+        values = gather(pcr2numpy(readmap(pathname), np.nan))
+        if relZ is None:
+            relZ = np.zeros((len(area_fractions),) + values.shape)
+        #fi
+        relZ[ifraction] = values
+    #rof
+    return relZ
+#fed
+
+# parameters of the nearest area fraction in the tables: its flood volume,
+# the area fraction, the slopes below and above it and its smoothing interval
+table_fields = ['flood_volume', 'area_fraction', 'k_lower', 'k_upper', 'm_interval']
+
+class FloodplainTables(object):
+    '''
+FloodplainTables: per cell tables of the volumes halfway between the area
+fractions and of the parameters of the nearest area fraction, from which the
+flooded fraction follows as a function of the flood volume; the flood depth
+and the wetted perimeter follow from the fraction, so that the flood volume
+equals the flooded area times the depth.
+
+    Input:
+    ======
+    relZ:                   array (area fractions x cells) with the relative
+                            elevations, see kk_parameters, increasing with the
+                            area fraction as the dzRel maps;
+    area_fractions:         the area fractions (areaFractions);
+    cell_area:              cell area [m2];
+    channel_length:         channel length [m];
+    reduction:              reductionKK;
+    criterion:              criterionKK.
+
+'''
+    def __init__(self, relZ = None, area_fractions = None, cell_area = None, channel_length = None, \
+            reduction = 0.5, criterion = 40.0):
+        if relZ is None:
+            return
+        #fi
+        self.digest = table_digest(relZ, area_fractions, cell_area, channel_length, reduction, criterion)
+        self.area_fractions = np.asarray(area_fractions, dtype = np.float64)
+        self.cell_area = np.asarray(cell_area, dtype = np.float64)
+        self.channel_length = np.asarray(channel_length, dtype = np.float64)
+        self.reduction = reduction
+        self.criterion = criterion
+        self.build(np.asarray(relZ, dtype = np.float64))
+    #fed
+
+    def build(self, relZ):
+        '''
+build: computes the tables. The nearest area fraction changes halfway between
+the volumes of two successive area fractions; at the halfway volume and if
+area fractions have the same volume, the higher area fraction is the nearest,
+as in flooded_fraction. The area fraction at zero volume is never the
+nearest. If the nearest area fraction is not nearer than the volume of the
+last area fraction, from about twice that volume on, flooded_fraction falls
+back to the whole cell. Cells with a missing relative elevation are missing.
+'''
+        self.parameters = kk_parameters(relZ, self.area_fractions, self.cell_area, self.reduction)
+        flood_volume, k_slope, m_interval = self.parameters
+        nr_fractions = len(self.area_fractions)
+        # the volumes halfway between the successive area fractions (cells x
+        # area fractions - 2) from which the higher one is nearer: the volume
+        # is at least as near to it as to the next lower area fraction with a
+        # smaller volume, if any; the halfway volumes are corrected for the
+        # rounding, so that the same area fraction is chosen as in
+        # flooded_fraction, also exactly halfway
+        below = flood_volume[1:-1].copy()
+        below[0] = np.where(flood_volume[1] == flood_volume[2], -np.inf, below[0])
+        for ifraction in range(1, nr_fractions - 2):
+            below[ifraction] = np.where(flood_volume[ifraction + 1] == flood_volume[ifraction + 2], \
+                below[ifraction - 1], below[ifraction])
+        #rof
+        above = flood_volume[2:]
+        higher = lambda volume: np.abs(volume - above) <= np.abs(volume - below)
+        halfway = 0.5 * (below + above)
+        finite = np.isfinite(halfway)
+        with np.errstate(invalid = 'ignore'):
+            for iteration in range(4):
+                halfway = np.where(finite & ~higher(halfway), np.nextafter(halfway, np.inf), halfway)
+                lower = np.nextafter(halfway, -np.inf)
+                halfway = np.where(finite & higher(lower), lower, halfway)
+            #rof
+        #htiw
+        self.halfway = np.ascontiguousarray(halfway.T)
+        self.last = flood_volume[-1]
+        self.missing = np.any(np.isnan(flood_volume), axis = 0)
+        # the nearest area fraction after each number of decisions for the
+        # higher one: the highest of the area fractions with the same volume
+        nearest = np.empty((nr_fractions - 1,) + flood_volume.shape[1:], dtype = np.intp)
+        nearest[-1] = nr_fractions - 1
+        for ifraction in range(nr_fractions - 2, 0, -1):
+            nearest[ifraction - 1] = np.where(flood_volume[ifraction] == flood_volume[ifraction + 1], \
+                nearest[ifraction], ifraction)
+        #rof
+        cells = np.arange(flood_volume.shape[1])
+        values = [flood_volume[nearest, cells], self.area_fractions[nearest], \
+            k_slope[nearest - 1, cells], k_slope[nearest, cells], m_interval[nearest, cells]]
+        # tables (cells x area fractions - 1 x fields), contiguous per cell
+        self.table = np.ascontiguousarray(np.stack(values, axis = -1).transpose(1, 0, 2))
+    #fed
+
+    @property
+    def nr_cells(self):
+        return self.table.shape[0]
+    #fed
+
+    def lookup(self, volume):
+        '''
+lookup: returns the flooded fraction, the flood depth [m] and the wetted
+perimeter [m] of the floodplain for the flood volume [m3] per cell.
+'''
+        volume = np.maximum(np.asarray(volume, dtype = np.float64), 0)
+        # the nearest area fraction from the number of halfway volumes reached
+        row = np.count_nonzero(volume[:, np.newaxis] >= self.halfway, axis = 1)
+        row += np.arange(self.nr_cells) * self.table.shape[1]
+        anchor, y_i, k_lower, k_upper, m_int = self.table.reshape(-1, len(table_fields)).take(row, axis = 0).T
+        delta = volume - anchor
+        fraction = kk_transition(delta, y_i, k_lower, k_upper, m_int, self.criterion)
+        # as in flooded_fraction, the whole cell is flooded if the nearest
+        # area fraction is not nearer than the volume of the last one
+        fraction[~(np.abs(delta) < self.last)] = 1
+        fraction[self.missing] = np.nan
+        fraction[volume <= 0] = 0
+        depth = flood_depth(volume, fraction, self.cell_area)
+        return fraction, depth, floodplain_perimeter(fraction, depth, self.cell_area, self.channel_length)
+    #fed
+
+    def exact(self, volume):
+        # the flooded fraction, depth and wetted perimeter computed directly, for validation
+        flood_volume, k_slope, m_interval = self.parameters
+        volume = np.maximum(np.asarray(volume, dtype = np.float64), 0)
+        fraction, depth = flooded_fraction(volume, flood_volume, k_slope, m_interval, \
+            self.area_fractions, self.cell_area, self.criterion)
+        return fraction, depth, floodplain_perimeter(fraction, depth, self.cell_area, self.channel_length)
+    #fed
+
+    def save(self, pathname):
+        flood_volume, k_slope, m_interval = self.parameters
+        np.savez(pathname, digest = self.digest, area_fractions = self.area_fractions, \
+            cell_area = self.cell_area, channel_length = self.channel_length, \
+            reduction = self.reduction, criterion = self.criterion, flood_volume = flood_volume, \
+            k_slope = k_slope, m_interval = m_interval, halfway = self.halfway, last = self.last, \
+            missing = self.missing, table = self.table)
+    #fed
+
+    @classmethod
+    def load(cls, pathname):
+        data = np.load(pathname)
+        tables = cls()
+        tables.digest = str(data['digest'])
+        for name in ['area_fractions', 'cell_area', 'channel_length', 'halfway', 'last', 'missing', 'table']:
+            setattr(tables, name, data[name])
+        #rof
+        tables.reduction = float(data['reduction'])
+        tables.criterion = float(data['criterion'])
+        tables.parameters = (data['flood_volume'], data['k_slope'], data['m_interval'])
+        return tables
+    #fed
+
+    @classmethod
+    def cached(cls, pathname, relZ, area_fractions, cell_area, channel_length, \
+            reduction = 0.5, criterion = 40.0):
+        '''
+cached: returns the tables from the file if they were built from the same
+input, or builds the tables and saves them to the file.
+'''
+        if os.path.isfile(pathname):
+            try:
+                tables = cls.load(pathname)
+            except (IOError, KeyError, ValueError):
+                tables = None
+            #yrt
+            if tables is not None and tables.digest == table_digest(relZ, area_fractions, \
+                    cell_area, channel_length, reduction, criterion):
+                return tables
+            #fi
+        #fi
+        tables = cls(relZ, area_fractions, cell_area, channel_length, reduction = reduction, \
+            criterion = criterion)
+        tables.save(pathname)
+        tables.report()
+        return tables
+    #fed
+
+    def report(self):
+        # print the size of the tables and the largest difference of the
+        # flooded fraction with flooded_fraction, at the volumes of the area
+        # fractions and around the volumes halfway between them, where the
+        # nearest area fraction changes
+        flood_volume = self.parameters[0]
+        halfway = self.halfway.T
+        volumes = np.concatenate([flood_volume[1:], halfway * (1 - 1.0e-9), halfway, \
+            halfway * (1 + 1.0e-9), [2 * self.last]])
+        max_error = 0.0
+        for volume in volumes:
+            error = np.abs(self.lookup(volume)[0] - self.exact(volume)[0])
+            max_error = max(max_error, np.max(error[~self.missing], initial = 0.0))
+        #rof
+        print('Floodplain tables: %d cells, %d of them missing, %.1f MB; ' \
+            'largest difference of the flooded fraction %.1e' % (self.nr_cells, np.count_nonzero(self.missing), \
+            (self.table.nbytes + self.halfway.nbytes) / 1024.0 ** 2, max_error))
+    #fed
+#ssalc
+
+def table_digest(relZ, area_fractions, cell_area, channel_length, reduction, criterion):
+    # returns the SHA-1 digest of the input of the tables
+    sha = hashlib.sha1(repr((list(area_fractions), float(reduction), float(criterion), \
+        table_fields)).encode('ascii'))
+    for values in [relZ, cell_area, channel_length]:
+        values = np.ascontiguousarray(values, dtype = np.float64)
+        sha.update(str(values.shape).encode('ascii'))
+        sha.update(values.tobytes())
+    #rof
+    return sha.hexdigest()
+#fed
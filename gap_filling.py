@@ -0,0 +1,103 @@
+"""
+gap_filling: filling of missing values with the value of the nearest valid
+cell, as done for the NDVI with areamaximum(ndvi, spreadzone(nominal(uniqueid(
+defined(ndvi))), 0, 1)). The index of the donor cell of every missing cell is
+computed once per pattern of missing values and re-used for every map with
+the same pattern, so that the spreading is not repeated every month.
+
+All arrays are NumPy arrays with NaN as missing value.
+
+"""
+
+# modules
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage
+
+class NearestValidFiller(object):
+    '''
+NearestValidFiller: fills the missing cells of arrays with the value of the
+nearest valid cell, re-using the donor index for recurring masks.
+
+    Input:
+    ======
+    sampling:               optional spacing of the rows and columns, e.g., the
+                            cell size, used for the distance; by default the
+                            cells are square;
+    max_indices:            number of donor indices (masks) that are kept.
+
+'''
+    def __init__(self, sampling = None, max_indices = 4):
+        self.sampling = sampling
+        self.max_indices = max(1, max_indices)
+        self.indices = OrderedDict()
+        self.builds = 0
+        self.reuses = 0
+    #fed
+
+    def mask_key(self, mask):
+        # key of the pattern of missing values
+        return hashlib.sha1(np.packbits(mask).tobytes() + \
+            str(mask.shape).encode('ascii')).hexdigest()
+    #fed
+
+    def donor_index(self, mask):
+        '''
+donor_index: returns the flat indices of the missing cells and of their
+donors; the index is built if the mask was not encountered before.
+'''
+        key = self.mask_key(mask)
+        if key in self.indices:
+            self.reuses += 1
+            index = self.indices.pop(key)
+        else:
+            self.builds += 1
+            missing = np.flatnonzero(mask)
+            if missing.size == 0 or missing.size == mask.size:
+                # nothing to fill or no donors
+                index = (missing[:0], missing[:0])
+            else:
+                nearest = ndimage.distance_transform_edt(mask, \
+                    sampling = self.sampling, return_distances = False, \
+                    return_indices = True)
+                donors = np.ravel_multi_index(tuple(nearest.reshape(mask.ndim, -1)[:, missing]), \
+                    mask.shape)
+                index = (missing, donors)
+            #fi
+            if len(self.indices) >= self.max_indices:
+                self.indices.popitem(last = False)
+            #fi
+        #fi
+        self.indices[key] = index
+        return index
+    #fed
+
+    def fill(self, data):
+        '''
+fill: returns a copy of the array in which the missing values are replaced by
+the value of the nearest valid cell.
+
+    Input:
+    ======
+    data:                   array with NaN for missing values.
+
+    Output:
+    =======
+    filled_data:            array without missing values, unless there are
+                            no valid cells at all.
+
+'''
+        data = np.asarray(data)
+        missing, donors = self.donor_index(np.isnan(data))
+        filled_data = data.copy()
+        filled_data.flat[missing] = data.flat[donors]
+        return filled_data
+    #fed
+
+    def report(self, name = ''):
+        # print how often the donor index was built and re-used
+        print('Gap filling %s: donor index built %d time(s), re-used %d time(s)' % \
+            (name, self.builds, self.reuses))
+    #fed
+#ssalc
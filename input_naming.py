@@ -0,0 +1,120 @@
+"""
+input_naming: naming schemes of the monthly and annual input maps of the Amazon
+Sediment Production Model. A scheme resolves the file name of an input map
+from the variable, the base name of the map and the date, so that runs are not
+tied to the maps of a single year.
+
+    TimestepNaming:         the original scheme, in which monthly maps are
+                            numbered by the time step of the run (e.g.,
+                            ndvi0000.001 for the first month) and the annual
+                            maps are static;
+    DatedNaming:            maps are resolved by date: by default, every
+                            monthly map carries the year and the month in its
+                            name (ndvi_1990_01.map for the NDVI of January
+                            1990, Pre1990.001 for the monthly rainfall) and
+                            the annual rainfall carries the year (Pan_1990.map).
+
+"""
+
+# modules
+import os, sys
+
+def generate_name_t(name, timestep):
+    '''
+generate_name_t: returns the name of the map of a time step following the
+PCRaster convention (as generateNameT of pcraster.framework), e.g.,
+ndvi0000.001 for ndvi0000 and time step 1.
+'''
+    head, tail = os.path.split(name)
+    number = '%d' % timestep
+    if '.' in tail or len(tail) + len(number) > 11:
+        sys.exit('Error: cannot generate a time step map name for %s and time step %d' % \
+            (name, timestep))
+    #fi
+    tmp = tail + '0' * (11 - len(tail) - len(number)) + number
+    return os.path.join(head, tmp[:8] + '.' + tmp[8:])
+#fed
+
+class TimestepNaming(object):
+    # monthly maps numbered by the time step of the run, static annual maps
+    def monthly(self, variable, mapname, date, timestep):
+        return generate_name_t(mapname, timestep)
+    #fed
+
+    def annual(self, variable, mapname, year):
+        # None: the annual map is static and read once by load_input_initial
+        return None
+    #fed
+#ssalc
+
+class DatedNaming(object):
+    '''
+DatedNaming: naming of the input maps by date.
+
+    Input:
+    ======
+    monthly_patterns:       dictionary with, per variable, a pattern of the
+                            map name that is filled with the keys mapname,
+                            name (the map name without trailing zeros), year,
+                            yy (the year in two digits) and month; the
+                            default for variables without a pattern is
+                            %(name)s_%(year)04d_%(month)02d.map;
+    annual_patterns:        dictionary with, per variable, the pattern of the
+                            annual map name; variables without a pattern are
+                            static;
+    climatologies:          list of variables of which the maps are monthly
+                            climatologies, numbered by the month of the year
+                            (e.g., ndvi0000.001 for every January).
+
+    A map name that is resolved for two different dates of a variable that is
+    not a climatology, or for two variables, is an error, so that a pattern
+    without the full year cannot silently re-use maps across centuries.
+
+'''
+    default_monthly_pattern = '%(name)s_%(year)04d_%(month)02d.map'
+    default_monthly_patterns = {'rain_month': 'Pre%(year)04d.%(month)03d'}
+    default_annual_patterns = {'rain_annual': 'Pan_%(year)04d.map'}
+
+    def __init__(self, monthly_patterns = None, annual_patterns = None, climatologies = None):
+        self.monthly_patterns = dict(self.default_monthly_patterns)
+        if monthly_patterns is not None:
+            self.monthly_patterns.update(monthly_patterns)
+        #fi
+        self.annual_patterns = dict(self.default_annual_patterns)
+        if annual_patterns is not None:
+            self.annual_patterns.update(annual_patterns)
+        #fi
+        self.climatologies = set(climatologies) if climatologies is not None else set()
+        # the variable and the date of every map name resolved so far
+        self.resolved = {}
+    #fed
+
+    def monthly(self, variable, mapname, date, timestep):
+        if variable in self.climatologies:
+            return generate_name_t(mapname, date.month)
+        #fi
+        pattern = self.monthly_patterns.get(variable, self.default_monthly_pattern)
+        return self._check_unique(pattern % {'mapname': mapname, 'name': mapname.rstrip('0'), \
+            'year': date.year, 'yy': date.year % 100, 'month': date.month}, \
+            variable, (date.year, date.month))
+    #fed
+
+    def annual(self, variable, mapname, year):
+        if variable in self.annual_patterns:
+            return self._check_unique(self.annual_patterns[variable] % {'mapname': mapname, \
+                'name': mapname.rstrip('0'), 'year': year, 'yy': year % 100}, variable, (year,))
+        #fi
+        return None
+    #fed
+
+    def _check_unique(self, filename, variable, date):
+        # returns the map name if it has not been resolved for another variable or date
+        owner = self.resolved.setdefault(filename, (variable, date))
+        if owner != (variable, date):
+            sys.exit('Error: map name %s is resolved for %s %s and for %s %s; use a pattern with the full year' % \
+                (filename, owner[0], '-'.join('%02d' % value for value in owner[1]), \
+                variable, '-'.join('%02d' % value for value in date)))
+        #fi
+        return filename
+    #fed
+#ssalc
@@ -0,0 +1,146 @@
+"""
+input_prefetch: background loading of the monthly input of the Amazon Sediment
+Production Model. A reader thread loads the input of the next time step(s)
+while the current time step is computed; the loaded data are passed through a
+bounded buffer so that at most a fixed number of time steps is held in memory.
+The reading only overlaps with the computation as far as the read function
+releases the GIL; benchmark_prefetch.py measures the gain.
+
+"""
+
+# modules
+import sys, time, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+#yrt
+
+class InputPrefetcher(object):
+    '''
+InputPrefetcher: loads the input of consecutive time steps in a background
+thread.
+
+    Input:
+    ======
+    read_function:          function that is called with a time step and that
+                            returns the ready-to-use input of that time step;
+                            it is called from the reader thread and should not
+                            depend on the state of the model;
+    first_timestep,
+    last_timestep:          the range of time steps to load, inclusive;
+    depth:                  number of time steps that are loaded ahead, i.e.,
+                            the size of the buffer.
+
+'''
+    def __init__(self, read_function, first_timestep, last_timestep, depth = 1):
+        self.read_function = read_function
+        self.first_timestep = first_timestep
+        self.last_timestep = last_timestep
+        self.buffer = queue.Queue(maxsize = max(1, depth))
+        self.stopped = threading.Event()
+
+        # statistics: a hit is a request for which the data were already loaded
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0.0
+        self.read_time = 0.0
+
+        self.thread = threading.Thread(target = self._read_ahead)
+        self.thread.daemon = True
+        self.thread.start()
+    #fed
+
+    def _read_ahead(self):
+        # reads all time steps in order; an exception is passed on to get,
+        # including SystemExit from a read function that calls sys.exit
+        for timestep in range(self.first_timestep, self.last_timestep + 1):
+            if self.stopped.is_set():
+                return
+            #fi
+            start = time.time()
+            try:
+                item = (timestep, self.read_function(timestep), None)
+            except BaseException:
+                item = (timestep, None, sys.exc_info()[1])
+            #yrt
+            self.read_time += time.time() - start
+            # wait for space in the buffer, checking whether we should stop
+            while not self.stopped.is_set():
+                try:
+                    self.buffer.put(item, timeout = 0.5)
+                    break
+                except queue.Full:
+                    pass
+                #yrt
+            #elihw
+            if item[2] is not None:
+                return
+            #fi
+        #rof
+    #fed
+
+    def get(self, timestep):
+        '''
+get: returns the input of the time step; blocks until it has been loaded.
+Time steps before the requested one that are still in the buffer are skipped.
+'''
+        if timestep < self.first_timestep or timestep > self.last_timestep:
+            sys.exit('Error: time step %d is outside the prefetched range %d-%d' % \
+                (timestep, self.first_timestep, self.last_timestep))
+        #fi
+        if self.buffer.empty():
+            self.misses += 1
+        else:
+            self.hits += 1
+        #fi
+        start = time.time()
+        item_timestep, data, error = self._next_item()
+        while item_timestep < timestep and error is None:
+            item_timestep, data, error = self._next_item()
+        #elihw
+        self.wait_time += time.time() - start
+        if error is not None:
+            raise error
+        #fi
+        if item_timestep != timestep:
+            sys.exit('Error: prefetched time step %d does not match requested time step %d' % \
+                (item_timestep, timestep))
+        #fi
+        return data
+    #fed
+
+    def _next_item(self):
+        # returns the next item of the buffer; waits while the reader thread
+        # is alive, so that get cannot block on a thread that has ended
+        while True:
+            try:
+                return self.buffer.get(timeout = 0.5)
+            except queue.Empty:
+                if not self.thread.is_alive() and self.buffer.empty():
+                    sys.exit('Error: the input prefetch thread ended without loading the requested time step')
+                #fi
+            #yrt
+        #elihw
+    #fed
+
+    def close(self):
+        # stop the reader thread and release the buffer
+        self.stopped.set()
+        while not self.buffer.empty():
+            try:
+                self.buffer.get_nowait()
+            except queue.Empty:
+                break
+            #yrt
+        #elihw
+        self.thread.join()
+    #fed
+
+    def report(self):
+        # print the prefetch statistics
+        requests = self.hits + self.misses
+        print('Input prefetch: %d of %d request(s) were hits (%.1f%%), %.2f s waiting, %.2f s reading' % \
+            (self.hits, requests, 100.0 * self.hits / max(1, requests), self.wait_time, self.read_time))
+    #fed
+#ssalc
@@ -0,0 +1,196 @@
+"""
+kinematic_wave: vectorized kinematic-wave routing of the discharge over an LDD
+for the Amazon Sediment Transport Model, as PCRaster kinematic. Per time
+slice, the discharge at the new time of every cell follows from the implicit
+scheme of Chow et al. (1988):
+
+    dt / dx * Q + alpha * Q ** beta = dt / dx * Qin + alpha * Qold ** beta + dt * q,
+
+with Qin the sum of the new discharge of the cells that drain into the cell
+and q the lateral inflow per unit channel length. The cells are solved level
+by level (see ldd_topology): all cells of a level only depend on cells of
+lower levels, so that the Newton iterations of a whole level are computed at
+once, with a mask of the cells that have not yet converged. The number of
+iterations per level is recorded for the performance report.
+
+All arrays are 1-D arrays over the cells of the topology, in double precision.
+
+"""
+
+# modules
+import time
+import numpy as np
+
+# smallest discharge [m3/s] in the iterations, which keeps Q ** (beta - 1) finite
+min_discharge = 1.0e-30
+
+def channel_alpha(manning_n, wetted_perimeter, gradient, beta = 0.6):
+    '''
+channel_alpha: returns the coefficient alpha of the kinematic wave,
+A = alpha * Q ** beta, from Manning's equation.
+
+    Input:
+    ======
+    manning_n:              Manning's n of the channel [s / m^1/3];
+    wetted_perimeter:       wetted perimeter of the channel [m], e.g., the
+                            channel width for wide channels;
+    gradient:               channel gradient [m / m];
+    beta:                   exponent of the kinematic wave, 0.6 for Manning.
+
+'''
+    return (manning_n * wetted_perimeter ** (2.0 / 3.0) / np.sqrt(gradient)) ** beta
+#fed
+
+class KinematicWaveSolver(object):
+    '''
+KinematicWaveSolver: kinematic-wave routing over the levels of an LDD.
+
+    Input:
+    ======
+    topology:               LddTopology of the LDD;
+    alpha:                  coefficient of the kinematic wave per cell, or a
+                            scalar;
+    beta:                   exponent of the kinematic wave;
+    channel_length:         length of the channel per cell [m];
+    tolerance:              relative tolerance of the discharge; a cell has
+                            converged if the Newton step is less than the
+                            tolerance times its discharge;
+    max_iterations:         maximum number of Newton iterations per level.
+
+'''
+    def __init__(self, topology, alpha, beta, channel_length, tolerance = 1.0e-10, \
+            max_iterations = 50):
+        self.topology = topology
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype = np.float64), (topology.nr_cells,))
+        self.beta = float(beta)
+        self.channel_length = np.broadcast_to(np.asarray(channel_length, dtype = np.float64), \
+            (topology.nr_cells,))
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        # per level, the cells of the level and the part that drains to another cell
+        self.level_cells = []
+        self.level_transfers = []
+        for ilevel in range(topology.nr_levels):
+            start, stop = topology.level_bounds[ilevel], topology.level_bounds[ilevel + 1]
+            self.level_cells.append(topology.order[start:stop])
+            target_slice = slice(topology.target_bounds[ilevel], topology.target_bounds[ilevel + 1])
+            self.level_transfers.append((topology.nr_senders[ilevel], \
+                topology.targets[target_slice], topology.target_starts[target_slice]))
+        #rof
+        self.reset_statistics()
+    #fed
+
+    def reset_statistics(self):
+        self.nr_sweeps = 0
+        self.level_iterations = np.zeros(self.topology.nr_levels, dtype = np.int64)
+        self.max_level_iterations = np.zeros(self.topology.nr_levels, dtype = np.int64)
+        self.cell_iterations = 0
+        self.nr_unconverged = 0
+        self.solve_time = 0.0
+    #fed
+
+    def route(self, discharge, lateral_inflow, timestep, nr_time_slices = 1, boundary_inflow = None):
+        '''
+route: returns the discharge at the end of the time step.
+
+    Input:
+    ======
+    discharge:              discharge at the start of the time step [m3/s];
+    lateral_inflow:         lateral inflow per unit channel length [m2/s];
+    timestep:               length of the time step [s];
+    nr_time_slices:         number of time slices of the time step;
+    boundary_inflow:        optional inflow [m3/s] per cell from outside the
+                            topology, e.g., from an upstream sub-basin, at
+                            the end of the time step.
+
+    Output:
+    =======
+    discharge:              discharge at the end of the time step [m3/s].
+
+'''
+        start_time = time.time()
+        discharge = np.maximum(np.asarray(discharge, dtype = np.float64), 0)
+        lateral_inflow = np.broadcast_to(np.asarray(lateral_inflow, dtype = np.float64), discharge.shape)
+        dt = timestep / float(nr_time_slices)
+        for islice in range(nr_time_slices):
+            discharge = self.sweep(discharge, lateral_inflow, dt, boundary_inflow)
+        #rof
+        self.solve_time += time.time() - start_time
+        return discharge
+    #fed
+
+    def sweep(self, old_discharge, lateral_inflow, dt, boundary_inflow = None):
+        # one time slice over all levels, from the sources to the pits
+        new_discharge = np.empty_like(old_discharge)
+        if boundary_inflow is None:
+            inflow = np.zeros_like(old_discharge)
+        else:
+            inflow = np.array(boundary_inflow, dtype = np.float64)
+        #fi
+        beta = self.beta
+        for ilevel, cells in enumerate(self.level_cells):
+            dt_dx = dt / self.channel_length[cells]
+            alpha = self.alpha[cells]
+            Qin = inflow[cells]
+            Qold = old_discharge[cells]
+            # right-hand side, limited to non-negative values
+            rhs = np.maximum(0, dt_dx * Qin + alpha * Qold ** beta + dt * lateral_inflow[cells])
+            # initial estimate from the linearised scheme
+            Qbar = np.maximum(0.5 * (Qin + Qold), min_discharge)
+            slope = alpha * beta * Qbar ** (beta - 1)
+            Q = np.maximum((dt_dx * Qin + slope * Qold + dt * lateral_inflow[cells]) / (dt_dx + slope), \
+                min_discharge)
+            Q[rhs == 0] = 0
+            # Newton iterations on the cells that have not converged
+            active = np.flatnonzero(rhs > 0)
+            iteration = 0
+            while active.size > 0 and iteration < self.max_iterations:
+                Qa = Q[active]
+                residual = dt_dx[active] * Qa + alpha[active] * Qa ** beta - rhs[active]
+                derivative = dt_dx[active] + alpha[active] * beta * Qa ** (beta - 1)
+                Qnew = np.maximum(Qa - residual / derivative, min_discharge)
+                Q[active] = Qnew
+                self.cell_iterations += active.size
+                active = active[np.abs(Qnew - Qa) > self.tolerance * Qnew]
+                iteration += 1
+            #elihw
+            self.nr_unconverged += active.size
+            self.level_iterations[ilevel] += iteration
+            self.max_level_iterations[ilevel] = max(self.max_level_iterations[ilevel], iteration)
+            new_discharge[cells] = Q
+            nr_senders, targets, starts = self.level_transfers[ilevel]
+            if nr_senders > 0:
+                inflow[targets] += np.add.reduceat(Q[:nr_senders], starts)
+            #fi
+        #rof
+        self.nr_sweeps += 1
+        # the inflow from upstream of the last time slice, for the water balance
+        self.inflow = inflow
+        return new_discharge
+    #fed
+
+    def report(self):
+        # print the iterations per level and the time spent
+        nr_levels = self.topology.nr_levels
+        sweeps = max(1, self.nr_sweeps)
+        mean_iterations = self.level_iterations / float(sweeps)
+        print('Kinematic wave: %d sweep(s) over %d cells in %d levels, %.3f s, %.2f ms per sweep' % \
+            (self.nr_sweeps, self.topology.nr_cells, nr_levels, self.solve_time, \
+            1000.0 * self.solve_time / sweeps))
+        if nr_levels > 0:
+            print('\titerations per level: mean %.2f, maximum %d; %.2f iterations per cell' % \
+                (mean_iterations.mean(), int(self.max_level_iterations.max()), \
+                self.cell_iterations / float(sweeps * max(1, self.topology.nr_cells))))
+            print('\t%8s %8s %10s' % ('iters', 'levels', 'cells'))
+            level_sizes = np.diff(self.topology.level_bounds)
+            for iterations in np.unique(self.max_level_iterations):
+                selected = self.max_level_iterations == iterations
+                print('\t%8d %8d %10d' % (iterations, int(selected.sum()), int(level_sizes[selected].sum())))
+            #rof
+        #fi
+        if self.nr_unconverged > 0:
+            print('Warning: %d cell solution(s) did not converge within %d iterations' % \
+                (self.nr_unconverged, self.max_iterations))
+        #fi
+    #fed
+#ssalc
@@ -0,0 +1,135 @@
+"""
+landcover_stack: the land cover fractions of the Amazon Sediment Production
+Model held as a single (classes x rows x cols) array with an index of the
+land cover classes. The weighted sums over the land cover classes, i.e., the
+conservation factor, the interception fraction and the Manning's n of the
+vegetation, are computed as a single contraction of the stack with the
+values of the land cover tables.
+
+All arrays are NumPy arrays with NaN as missing value.
+
+"""
+
+# modules
+import numpy as np
+
+class CoverFractionStack(object):
+    '''
+CoverFractionStack: land cover fractions of all classes in one contiguous
+array.
+
+    Input:
+    ======
+    classes:                list of the names of the land cover classes;
+    shape:                  shape of the grid of a single class;
+    dtype:                  data type of the fractions.
+
+'''
+    def __init__(self, classes, shape, dtype = np.float32):
+        self.classes = list(classes)
+        self.index = dict((key, iclass) for iclass, key in enumerate(self.classes))
+        self.fractions = np.empty((len(self.classes),) + tuple(shape), dtype = dtype)
+    #fed
+
+    @classmethod
+    def from_dict(cls, cover_fraction_info, dtype = np.float32):
+        # create the stack from a dictionary of arrays per class
+        classes = list(cover_fraction_info.keys())
+        cover_stack = cls(classes, np.shape(cover_fraction_info[classes[0]]), dtype)
+        for key in classes:
+            cover_stack.set_fraction(key, cover_fraction_info[key])
+        #rof
+        return cover_stack
+    #fed
+
+    @classmethod
+    def from_array(cls, classes, fractions):
+        # wrap an existing (classes x rows x cols) array, e.g., in shared memory,
+        # without copying it
+        cover_stack = cls(classes, (0, 0), fractions.dtype)
+        cover_stack.fractions = fractions
+        return cover_stack
+    #fed
+
+    def set_fraction(self, key, data):
+        # copy the fraction of the class into the stack
+        self.fractions[self.index[key]] = data
+    #fed
+
+    def normalise(self):
+        '''
+normalise: divides the fractions by the total fraction of all classes in place,
+so that the fractions add up to unity; cells without significant land cover
+data become missing.
+'''
+        total_cover = self.fractions.sum(axis = 0)
+        with np.errstate(invalid = 'ignore'):
+            self.fractions /= np.maximum(1.0e-12, total_cover)
+            self.fractions[:, ~(total_cover > 1.0e-12)] = np.nan
+        #htiw
+    #fed
+
+    def weighted_sum(self, value_info, overrides = None):
+        '''
+weighted_sum: returns the sum over all classes of the fraction times the value
+of the class.
+
+    Input:
+    ======
+    value_info:             dictionary with the value per land cover class;
+                            the values may be arrays of the same shape, e.g.,
+                            one value per ensemble member, which become the
+                            leading dimensions of the result;
+    overrides:              optional dictionary with an array per class that
+                            replaces the value of value_info for that class
+                            on a per-cell basis.
+
+    Output:
+    =======
+    weighted_sum:           array with the cell-average value.
+
+'''
+        if overrides is None:
+            overrides = {}
+        #fi
+        # the shape of the values of a class, e.g., the number of members;
+        # if all classes are overridden, that of the override less the cells
+        plain_classes = [key for key in self.classes if key not in overrides]
+        if len(plain_classes) > 0:
+            member_shape = np.shape(value_info[plain_classes[0]])
+        else:
+            override_shape = np.shape(overrides[self.classes[0]])
+            member_shape = override_shape[:max(0, len(override_shape) - (self.fractions.ndim - 1))]
+        #fi
+        values = np.array([np.zeros(member_shape) if key in overrides else value_info[key] \
+            for key in self.classes], dtype = self.fractions.dtype)
+        weighted_sum = np.tensordot(np.moveaxis(values, 0, -1), self.fractions, axes = 1)
+        for key, override in overrides.items():
+            weighted_sum += self.fractions[self.index[key]] * override
+        #rof
+        return weighted_sum
+    #fed
+#ssalc
+
+def compute_conservation_factor_stack(cover_stack, P_factor_info, selected_slope):
+    '''
+compute_conservation_factor_stack: as compute_conservation_factor, the P factor
+of Pham et al. (2003) per land cover type, except for croplands for which the
+factor depends on the slope gradient following Wener (1981).
+'''
+    overrides = {}
+    if 'croplands' in cover_stack.index:
+        overrides['croplands'] = 0.2 + 0.3 * selected_slope
+    #fi
+    return cover_stack.weighted_sum(P_factor_info, overrides)
+#fed
+
+def compute_interception_fraction_stack(cover_stack, interception_info):
+    # as compute_interception_fraction, limited between zero and unity
+    return np.clip(cover_stack.weighted_sum(interception_info), 0.0, 1.0)
+#fed
+
+def Manning_n4_stack(cover_stack, manning_n_info):
+    # as Manning_n4, the Manning's n as the weighed average of the land cover
+    return cover_stack.weighted_sum(manning_n_info)
+#fed
@@ -0,0 +1,380 @@
+"""
+ldd_topology: the drainage network of a local drain direction (LDD) map as
+arrays, for the flow accumulation of the Amazon Sediment Transport Model. The
+LDD is parsed once into the index of the downstream cell of every cell and
+the topological level of every cell: the cells of a level only receive flow
+from cells of lower levels. Accumulations over the network are computed as
+vectorized sweeps over the levels, from the sources to the pits, in which all
+cells of a level pass their flux downstream at once; the number of Python
+operations thus scales with the number of levels, not with the number of
+cells.
+
+The operations follow those of PCRaster (accuflux, accufractionflux,
+accufractionstate, upstream, downstream, catchment) but take and return NumPy
+arrays, of the grid of the LDD or as 1-D arrays over its cells (see
+active_cells), with NaN as missing value; no clone is needed. The topology can
+be saved to and loaded from a .npz file, so that it is parsed once for all
+runs on the same LDD.
+
+The LDD uses the PCRaster directions, as on the numeric key pad: 5 is a pit
+and 1 to 9 point to the neighbouring cell in that direction, with north up.
+Cells that drain to a missing or outside cell are treated as pits.
+
+"""
+
+# modules
+import os, sys, hashlib
+import numpy as np
+
+from active_cells import ActiveCells
+
+# offsets (rows, cols) of the downstream cell per LDD direction
+ldd_offsets = {1: (1, -1), 2: (1, 0), 3: (1, 1), 4: (0, -1), 5: (0, 0), \
+    6: (0, 1), 7: (-1, -1), 8: (-1, 0), 9: (-1, 1)}
+
+def ldd_digest(ldd):
+    # returns the SHA-1 digest of the LDD values and shape
+    ldd = np.ascontiguousarray(ldd_directions(ldd))
+    sha = hashlib.sha1(str(ldd.shape).encode('ascii'))
+    sha.update(ldd.tobytes())
+    return sha.hexdigest()
+#fed
+
+def ldd_directions(ldd):
+    # returns the LDD as integer directions, zero for missing values
+    ldd = np.asarray(ldd)
+    if ldd.dtype.kind == 'f':
+        ldd = np.where(np.isfinite(ldd), ldd, 0)
+    #fi
+    ldd = ldd.astype(np.int8)
+    ldd[(ldd < 1) | (ldd > 9)] = 0
+    return ldd
+#fed
+
+class LddTopology(object):
+    '''
+LddTopology: downstream index and topological order of the cells of an LDD.
+
+    Input:
+    ======
+    ldd:                    2-D array with the LDD directions; values outside
+                            1 to 9 or NaN are missing.
+
+'''
+    def __init__(self, ldd = None):
+        if ldd is None:
+            return
+        #fi
+        ldd = ldd_directions(ldd)
+        self.digest = ldd_digest(ldd)
+        self.cells = ActiveCells(ldd > 0)
+        self.downstream_index = self.compute_downstream(ldd)
+        self.compute_levels()
+    #fed
+
+    @property
+    def nr_cells(self):
+        return self.cells.nr_cells
+    #fed
+
+    @property
+    def nr_levels(self):
+        return len(self.level_bounds) - 1
+    #fed
+
+    def compute_downstream(self, ldd):
+        '''
+compute_downstream: returns the position along the cells of the downstream
+cell of every cell, -1 for pits.
+'''
+        nr_rows, nr_cols = ldd.shape
+        rows, cols = np.unravel_index(self.cells.indices, ldd.shape)
+        directions = ldd.ravel()[self.cells.indices]
+        row_offsets = np.zeros(10, dtype = np.int64)
+        col_offsets = np.zeros(10, dtype = np.int64)
+        for direction, (row_offset, col_offset) in ldd_offsets.items():
+            row_offsets[direction] = row_offset
+            col_offsets[direction] = col_offset
+        #rof
+        down_rows = rows + row_offsets[directions]
+        down_cols = cols + col_offsets[directions]
+        inside = (down_rows >= 0) & (down_rows < nr_rows) & (down_cols >= 0) & (down_cols < nr_cols) & \
+            (directions != 5)
+        # position of every grid cell along the cells, -1 for missing cells
+        position = np.full(nr_rows * nr_cols, -1, dtype = np.int64)
+        position[self.cells.indices] = np.arange(self.nr_cells)
+        downstream_index = np.full(self.nr_cells, -1, dtype = np.int64)
+        downstream_index[inside] = position[down_rows[inside] * nr_cols + down_cols[inside]]
+        return downstream_index
+    #fed
+
+    def compute_levels(self):
+        '''
+compute_levels: orders the cells by topological level; sources are at level
+0 and every other cell is one level above its highest upstream cell. Within a
+level, the cells are sorted by their downstream cell and pits come last, so
+that the flux of a level is passed on with a single reduceat per level.
+'''
+        downstream_index = self.downstream_index
+        draining = downstream_index >= 0
+        nr_upstream = np.bincount(downstream_index[draining], minlength = self.nr_cells)
+        level = np.full(self.nr_cells, -1, dtype = np.int64)
+        front = np.flatnonzero(nr_upstream == 0)
+        ilevel = 0
+        while front.size > 0:
+            level[front] = ilevel
+            targets = downstream_index[front]
+            targets = targets[targets >= 0]
+            nr_upstream -= np.bincount(targets, minlength = self.nr_cells)
+            # the cells of which the last upstream cell was in the front
+            targets = np.unique(targets)
+            front = targets[nr_upstream[targets] == 0]
+            ilevel += 1
+        #elihw
+        if (level < 0).any():
+            raise ValueError('the LDD contains a cycle through %d cell(s)' % int((level < 0).sum()))
+        #fi
+        self.level = level
+        # sort by level, pits last within a level, then by downstream cell
+        self.order = np.lexsort((downstream_index, ~draining, level))
+        self.level_bounds = np.searchsorted(level[self.order], np.arange(ilevel + 1))
+        # per level the number of draining cells, the distinct downstream cells
+        # and the start of the cells that drain to each of them
+        sorted_downstream = downstream_index[self.order]
+        self.nr_senders = np.zeros(ilevel, dtype = np.int64)
+        targets = []
+        starts = []
+        for ilevel in range(self.nr_levels):
+            start, stop = self.level_bounds[ilevel], self.level_bounds[ilevel + 1]
+            downstream = sorted_downstream[start:stop]
+            self.nr_senders[ilevel] = np.count_nonzero(downstream >= 0)
+            downstream = downstream[:self.nr_senders[ilevel]]
+            first = np.flatnonzero(np.r_[True, downstream[1:] != downstream[:-1]]) \
+                if downstream.size > 0 else np.zeros(0, dtype = np.int64)
+            targets.append(downstream[first])
+            starts.append(first)
+        #rof
+        self.target_bounds = np.cumsum([0] + [target.size for target in targets])
+        self.targets = np.concatenate(targets) if len(targets) > 0 else np.zeros(0, dtype = np.int64)
+        self.target_starts = np.concatenate(starts) if len(starts) > 0 else np.zeros(0, dtype = np.int64)
+    #fed
+
+    def levels(self):
+        '''
+levels: yields per level, from the sources to the pits, the cells of the level
+that drain to another cell, their distinct downstream cells and the start of
+the cells that drain to each of the downstream cells.
+'''
+        for ilevel in range(self.nr_levels):
+            start = self.level_bounds[ilevel]
+            senders = self.order[start:start + self.nr_senders[ilevel]]
+            if senders.size > 0:
+                target_slice = slice(self.target_bounds[ilevel], self.target_bounds[ilevel + 1])
+                yield senders, self.targets[target_slice], self.target_starts[target_slice]
+            #fi
+        #rof
+    #fed
+
+    def save(self, pathname):
+        np.savez(pathname, digest = self.digest, shape = np.array(self.cells.shape), \
+            indices = self.cells.indices, downstream_index = self.downstream_index, \
+            level = self.level, order = self.order, level_bounds = self.level_bounds, \
+            nr_senders = self.nr_senders, targets = self.targets, \
+            target_bounds = self.target_bounds, target_starts = self.target_starts)
+    #fed
+
+    @classmethod
+    def load(cls, pathname):
+        data = np.load(pathname)
+        topology = cls()
+        topology.digest = str(data['digest'])
+        mask = np.zeros(int(np.prod(data['shape'])), dtype = bool)
+        mask[data['indices']] = True
+        topology.cells = ActiveCells(mask.reshape(tuple(data['shape'])))
+        for name in ['downstream_index', 'level', 'order', 'level_bounds', 'nr_senders', \
+                'targets', 'target_bounds', 'target_starts']:
+            setattr(topology, name, data[name])
+        #rof
+        return topology
+    #fed
+
+    @classmethod
+    def cached(cls, ldd, pathname):
+        '''
+cached: returns the topology of the LDD from the file if that holds the
+topology of the same LDD, or parses the LDD and saves its topology to the
+file.
+'''
+        if os.path.isfile(pathname):
+            try:
+                topology = cls.load(pathname)
+            except (IOError, KeyError, ValueError):
+                topology = None
+            #yrt
+            if topology is not None and topology.digest == ldd_digest(ldd):
+                return topology
+            #fi
+        #fi
+        topology = cls(ldd)
+        topology.save(pathname)
+        print('LDD topology: %d cells in %d levels saved to %s' % \
+            (topology.nr_cells, topology.nr_levels, pathname))
+        return topology
+    #fed
+
+    def gather(self, values):
+        '''
+gather: returns the values as an array over the cells, in double precision;
+arrays of the grid are gathered, arrays over the cells are copied; leading
+dimensions are kept.
+'''
+        values = np.asarray(values, dtype = np.float64)
+        if values.shape[-1:] == (self.nr_cells,) and values.shape[-2:] != self.cells.shape:
+            return values.copy()
+        #fi
+        return self.cells.gather(values)
+    #fed
+
+    def scatter(self, values, like):
+        # returns the values in the form of the input: a grid or cells
+        like = np.asarray(like)
+        if like.shape[-1:] == (self.nr_cells,) and like.shape[-2:] != self.cells.shape:
+            return values
+        #fi
+        return self.cells.scatter(values)
+    #fed
+
+    def accumulate(self, values, fraction = None):
+        # sweeps over the levels; adds the (fraction of the) values of the
+        # cells of every level to their downstream cells and returns the
+        # values, that then hold the accumulated material
+        for senders, targets, starts in self.levels():
+            flux = values[..., senders]
+            if fraction is not None:
+                flux = flux * fraction[..., senders]
+            #fi
+            values[..., targets] += np.add.reduceat(flux, starts, axis = -1)
+        #rof
+        return values
+    #fed
+
+    def accuflux(self, material):
+        '''
+accuflux: returns the accumulated material that flows out of every cell, i.e.,
+the material of the cell and of all cells upstream, as PCRaster accuflux.
+'''
+        return self.scatter(self.accumulate(self.gather(material)), material)
+    #fed
+
+    def accufractionflux(self, material, fraction):
+        '''
+accufractionflux: returns the flux out of every cell and the state that remains
+in the cell if a fraction of the material and the inflow is passed
+downstream, as PCRaster accufractionflux and accufractionstate.
+
+    Input:
+    ======
+    material:               material per cell;
+    fraction:               fraction that is transported, between 0 and 1.
+
+    Output:
+    =======
+    flux:                   material that flows out of the cell;
+    state:                  material that remains in the cell.
+
+'''
+        fraction = np.clip(self.gather(fraction), 0, 1)
+        available = self.accumulate(self.gather(material), fraction)
+        flux = fraction * available
+        return self.scatter(flux, material), self.scatter(available - flux, material)
+    #fed
+
+    def upstream(self, values):
+        # returns the sum of the values of the cells that drain directly into every cell
+        cell_values = self.gather(values)
+        result = np.zeros_like(cell_values)
+        for senders, targets, starts in self.levels():
+            result[..., targets] += np.add.reduceat(cell_values[..., senders], starts, axis = -1)
+        #rof
+        return self.scatter(result, values)
+    #fed
+
+    def downstream(self, values):
+        # returns the value of the downstream cell of every cell; pits get their own value
+        index = np.where(self.downstream_index >= 0, self.downstream_index, np.arange(self.nr_cells))
+        return self.scatter(self.gather(values)[..., index], values)
+    #fed
+
+    def upstream_total(self, values):
+        # as accuflux, minus the value of the cell itself: the total over the cells upstream
+        cell_values = self.gather(values)
+        return self.scatter(self.accumulate(cell_values.copy()) - cell_values, values)
+    #fed
+
+    def catchment(self, outlet_cells):
+        '''
+catchment: returns, per outlet, the mask of the cells of which the water flows
+through the outlet, including the outlet, as PCRaster catchment.
+
+    Input:
+    ======
+    outlet_cells:           positions along the cells of the outlets, see
+                            cell_positions.
+
+    Output:
+    =======
+    masks:                  boolean array (outlets x cells).
+
+'''
+        outlet_cells = np.atleast_1d(outlet_cells)
+        masks = np.zeros((outlet_cells.size, self.nr_cells), dtype = bool)
+        masks[np.arange(outlet_cells.size), outlet_cells] = True
+        # sweep from the pits to the sources: a cell belongs to the catchment
+        # if its downstream cell does
+        for ilevel in range(self.nr_levels - 1, -1, -1):
+            start = self.level_bounds[ilevel]
+            senders = self.order[start:start + self.nr_senders[ilevel]]
+            masks[:, senders] |= masks[:, self.downstream_index[senders]]
+        #rof
+        return masks
+    #fed
+
+    def subset(self, cells):
+        '''
+subset: returns the topology of a part of the cells, e.g., a sub-basin, on the
+same grid; cells that drain to a cell outside the part become pits. The cells
+of the part keep their relative order, so that the cells of the subset are
+the cells of the part, sorted.
+'''
+        cells = np.unique(np.asarray(cells, dtype = np.int64))
+        mask = np.zeros(int(np.prod(self.cells.shape)), dtype = bool)
+        mask[self.cells.indices[cells]] = True
+        topology = LddTopology()
+        sha = hashlib.sha1(self.digest.encode('ascii'))
+        sha.update(cells.tobytes())
+        topology.digest = sha.hexdigest()
+        topology.cells = ActiveCells(mask.reshape(self.cells.shape))
+        position = np.full(self.nr_cells, -1, dtype = np.int64)
+        position[cells] = np.arange(cells.size)
+        downstream_index = self.downstream_index[cells]
+        topology.downstream_index = np.where(downstream_index >= 0, position[downstream_index], -1)
+        topology.compute_levels()
+        return topology
+    #fed
+
+    def cell_positions(self, grid_indices):
+        # returns the positions along the cells of the cells with the indices in
+        # the flattened grid, -1 for missing cells
+        position = np.full(int(np.prod(self.cells.shape)), -1, dtype = np.int64)
+        position[self.cells.indices] = np.arange(self.nr_cells)
+        return position[np.asarray(grid_indices)]
+    #fed
+
+    def report(self):
+        level_sizes = np.diff(self.level_bounds)
+        print('LDD topology: %d cells, %d pit(s), %d levels; at most %d and on average %.1f cells per level' % \
+            (self.nr_cells, int((self.downstream_index < 0).sum()), self.nr_levels, \
+            int(level_sizes.max()) if level_sizes.size > 0 else 0, \
+            level_sizes.mean() if level_sizes.size > 0 else 0.0))
+    #fed
+#ssalc
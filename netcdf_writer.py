@@ -0,0 +1,184 @@
+"""
+netcdf_writer: persistent writer for the monthly NetCDF output of the Amazon
+Sediment Production Model. Every product keeps a single open file handle for
+the whole run; time steps are buffered in memory and written in bulk, to a
+variable that is chunked and compressed with zlib and the shuffle filter.
+The file layout (time, latitude, longitude) is the same as that of
+createNetCDF and data2NetCDF, so that the files can be processed by
+extract_estimations_for_stations.py.
+
+"""
+
+# modules
+import os, sys, datetime
+import numpy as np
+import netCDF4 as nc
+
+# time units of the output
+time_units = 'Days since 1901-01-01'
+time_calendar = 'standard'
+
+class BufferedNetCDFWriter(object):
+    '''
+BufferedNetCDFWriter: writes a single variable with a time dimension to a
+NetCDF file, buffering a number of time steps in memory.
+
+    Input:
+    ======
+    filename:               name of the NetCDF file;
+    varname:                name of the variable;
+    units:                  units of the variable;
+    longitudes,
+    latitudes:              coordinates of the columns and rows;
+    buffer_size:            number of time steps held before they are written;
+    chunk_shape:            chunk shape (time, latitude, longitude) of the
+                            variable, clipped to the size of the grid;
+    complevel:              zlib compression level, no compression if zero;
+    shuffle:                switch of the shuffle filter;
+    MV:                     value used for missing values;
+    attributes:             dictionary with global attributes;
+    append:                 if True and the file exists, the file is opened
+                            to add time steps to it.
+
+'''
+    def __init__(self, filename, varname, units, longitudes, latitudes, \
+            buffer_size = 12, chunk_shape = (12, 64, 64), complevel = 4, \
+            shuffle = True, MV = -999.9, attributes = None, append = False):
+        self.filename = filename
+        self.varname = varname
+        self.buffer_size = max(1, buffer_size)
+        self.MV = MV
+        self.shape = (len(latitudes), len(longitudes))
+        # the buffer is only allocated by write, not when only windows are written
+        self.buffer = None
+        self.timestamps = []
+        self.first_position = None
+        self.syncs = 0
+
+        if append and os.path.isfile(filename):
+            self.rootgrp = nc.Dataset(filename, 'a')
+            if varname not in self.rootgrp.variables:
+                sys.exit('Error: variable %s not found in %s' % (varname, filename))
+            #fi
+        else:
+            self.rootgrp = nc.Dataset(filename, 'w', format = 'NETCDF4')
+            if attributes is not None:
+                self.rootgrp.setncatts(attributes)
+            #fi
+            self.rootgrp.createDimension('time', None)
+            self.rootgrp.createDimension('latitude', len(latitudes))
+            self.rootgrp.createDimension('longitude', len(longitudes))
+            var = self.rootgrp.createVariable('time', 'f8', ('time',))
+            var.standard_name = 'time'
+            var.units = time_units
+            var.calendar = time_calendar
+            var = self.rootgrp.createVariable('latitude', 'f4', ('latitude',))
+            var.standard_name = 'latitude'
+            var.units = 'degrees_north'
+            var[:] = latitudes
+            var = self.rootgrp.createVariable('longitude', 'f4', ('longitude',))
+            var.standard_name = 'longitude'
+            var.units = 'degrees_east'
+            var[:] = longitudes
+            chunksizes = (max(1, chunk_shape[0]), \
+                max(1, min(chunk_shape[1], self.shape[0])), \
+                max(1, min(chunk_shape[2], self.shape[1])))
+            var = self.rootgrp.createVariable(varname, 'f4', \
+                ('time', 'latitude', 'longitude'), fill_value = MV, \
+                chunksizes = chunksizes, zlib = complevel > 0, \
+                complevel = max(1, complevel), shuffle = shuffle)
+            var.units = units
+            self.rootgrp.sync()
+        #fi
+    #fed
+
+    def write(self, data, posCnt, timeStamp):
+        '''
+write: adds the data of a time step to the buffer; the buffer is written when
+it is full or when the position does not follow on the buffered time steps.
+
+    Input:
+    ======
+    data:                   array with the data of the time step, with NaN or
+                            MV for missing values;
+    posCnt:                 zero-based position along the time dimension;
+    timeStamp:              date of the time step.
+
+'''
+        nr_buffered = len(self.timestamps)
+        if nr_buffered > 0 and posCnt != self.first_position + nr_buffered:
+            self.flush(sync = False)
+            nr_buffered = 0
+        #fi
+        if nr_buffered == 0:
+            self.first_position = posCnt
+        #fi
+        if self.buffer is None:
+            self.buffer = np.empty((self.buffer_size,) + self.shape, dtype = np.float32)
+        #fi
+        self.buffer[nr_buffered] = data
+        self.timestamps.append(timeStamp)
+        if len(self.timestamps) == self.buffer_size:
+            self.flush()
+        #fi
+    #fed
+
+    def flush(self, sync = True):
+        # write the buffered time steps in bulk and, optionally, sync the file
+        nr_buffered = len(self.timestamps)
+        if nr_buffered > 0:
+            block = self.buffer[:nr_buffered]
+            block[np.isnan(block)] = self.MV
+            positions = slice(self.first_position, self.first_position + nr_buffered)
+            self.rootgrp.variables[self.varname][positions, :, :] = block
+            self.rootgrp.variables['time'][positions] = nc.date2num( \
+                [datetime.datetime(date.year, date.month, date.day) for date in self.timestamps], \
+                time_units, time_calendar)
+            self.timestamps = []
+            self.first_position = None
+        #fi
+        if sync:
+            self.rootgrp.sync()
+            self.syncs += 1
+        #fi
+    #fed
+
+    def write_window(self, block, posCnt, rows, timeStamps):
+        '''
+write_window: writes the data of consecutive time steps for a block of rows
+directly to the file, e.g., for tiled runs in which the grid of a time step is
+never held in memory as a whole. Blocks of full chunks are written most
+efficiently.
+
+    Input:
+    ======
+    block:                  array (time, rows, longitude) with NaN or MV for
+                            missing values; it is modified in place;
+    posCnt:                 zero-based position of the first time step;
+    rows:                   slice of the rows of the block;
+    timeStamps:             dates of the time steps.
+
+'''
+        block[np.isnan(block)] = self.MV
+        positions = slice(posCnt, posCnt + len(block))
+        self.rootgrp.variables[self.varname][positions, rows, :] = block
+        self.rootgrp.variables['time'][positions] = nc.date2num( \
+            [datetime.datetime(date.year, date.month, date.day) for date in timeStamps], \
+            time_units, time_calendar)
+    #fed
+
+    def timesteps_written(self):
+        # returns the length of the time dimension of the file, without the
+        # time steps that are still buffered
+        return len(self.rootgrp.dimensions['time'])
+    #fed
+
+    def close(self):
+        # flush the buffer and close the file; closing twice is allowed
+        if self.rootgrp is not None:
+            self.flush(sync = False)
+            self.rootgrp.close()
+            self.rootgrp = None
+        #fi
+    #fed
+#ssalc
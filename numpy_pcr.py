@@ -0,0 +1,195 @@
+"""
+numpy_pcr: NumPy stand-ins for the PCRaster operations that are used by the
+factor functions in amazon_factors. Missing values are represented by NaN in
+the arrays that are passed in and returned and by masked cells internally, so
+that comparisons on missing values result in missing conditions, as is the
+case for PCRaster's ifthenelse and cover.
+
+"""
+
+# modules
+import numpy as np
+
+# cache of the lookup tables that have been read, keyed by their file name
+_lookup_tables = {}
+
+def to_field(value):
+    '''
+to_field: function that converts the input of a factor function into the
+internal representation of the NumPy backend: arrays become masked arrays in
+which NaN and masked cells are missing, dictionaries are converted per value
+and any other value (e.g., floats or table names) is returned as is.
+
+    Input:
+    ======
+    value:                  array, dictionary of arrays or any other value.
+
+    Output:
+    =======
+    field:                  masked array or the converted input.
+
+'''
+    if isinstance(value, dict):
+        return dict((key, to_field(item)) for key, item in value.items())
+    elif isinstance(value, np.ndarray):
+        if value.dtype.kind != 'f':
+            value = value.astype(np.float64)
+        #fi
+        return np.ma.masked_invalid(value, copy = False)
+    else:
+        return value
+    #fi
+#fed
+
+def to_array(value):
+    '''
+to_array: function that converts the internal representation back to a plain
+array with NaN for the missing values.
+
+    Input:
+    ======
+    value:                  masked array, array or float.
+
+    Output:
+    =======
+    array:                  array of floats with NaN for missing values.
+
+'''
+    if isinstance(value, dict):
+        return dict((key, to_array(item)) for key, item in value.items())
+    #fi
+    value = np.ma.asarray(value)
+    if value.dtype.kind != 'f':
+        value = value.astype(np.float64)
+    #fi
+    return value.filled(np.nan)
+#fed
+
+def scalar(value):
+    # floats are broadcast over the grid, arrays are converted
+    if isinstance(value, np.ndarray):
+        return to_field(value)
+    else:
+        return float(value)
+    #fi
+#fed
+
+def min(*values):
+    # cell-wise minimum, missing if any of the values is missing
+    result = values[0]
+    for value in values[1:]:
+        result = np.ma.minimum(result, value)
+    #rof
+    return result
+#fed
+
+def max(*values):
+    # cell-wise maximum, missing if any of the values is missing
+    result = values[0]
+    for value in values[1:]:
+        result = np.ma.maximum(result, value)
+    #rof
+    return result
+#fed
+
+def exp(value):
+    return np.ma.exp(value)
+#fed
+
+def sqrt(value):
+    return np.ma.sqrt(value)
+#fed
+
+def sin(value):
+    return np.ma.sin(value)
+#fed
+
+def atan(value):
+    return np.ma.arctan(value)
+#fed
+
+def ifthenelse(condition, true_value, false_value):
+    # cells with a missing condition are missing in the result
+    return np.ma.where(condition, true_value, false_value)
+#fed
+
+def cover(value, *covers):
+    # missing cells are filled with the first non-missing cover value
+    result = np.ma.asarray(value)
+    for cover_value in covers:
+        result = np.ma.where(np.ma.getmaskarray(result), cover_value, result)
+    #rof
+    return result
+#fed
+
+def read_lookup_table(tablename):
+    '''
+read_lookup_table: function that reads a PCRaster lookup table with a single
+key column, e.g., ManningN1.txt, and returns its rows as a list of tuples
+(lower, upper, lower_inclusive, upper_inclusive, value). Keys are either a
+single value or a range such as [0,5> or <,2]; open bounds are infinite.
+
+    Input:
+    ======
+    tablename:              name of the lookup table.
+
+    Output:
+    =======
+    rows:                   list of the ranges and their values.
+
+'''
+    rows = []
+    with open(tablename, 'rt') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            #fi
+            key, value = fields[0], float(fields[-1])
+            if key[0] in '[<':
+                lower, upper = key[1:-1].split(',')
+                rows.append((\
+                    float(lower) if lower.strip() else -np.inf, \
+                    float(upper) if upper.strip() else np.inf, \
+                    key[0] == '[', key[-1] == ']', value))
+            else:
+                rows.append((float(key), float(key), True, True, value))
+            #fi
+        #rof
+    #htiw
+    return rows
+#fed
+
+def lookupscalar(tablename, value):
+    '''
+lookupscalar: function that returns the value of the first row of the lookup
+table that matches the key for each cell; cells without a matching row or with
+a missing key are missing.
+
+    Input:
+    ======
+    tablename:              name of the lookup table;
+    value:                  key for which the table is evaluated.
+
+    Output:
+    =======
+    result:                 the looked-up values.
+
+'''
+    if tablename not in _lookup_tables:
+        _lookup_tables[tablename] = read_lookup_table(tablename)
+    #fi
+    key = np.ma.asarray(value)
+    data = key.filled(np.nan)
+    result = np.full(data.shape, np.nan)
+    unset = ~np.ma.getmaskarray(key) & ~np.isnan(data)
+    for lower, upper, lower_inclusive, upper_inclusive, row_value in \
+            _lookup_tables[tablename]:
+        above = data >= lower if lower_inclusive else data > lower
+        below = data <= upper if upper_inclusive else data < upper
+        match = unset & above & below
+        result[match] = row_value
+        unset &= ~match
+    #rof
+    return np.ma.masked_invalid(result, copy = False)
+#fed
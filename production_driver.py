@@ -0,0 +1,94 @@
+'''
+Driver for runs of the Amazon Sediment Production Model over arbitrary date
+ranges. The number of monthly time steps follows from the start and end
+month; the monthly and annual input maps are resolved by date through the
+naming scheme, so that multi-year and multi-decade runs need one run and one
+setup of the static factors only.
+
+Example:
+    python production_driver.py -s 1990-01 -e 2029-12 -n dated -o /scratch/output
+'''
+
+import os, sys, datetime
+from argparse import ArgumentParser
+from pcraster.framework import DynamicFramework
+
+from amazon_sediment_production import RUSLE
+from input_naming import TimestepNaming, DatedNaming
+
+# returns the first day of the month given as YYYY-MM
+def parse_month(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m')
+    except ValueError:
+        sys.exit('Error: %s is not a month in the format YYYY-MM' % text)
+    #yrt
+#fed
+
+# returns the number of months from the start month to the end month, inclusive
+def months_between(startdate, enddate):
+    return (enddate.year - startdate.year) * 12 + enddate.month - startdate.month + 1
+#fed
+
+def run_production(clone_filename, mapdir, txtdir, outdir, startdate, enddate, \
+        input_naming = None, restart = False, memory_budget = None):
+    nrOfTimeSteps = months_between(startdate, enddate)
+    if nrOfTimeSteps < 1:
+        sys.exit('Error: the end date %s lies before the start date %s' % (enddate, startdate))
+    #fi
+    print('Running the production model from %s to %s: %d monthly time steps' % \
+        (startdate.strftime('%Y-%m'), enddate.strftime('%Y-%m'), nrOfTimeSteps))
+    myModel = RUSLE(clone_filename, mapdir, txtdir, outdir, startdate, restart = restart, \
+        input_naming = input_naming)
+    if memory_budget is not None:
+        # out-of-core run, tile by tile
+        from tiled_production import TiledProduction
+        if restart:
+            sys.exit('Error: tiled runs cannot be restarted')
+        #fi
+        myModel.config_model()
+        TiledProduction(myModel, memory_budget = memory_budget).run(nrOfTimeSteps)
+        return
+    #fi
+    dynamicModel = DynamicFramework(myModel, nrOfTimeSteps, firstTimestep = myModel.first_timestep())
+    dynamicModel.run()
+#fed
+
+if __name__ == "__main__":
+    workdir = os.getcwd()
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--start', default = '1990-01', help = "First month of the run, YYYY-MM")
+    parser.add_argument('-e', '--end', default = '1990-12', help = "Last month of the run, YYYY-MM")
+    parser.add_argument('-n', '--naming', choices = ['timestep', 'dated'], default = 'dated', \
+        help = "Naming scheme of the input maps: by time step of the run or by date")
+    parser.add_argument('-m', '--mapdir', default = os.path.join(workdir, 'amazon_fine'), \
+        help = "Directory with the input maps")
+    parser.add_argument('-t', '--txtdir', default = os.path.join(workdir, 'txtdata'), \
+        help = "Directory with the text tables")
+    parser.add_argument('-c', '--clone', default = os.path.join(workdir, 'mapinput', 'amazon_5min_mask.map'), \
+        help = "Clone map")
+    parser.add_argument('-o', '--outputdir', required = True, help = "Output directory name")
+    parser.add_argument('-r', '--restart', action = "store_true", default = False, \
+        help = "Restart from the latest checkpoint in the output directory")
+    parser.add_argument('-b', '--memory-budget', type = float, default = None, \
+        help = "Run tile by tile within this memory budget in MB, for grids that do not fit in memory")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.clone):
+        sys.exit('Error: %s is not a file.' % args.clone)
+    #fi
+    if not os.path.isdir(args.outputdir):
+        print("Output directory %s does not exist yet; will try to create it." % args.outputdir)
+        try:
+            os.makedirs(args.outputdir)
+        except OSError:
+            sys.exit("Error: creation of the directory %s failed" % args.outputdir)
+        #yrt
+    #fi
+
+    input_naming = DatedNaming() if args.naming == 'dated' else TimestepNaming()
+    run_production(args.clone, args.mapdir, args.txtdir, args.outputdir, \
+        parse_month(args.start), parse_month(args.end), input_naming = input_naming, \
+        restart = args.restart, memory_budget = args.memory_budget)
+    print('Hurray, Model Is Finished!')
+#fi
@@ -0,0 +1,117 @@
+"""
+report_queue: asynchronous writing of the map output of the Amazon Sediment
+Production Model. Snapshots of the result arrays are handed to a pool of
+writer threads; all writes to the same file go to the same writer so that they
+are done in order. Every writer has a bounded queue: when it is full, the model
+waits (backpressure) rather than piling up snapshots in memory. Errors of the
+writers are raised when the queue is closed at the end of the run, or earlier
+when the next snapshot is submitted.
+
+"""
+
+# modules
+import sys, threading, zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+#yrt
+
+class ReportQueue(object):
+    '''
+ReportQueue: bounded pool of background writers.
+
+    Input:
+    ======
+    write_function:         function that is called with a file name and the
+                            data to write; it is called from the writer
+                            threads;
+    nr_writers:             number of writer threads;
+    max_pending:            maximum number of snapshots waiting per writer.
+
+'''
+    def __init__(self, write_function, nr_writers = 2, max_pending = 4):
+        self.write_function = write_function
+        self.queues = [queue.Queue(maxsize = max(1, max_pending)) \
+            for iwriter in range(max(1, nr_writers))]
+        self.errors = []
+        self.nr_written = 0
+        self.lock = threading.Lock()
+        self.writers = []
+        for writer_queue in self.queues:
+            writer = threading.Thread(target = self._write, args = (writer_queue,))
+            writer.daemon = True
+            writer.start()
+            self.writers.append(writer)
+        #rof
+        self.closed = False
+    #fed
+
+    def _write(self, writer_queue):
+        # write the snapshots in the order in which they were submitted until
+        # the sentinel None is received
+        while True:
+            item = writer_queue.get()
+            if item is None:
+                writer_queue.task_done()
+                return
+            #fi
+            filename, data = item
+            try:
+                self.write_function(filename, data)
+                with self.lock:
+                    self.nr_written += 1
+                #htiw
+            except Exception:
+                with self.lock:
+                    self.errors.append((filename, sys.exc_info()[1]))
+                #htiw
+            #yrt
+            writer_queue.task_done()
+        #elihw
+    #fed
+
+    def submit(self, filename, data):
+        '''
+submit: hands a snapshot to the writer of the file; blocks while the queue of
+that writer is full. The data should not be modified afterwards.
+'''
+        self.raise_errors()
+        iwriter = zlib.crc32(filename.encode('utf-8')) % len(self.queues)
+        self.queues[iwriter].put((filename, data))
+    #fed
+
+    def raise_errors(self):
+        # raise the first error of the writers, if any
+        if len(self.errors) > 0:
+            filename, error = self.errors[0]
+            raise IOError('writing %s failed: %s (%d failed write(s) in total)' % \
+                (filename, error, len(self.errors)))
+        #fi
+    #fed
+
+    def flush(self):
+        # wait until all snapshots submitted so far are written, e.g., before a
+        # checkpoint; raises the first error if any of the writes failed
+        for writer_queue in self.queues:
+            writer_queue.join()
+        #rof
+        self.raise_errors()
+    #fed
+
+    def close(self):
+        # wait until all snapshots are written and stop the writers; raises the
+        # first error if any of the writes failed
+        if not self.closed:
+            self.closed = True
+            for writer_queue in self.queues:
+                writer_queue.put(None)
+            #rof
+            for writer in self.writers:
+                writer.join()
+            #rof
+            print('Report queue: %d map(s) written' % self.nr_written)
+        #fi
+        self.raise_errors()
+    #fed
+#ssalc
@@ -0,0 +1,213 @@
+"""
+rusle_kernel: fused, block-wise evaluation of the monthly RUSLE chain of the
+Amazon Sediment Production Model. Instead of evaluating partition_erosivity,
+compute_kfact_monthly, compute_vegcover_factor2, compute_soil_loss,
+compute_Manning, compute_hydro_coeff, compute_delivery_ratio and
+compute_erosion one after the other on full grids, the soil loss, delivery
+ratio and sediment transport are computed in a single pass over blocks of
+rows, re-using a small set of block-sized buffers. As every cell is computed
+independently, the blocks can be computed in parallel by a pool of threads;
+the NumPy operations release the GIL and the result does not depend on the
+number of threads.
+
+All arrays are NumPy arrays with NaN as missing value; missing values and
+domain errors follow the factor functions in amazon_factors.
+
+"""
+
+# modules
+import threading
+import numpy as np
+
+from amazon_factors import mv
+
+# names of the monthly input, the static factors and the output of the kernel
+dynamic_inputs = ['rain_month', 'tmin', 'tmax', 'ground_cover_fraction', \
+    'ndvi', 'Qsurface']
+static_inputs = ['rain_annual', 'R_year', 'K_year', 'kfact_seasonal', 'LS', \
+    'P_month', 'CellArea', 'Manning_n1', 'Manning_n4', 'slope_gradient', \
+    'slope_length']
+kernel_outputs = ['SoilLoss', 'DelRatio', 'SedTrans']
+
+# number of scratch buffers used per block
+_nr_buffers = 3
+
+# scratch buffers per thread
+_local = threading.local()
+
+def compute_monthly_sediment(dynamic_data, static_data, \
+        block_rows = 256, out = None, dtype = np.float32, pool = None):
+    '''
+compute_monthly_sediment: function that computes the soil loss, the delivery
+ratio and the sediment transport for one month in a single pass over the grid,
+processed in blocks of rows.
+
+    Input:
+    ======
+    dynamic_data:           dictionary with the arrays of the monthly input
+                            listed in dynamic_inputs;
+    static_data:            dictionary with the arrays of the static factors
+                            listed in static_inputs;
+    block_rows:             number of rows (or cells for 1-D input) that are
+                            processed per block;
+    out:                    optional dictionary with the output arrays that is
+                            filled in place, e.g., those of the previous time
+                            step;
+    dtype:                  data type of the output and the buffers;
+    pool:                   optional pool of threads, e.g., a
+                            multiprocessing.pool.ThreadPool, over which the
+                            blocks are distributed.
+
+    Output:
+    =======
+    out:                    dictionary with the arrays of SoilLoss [tonnes per
+                            month], DelRatio [-] and SedTrans [tonnes per month].
+
+'''
+    shape = np.shape(static_data['LS'])
+    if out is None:
+        out = dict((name, np.empty(shape, dtype = dtype)) \
+            for name in kernel_outputs)
+    #fi
+
+    block_shape = (min(block_rows, shape[0]),) + tuple(shape[1:])
+    def compute_rows(rows):
+        # the scratch buffers are allocated once per thread
+        buffers = _scratch_buffers(block_shape, dtype)
+        nr_rows = rows.stop - rows.start
+        block = {}
+        for name in dynamic_inputs:
+            block[name] = _block_of(dynamic_data[name], rows)
+        #rof
+        for name in static_inputs:
+            block[name] = _block_of(static_data[name], rows)
+        #rof
+        with np.errstate(all = 'ignore'):
+            _compute_block(block, \
+                [out[name][rows] for name in kernel_outputs], \
+                [buf[:nr_rows] for buf in buffers])
+        #htiw
+    #fed
+
+    row_blocks = [slice(row_start, min(row_start + block_rows, shape[0])) \
+        for row_start in range(0, shape[0], block_rows)]
+    if pool is None:
+        for rows in row_blocks:
+            compute_rows(rows)
+        #rof
+    else:
+        pool.map(compute_rows, row_blocks, chunksize = 1)
+    #fi
+    return out
+#fed
+
+def parallel_block_rows(nr_rows, nr_workers, block_rows = 256, blocks_per_worker = 4):
+    # returns the rows per block for a pool of workers: at most block_rows, but
+    # small enough to give every worker several blocks for load balancing
+    nr_blocks = max(1, nr_workers * blocks_per_worker)
+    return max(1, min(block_rows, -(-nr_rows // nr_blocks)))
+#fed
+
+def _scratch_buffers(block_shape, dtype):
+    # returns the scratch buffers of the current thread
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None or buffers[0].shape != block_shape or buffers[0].dtype != dtype:
+        buffers = [np.empty(block_shape, dtype = dtype) \
+            for ibuf in range(_nr_buffers)]
+        _local.buffers = buffers
+    #fi
+    return buffers
+#fed
+
+def _block_of(data, rows):
+    # floats and other scalars apply to every block
+    if np.ndim(data) == 0:
+        return data
+    #fi
+    return data[rows]
+#fed
+
+def _compute_block(block, outputs, buffers):
+    # computes the chain for one block; all intermediates are written to the
+    # buffers or the output arrays, in the order of the factor functions
+    soil_loss, delivery_ratio, sed_trans = outputs
+    r_month, k_month, tmp = buffers
+
+    # monthly erosivity (partition_erosivity)
+    np.maximum(block['rain_month'], block['rain_annual'], out = tmp)
+    np.divide(block['rain_month'], tmp, out = r_month)
+    r_month[~(block['rain_annual'] > 0)] = 0.0
+    r_month[np.isnan(block['rain_annual'])] = np.nan
+    r_month *= block['R_year']
+
+    # monthly erodibility (compute_melt_time_fraction, compute_kfact_monthly)
+    np.subtract(block['tmax'], block['tmin'], out = tmp)
+    np.maximum(0.1, tmp, out = tmp)
+    np.maximum(0.0, block['tmax'], out = k_month)
+    k_month /= tmp
+    np.minimum(1.0, k_month, out = k_month)
+    k_month *= block['kfact_seasonal'] - 1.0
+    k_month += 1.0
+    k_month *= block['K_year']
+
+    # vegetation cover factor (compute_vegcover_factor2), the cover factor is
+    # held in the soil loss array
+    gc = block['ground_cover_fraction']
+    np.multiply(gc, gc, out = soil_loss)
+    soil_loss *= 0.0449
+    soil_loss -= 0.799
+    np.multiply(7.74, gc, out = tmp)
+    soil_loss -= tmp
+    np.exp(soil_loss, out = soil_loss)
+    _cover_invalid(soil_loss, mv)
+    np.divide(r_month, block['R_year'], out = tmp)
+    _set_invalid(tmp)
+    soil_loss *= tmp
+    _cover_invalid(soil_loss, mv)
+
+    # soil loss (compute_soil_loss)
+    soil_loss *= r_month
+    soil_loss *= k_month
+    soil_loss *= block['LS']
+    soil_loss *= block['P_month']
+    soil_loss *= block['CellArea']
+    soil_loss /= 10000
+
+    # Manning's n (compute_Manning), held in r_month
+    ndvi = block['ndvi']
+    np.maximum(ndvi, 0.0, out = r_month)
+    r_month[np.isnan(ndvi)] = np.nan
+    r_month *= block['Manning_n4']
+    r_month += block['Manning_n1']
+    r_month += 0.049
+
+    # hydrological coefficient (compute_hydro_coeff), held in k_month
+    np.divide(block['Qsurface'], block['rain_month'], out = k_month)
+    _cover_invalid(k_month, 0.0001)
+    np.clip(k_month, 0.0, 1.0, out = k_month)
+
+    # delivery ratio (compute_delivery_ratio)
+    np.multiply(block['slope_gradient'], 100, out = tmp)
+    np.sqrt(tmp, out = tmp)
+    tmp *= k_month
+    r_month *= block['slope_length']
+    tmp /= r_month
+    _set_invalid(tmp)
+    np.power(tmp, 0.79, out = tmp)
+    tmp *= 9.53
+    np.maximum(0.0, tmp, out = tmp)
+    np.minimum(1.0, tmp, out = delivery_ratio)
+
+    # sediment transport (compute_erosion)
+    np.multiply(soil_loss, delivery_ratio, out = sed_trans)
+#fed
+
+def _set_invalid(data):
+    # domain errors such as a division by zero result in missing values
+    data[np.isinf(data)] = np.nan
+#fed
+
+def _cover_invalid(data, value):
+    # replace missing values and domain errors in place
+    data[~np.isfinite(data)] = value
+#fed
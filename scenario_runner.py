@@ -0,0 +1,285 @@
+'''
+Runner of the Amazon Sediment Production Model for many scenarios, e.g.,
+forcing years and land-use scenarios over the same basin. The scenarios are
+run by a pool of worker processes; the static inputs and factors are loaded
+once by the runner and placed in shared memory, which the workers map
+read-only instead of reading the static maps and computing the static
+factors again. Every scenario writes its output to its own directory under
+the output directory.
+
+A scenario is a dictionary with the keys:
+    name:                   name of the scenario and of its output directory;
+    start, end:             first and last month of the run, YYYY-MM;
+    naming:                 optional naming scheme of the input maps,
+                            'dated' (default) or 'timestep';
+    landcover_tables:       optional dictionary with, per land cover table
+                            (manning_n_info, P_factor_info or
+                            part_interception_info), the values per land
+                            cover class that replace those of the table;
+                            the land cover dependent factors are recomputed
+                            for the scenario from the shared land cover
+                            fractions.
+
+Example:
+    python scenario_runner.py -y 1990 1991 1992 -p 3 -o /scratch/output/scenarios
+'''
+
+import os, sys, time, json
+import multiprocessing
+from argparse import ArgumentParser
+import numpy as np
+from pcraster import cover, pcr2numpy
+from pcraster.framework import DynamicFramework
+
+from amazon_sediment_production import RUSLE
+from production_driver import parse_month, months_between
+from input_naming import TimestepNaming, DatedNaming
+from landcover_stack import CoverFractionStack, compute_conservation_factor_stack, \
+    compute_interception_fraction_stack, Manning_n4_stack
+from shared_buffers import share_arrays, map_shared_arrays
+import amazon_factors
+from amazon_factors import mv
+
+# land cover tables of the model by attribute name
+landcover_tables = {'manning_n_info': 'Landcover_n4.txt', 'P_factor_info': 'P_factor.txt', \
+    'part_interception_info': 'part_interception.txt'}
+
+# state of a worker process, set by _init_worker
+_worker_state = {}
+
+def load_static_state(clone_filename, mapdir, txtdir, outdir, land_cover = False):
+    '''
+load_static_state: returns the static factors of the model as arrays, taken
+from the static factor cache if possible.
+
+    Input:
+    ======
+    clone_filename:         clone map;
+    mapdir, txtdir:         directories with the input maps and text tables;
+    outdir:                 output directory of the runner;
+    land_cover:             if True, the land cover fractions and the selected
+                            slope are included as well, as needed for land-use
+                            scenarios.
+
+    Output:
+    =======
+    arrays:                 dictionary with the arrays by name;
+    classes:                names of the land cover classes;
+    tables:                 dictionary with the land cover tables.
+
+'''
+    model = RUSLE(clone_filename, mapdir, txtdir, outdir, None)
+    model.config_model()
+    if not model.load_static_cache():
+        model.load_input_initial()
+        model.setup_model()
+        model.store_static_cache()
+    #fi
+    arrays = model.static_state_arrays()
+    tables = dict((name, model.load_landcoverdata(model.check_txtfile(filename))) \
+        for name, filename in landcover_tables.items())
+    classes = sorted(tables['manning_n_info'].keys())
+    if land_cover:
+        if not hasattr(model, 'cover_stack'):
+            model.cover_stack = model.load_landcovermaps(classes)
+            model.selected_slope = cover(model.rd_map('sel_slope'), mv)
+        #fi
+        classes = model.cover_stack.classes
+        arrays['cover_fractions'] = model.cover_stack.fractions
+        arrays['selected_slope'] = pcr2numpy(model.selected_slope, np.nan)
+    #fi
+    return arrays, classes, tables
+#fed
+
+def _init_worker(clone_filename, mapdir, txtdir, outdir, shared_arrays, classes, tables):
+    # initialisation of a worker process of the pool
+    _worker_state['run_settings'] = (clone_filename, mapdir, txtdir, outdir)
+    _worker_state['arrays'] = map_shared_arrays(shared_arrays)
+    _worker_state['classes'] = classes
+    _worker_state['tables'] = tables
+#fed
+
+def scenario_static_state(scenario, arrays, classes, tables):
+    '''
+scenario_static_state: returns the static factors of the scenario; these are
+the shared arrays, except for the land cover dependent factors if the
+scenario changes the land cover tables.
+'''
+    overrides = scenario.get('landcover_tables')
+    if not overrides:
+        return arrays
+    #fi
+    if 'cover_fractions' not in arrays:
+        sys.exit('Error: scenario %s changes the land cover tables but the land cover is not shared' % \
+            scenario['name'])
+    #fi
+    scenario_tables = dict((name, dict(values)) for name, values in tables.items())
+    for name, values in overrides.items():
+        if name not in scenario_tables:
+            sys.exit('Error: scenario %s changes the unknown land cover table %s' % \
+                (scenario['name'], name))
+        #fi
+        scenario_tables[name].update(values)
+    #rof
+    arrays = dict(arrays)
+    cover_stack = CoverFractionStack.from_array(classes, arrays['cover_fractions'])
+    arrays['interception_fraction'] = compute_interception_fraction_stack(cover_stack, \
+        scenario_tables['part_interception_info'])
+    arrays['P_month'] = compute_conservation_factor_stack(cover_stack, \
+        scenario_tables['P_factor_info'], arrays['selected_slope'])
+    arrays['Manning_n4'] = Manning_n4_stack(cover_stack, scenario_tables['manning_n_info'])
+    backend = amazon_factors.get_backend()
+    amazon_factors.set_backend('numpy')
+    try:
+        R_year = amazon_factors.compute_annual_erosivity( \
+            (1.0 - arrays['interception_fraction']) * arrays['rain_annual'])
+    finally:
+        amazon_factors.set_backend(backend)
+    #yrt
+    arrays['R_year'] = np.where(np.isnan(R_year), mv, R_year)
+    return arrays
+#fed
+
+def run_scenario(scenario):
+    '''
+run_scenario: runs the model for a single scenario in a worker process and
+returns the name of the scenario, the process id, the start and end time and
+the number of months.
+'''
+    start_time = time.time()
+    clone_filename, mapdir, txtdir, outdir = _worker_state['run_settings']
+    startdate = parse_month(scenario['start'])
+    nrOfTimeSteps = months_between(startdate, parse_month(scenario['end']))
+    scenario_outdir = os.path.join(outdir, scenario['name'])
+    if not os.path.isdir(scenario_outdir):
+        os.makedirs(scenario_outdir)
+    #fi
+    input_naming = TimestepNaming() if scenario.get('naming') == 'timestep' else DatedNaming()
+    static_state = scenario_static_state(scenario, _worker_state['arrays'], \
+        _worker_state['classes'], _worker_state['tables'])
+    myModel = RUSLE(clone_filename, mapdir, txtdir, scenario_outdir, startdate, \
+        input_naming = input_naming, static_state = static_state)
+    DynamicFramework(myModel, nrOfTimeSteps).run()
+    return {'name': scenario['name'], 'pid': os.getpid(), 'start_time': start_time, \
+        'end_time': time.time(), 'nr_months': nrOfTimeSteps}
+#fed
+
+def run_scenarios(scenarios, clone_filename, mapdir, txtdir, outdir, processes = None):
+    '''
+run_scenarios: runs the scenarios on a pool of worker processes and reports the
+throughput.
+
+    Input:
+    ======
+    scenarios:              list of scenarios, see above;
+    clone_filename:         clone map;
+    mapdir, txtdir:         directories with the input maps and text tables;
+    outdir:                 output directory; every scenario writes to the
+                            sub-directory with its name;
+    processes:              number of worker processes, by default the number
+                            of processors.
+
+    Output:
+    =======
+    results:                list with the result of run_scenario per scenario.
+
+'''
+    names = [scenario['name'] for scenario in scenarios]
+    if len(set(names)) < len(names):
+        sys.exit('Error: the names of the scenarios, and hence their output directories, are not unique')
+    #fi
+    for scenario in scenarios:
+        if months_between(parse_month(scenario['start']), parse_month(scenario['end'])) < 1:
+            sys.exit('Error: the end of scenario %s lies before its start' % scenario['name'])
+        #fi
+    #rof
+    land_cover = any(scenario.get('landcover_tables') for scenario in scenarios)
+    arrays, classes, tables = load_static_state(clone_filename, mapdir, txtdir, outdir, \
+        land_cover = land_cover)
+    nr_cells = int(np.count_nonzero(np.isfinite(arrays['CellArea'])))
+    shared_arrays = share_arrays(arrays)
+    del arrays
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    #fi
+    processes = max(1, min(processes, len(scenarios)))
+    print('Running %d scenario(s) on %d worker process(es)' % (len(scenarios), processes))
+
+    start_time = time.time()
+    pool = multiprocessing.Pool(processes, initializer = _init_worker, \
+        initargs = (clone_filename, mapdir, txtdir, outdir, shared_arrays, classes, tables))
+    try:
+        results = pool.map(run_scenario, scenarios, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+    #yrt
+    report_throughput(results, nr_cells, time.time() - start_time)
+    return results
+#fed
+
+def report_throughput(results, nr_cells, wall_time):
+    # print the aggregate throughput in cell-months per second and the
+    # utilisation of every worker, i.e., the fraction of the wall time that it
+    # was running scenarios
+    nr_months = sum(result['nr_months'] for result in results)
+    wall_time = max(wall_time, 1.0e-9)
+    print('Scenarios: %d run(s), %d month(s) of %d cells in %.1f s: %.0f cell-months per second' % \
+        (len(results), nr_months, nr_cells, wall_time, nr_cells * nr_months / wall_time))
+    busy_times = {}
+    for result in results:
+        busy_time, nr_runs = busy_times.get(result['pid'], (0.0, 0))
+        busy_times[result['pid']] = \
+            (busy_time + result['end_time'] - result['start_time'], nr_runs + 1)
+    #rof
+    for pid in sorted(busy_times.keys()):
+        busy_time, nr_runs = busy_times[pid]
+        print('\tworker %d: %d run(s), busy %.1f s, utilisation %.0f%%' % \
+            (pid, nr_runs, busy_time, 100.0 * busy_time / wall_time))
+    #rof
+#fed
+
+if __name__ == "__main__":
+    workdir = os.getcwd()
+    parser = ArgumentParser()
+    parser.add_argument('-y', '--years', type = int, nargs = '*', default = [], \
+        help = "Forcing years, each run as a scenario from January to December")
+    parser.add_argument('-f', '--scenario-file', default = None, \
+        help = "JSON file with a list of scenarios")
+    parser.add_argument('-p', '--processes', type = int, default = None, \
+        help = "Number of worker processes, by default the number of processors")
+    parser.add_argument('-m', '--mapdir', default = os.path.join(workdir, 'amazon_fine'), \
+        help = "Directory with the input maps")
+    parser.add_argument('-t', '--txtdir', default = os.path.join(workdir, 'txtdata'), \
+        help = "Directory with the text tables")
+    parser.add_argument('-c', '--clone', default = os.path.join(workdir, 'mapinput', 'amazon_5min_mask.map'), \
+        help = "Clone map")
+    parser.add_argument('-o', '--outputdir', required = True, help = "Output directory name")
+    args = parser.parse_args()
+
+    scenarios = [{'name': 'forcing_%d' % year, 'start': '%d-01' % year, 'end': '%d-12' % year} \
+        for year in args.years]
+    if args.scenario_file is not None:
+        with open(args.scenario_file, 'rt') as f:
+            scenarios += json.load(f)
+        #htiw
+    #fi
+    if len(scenarios) == 0:
+        sys.exit('Error: no scenarios given, use --years and/or --scenario-file')
+    #fi
+    if not os.path.isfile(args.clone):
+        sys.exit('Error: %s is not a file.' % args.clone)
+    #fi
+    if not os.path.isdir(args.outputdir):
+        print("Output directory %s does not exist yet; will try to create it." % args.outputdir)
+        try:
+            os.makedirs(args.outputdir)
+        except OSError:
+            sys.exit("Error: creation of the directory %s failed" % args.outputdir)
+        #yrt
+    #fi
+
+    run_scenarios(scenarios, args.clone, args.mapdir, args.txtdir, args.outputdir, \
+        processes = args.processes)
+    print('Hurray, All Scenarios Are Finished!')
+#fi
@@ -0,0 +1,49 @@
+"""
+shared_buffers: arrays in shared memory for the worker processes of the
+Amazon Sediment models. A buffer is a RawArray of bytes that is passed to the
+workers when they are started; each process maps a numpy array on it, so that
+the data are not copied or pickled per task.
+
+"""
+
+# modules
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+def shared_array(shape, dtype = np.float64):
+    # returns a buffer in shared memory and the array on it
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffer = RawArray(ctypes.c_char, max(1, size * dtype.itemsize))
+    return buffer, np.frombuffer(buffer, dtype = dtype, count = size).reshape(shape)
+#fed
+
+def map_shared_array(buffer, shape, dtype = np.float64):
+    # returns the array on a buffer in shared memory
+    return np.frombuffer(buffer, dtype = np.dtype(dtype), count = int(np.prod(shape))).reshape(shape)
+#fed
+
+def share_arrays(arrays):
+    # copy the arrays to shared memory; returns, per name, the shared buffer
+    # with the shape and data type of the array
+    shared = {}
+    for name, data in arrays.items():
+        data = np.asarray(data)
+        buffer, shared_data = shared_array(data.shape, data.dtype)
+        shared_data[...] = data
+        shared[name] = (buffer, data.shape, data.dtype.str)
+    #rof
+    return shared
+#fed
+
+def map_shared_arrays(shared):
+    # returns read-only arrays on the shared buffers of share_arrays
+    arrays = {}
+    for name, (buffer, shape, dtype) in shared.items():
+        data = map_shared_array(buffer, shape, dtype)
+        data.flags.writeable = False
+        arrays[name] = data
+    #rof
+    return arrays
+#fed
@@ -0,0 +1,191 @@
+"""
+static_cache: persistent, content-addressed cache for the static factors of the
+Amazon Sediment Production Model. The key of a cache entry is a hash of the
+contents of all input maps and text tables that the static factors depend on,
+together with a hash of the code that computes them; any change upstream thus
+results in a new key and hence in a recomputation. Every factor is stored as
+a .npy file so that it can be memory-mapped on a warm start.
+
+"""
+
+# modules
+import os, sys, json, shutil, hashlib
+import numpy as np
+
+# the name of the file with the manifest of a cache entry and the name of the
+# file that holds the digests of the files hashed so far
+_manifest_name = 'manifest.json'
+_digest_index_name = 'digests.json'
+
+def file_digest(pathname, blocksize = 1 << 20):
+    '''
+file_digest: function that returns the SHA-1 digest of the contents of a file.
+
+    Input:
+    ======
+    pathname:               name of the file;
+    blocksize:              number of bytes read at once.
+
+    Output:
+    =======
+    digest:                 hexadecimal digest of the file contents.
+
+'''
+    sha = hashlib.sha1()
+    with open(pathname, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+        #elihw
+    #htiw
+    return sha.hexdigest()
+#fed
+
+def source_pathname(module_file):
+    # return the source file of a module, also if it was loaded from a .pyc
+    if module_file.endswith('.pyc') or module_file.endswith('.pyo'):
+        return module_file[:-1]
+    #fi
+    return module_file
+#fed
+
+class StaticFactorCache(object):
+    '''
+StaticFactorCache: on-disk cache of static factors, keyed on the digests of the
+input files and the code files.
+
+    Input:
+    ======
+    cachedir:               directory in which the cache entries are stored;
+    code_files:             list of the source files of the code that computes
+                            the factors; their contents are part of every key.
+
+'''
+    def __init__(self, cachedir, code_files):
+        self.cachedir = cachedir
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        #fi
+        self.code_files = [source_pathname(fn) for fn in code_files]
+        self.hits = 0
+        self.misses = 0
+
+        # digests are re-used for files of which the size and modification
+        # time did not change, so that a warm start does not read the maps
+        self.digest_index_name = os.path.join(self.cachedir, _digest_index_name)
+        self.digest_index = {}
+        if os.path.isfile(self.digest_index_name):
+            try:
+                with open(self.digest_index_name, 'rt') as f:
+                    self.digest_index = json.load(f)
+                #htiw
+            except (IOError, OSError, ValueError):
+                # e.g., removed by a concurrent run or left incomplete by an
+                # older version; the digests are then computed again
+                self.digest_index = {}
+            #yrt
+        #fi
+    #fed
+
+    def digest(self, pathname):
+        # return the digest of a file, using the index if it is up to date
+        pathname = os.path.abspath(pathname)
+        stat = os.stat(pathname)
+        entry = self.digest_index.get(pathname)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            entry = [stat.st_size, stat.st_mtime, file_digest(pathname)]
+            self.digest_index[pathname] = entry
+        #fi
+        return entry[2]
+    #fed
+
+    def compute_key(self, input_files):
+        '''
+compute_key: returns the key of the cache entry for the given input files; the
+names of the files are not part of the key, only their order and contents.
+
+    Input:
+    ======
+    input_files:            list of the input files of the static factors.
+
+    Output:
+    =======
+    key:                    hexadecimal key of the cache entry.
+
+'''
+        sha = hashlib.sha1()
+        for pathname in self.code_files + list(input_files):
+            if not os.path.isfile(pathname):
+                sys.exit('Error: %s cannot be hashed for the static factor cache' % pathname)
+            #fi
+            sha.update(self.digest(pathname).encode('ascii'))
+        #rof
+        # concurrent runs share the index: write it via a temporary file of
+        # this process, so that a reader never sees a partial file
+        tmpname = self.digest_index_name + '.tmp%d' % os.getpid()
+        with open(tmpname, 'wt') as f:
+            json.dump(self.digest_index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        #htiw
+        if os.path.isfile(self.digest_index_name):
+            os.remove(self.digest_index_name)
+        #fi
+        os.rename(tmpname, self.digest_index_name)
+        return sha.hexdigest()
+    #fed
+
+    def load(self, key, names):
+        '''
+load: returns a dictionary with the cached factors as read-only memory-mapped
+arrays if all names are present in the entry for the key, otherwise None.
+'''
+        entrydir = os.path.join(self.cachedir, key)
+        manifest_name = os.path.join(entrydir, _manifest_name)
+        if os.path.isfile(manifest_name):
+            with open(manifest_name, 'rt') as f:
+                manifest = json.load(f)
+            #htiw
+            if set(names) <= set(manifest['names']):
+                self.hits += 1
+                print('Static factor cache hit for %s' % key)
+                return dict((name, np.load(os.path.join(entrydir, name + '.npy'), \
+                    mmap_mode = 'r')) for name in names)
+            #fi
+        #fi
+        self.misses += 1
+        print('Static factor cache miss for %s' % key)
+        return None
+    #fed
+
+    def store(self, key, arrays):
+        '''
+store: writes the dictionary of arrays as the entry for the key; the entry is
+written to a temporary directory first so that an interrupted write never
+results in an incomplete entry.
+'''
+        entrydir = os.path.join(self.cachedir, key)
+        tmpdir = entrydir + '.tmp%d' % os.getpid()
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        #fi
+        os.makedirs(tmpdir)
+        for name, data in arrays.items():
+            np.save(os.path.join(tmpdir, name + '.npy'), np.asarray(data))
+        #rof
+        with open(os.path.join(tmpdir, _manifest_name), 'wt') as f:
+            json.dump({'names': sorted(arrays.keys())}, f)
+        #htiw
+        if os.path.isdir(entrydir):
+            shutil.rmtree(entrydir)
+        #fi
+        os.rename(tmpdir, entrydir)
+        print('Static factors stored in cache entry %s' % key)
+    #fed
+
+    def report(self):
+        # print the number of hits and misses
+        print('Static factor cache: %d hit(s), %d miss(es)' % (self.hits, self.misses))
+    #fed
+#ssalc
@@ -0,0 +1,466 @@
+'''
+Sub-basin domain decomposition of the routing of the Amazon Sediment Transport
+Model. The LDD is split at chosen outlet cells, each the last cell of a
+tributary upstream of its confluence, into sub-basins that only exchange
+water and sediment through these outlets: the tributaries (e.g., the Madeira,
+Negro, Solimoes, Tapajos and Xingu) are independent until their confluences.
+Every sub-basin is routed by its own worker process. At every time step, the
+outflow of a sub-basin, water [m3/s] and sediment [kg], is passed to the
+cell that it drains into in the downstream sub-basin through a ring buffer in
+shared memory; the downstream worker waits for the outflow of the time step
+from its upstream sub-basins, while these continue with the next time steps
+as long as the ring has room, so that the sub-basins are routed as a
+pipeline. If a worker fails, the others stop waiting for the ring buffers and
+are terminated if they do not end in time, and the run is aborted.
+
+The water is routed by the kinematic wave (kinematic_wave) and the sediment by
+accufractionflux with a transported fraction Q / (Q + Qs) of the material,
+with Qs the discharge at which half of the material is transported. The inflow
+from upstream sub-basins enters the inflow of the receiving cell, as in the
+serial run over the whole LDD, so that the decomposed run reproduces the
+serial run up to the order in which the inflows of a confluence are summed;
+the largest difference is part of the scaling report.
+
+The forcing is an object that returns, per time step, the lateral inflow per
+unit channel length [m2/s] and the sediment input [kg] of the given cells; it
+is passed to the worker processes and must therefore be picklable.
+
+Example:
+    python subbasin_routing.py -r 240 -c 320 -s 6 -n 100
+'''
+
+import sys, time
+import multiprocessing
+from argparse import ArgumentParser
+import numpy as np
+
+from ldd_topology import LddTopology
+from kinematic_wave import KinematicWaveSolver
+from shared_buffers import shared_array, map_shared_array
+
+def subbasin_labels(topology, outlets):
+    '''
+subbasin_labels: returns the sub-basin of every cell: the number of the first
+outlet downstream of the cell, counted from one, or zero for the cells that
+drain to a pit without passing an outlet, the trunk.
+
+    Input:
+    ======
+    topology:               LddTopology of the LDD;
+    outlets:                positions along the cells of the outlets.
+
+'''
+    labels = np.zeros(topology.nr_cells, dtype = np.int64)
+    is_outlet = np.zeros(topology.nr_cells, dtype = bool)
+    is_outlet[outlets] = True
+    labels[outlets] = np.arange(1, len(outlets) + 1)
+    # from the pits to the sources, every cell that is not an outlet takes the
+    # sub-basin of its downstream cell
+    for ilevel in range(topology.nr_levels - 1, -1, -1):
+        cells = topology.order[topology.level_bounds[ilevel]:topology.level_bounds[ilevel + 1]]
+        cells = cells[(topology.downstream_index[cells] >= 0) & ~is_outlet[cells]]
+        labels[cells] = labels[topology.downstream_index[cells]]
+    #rof
+    return labels
+#fed
+
+def select_outlets(topology, nr_subbasins):
+    '''
+select_outlets: returns the positions of nr_subbasins - 1 outlets, chosen from
+the cells that drain into a confluence; the largest sub-basin is split in
+turn, at the outlet that divides its cells most evenly.
+'''
+    downstream = topology.downstream_index
+    nr_upstream = np.bincount(downstream[downstream >= 0], minlength = topology.nr_cells)
+    candidates = np.flatnonzero((downstream >= 0) & (nr_upstream[np.maximum(downstream, 0)] >= 2))
+    outlets = []
+    for isubbasin in range(nr_subbasins - 1):
+        labels = subbasin_labels(topology, outlets)
+        sizes = np.bincount(labels)
+        # the cells upstream of every cell within its current sub-basin
+        fraction = np.ones(topology.nr_cells)
+        fraction[outlets] = 0
+        upstream_cells = topology.accumulate(np.ones(topology.nr_cells), fraction)
+        largest = np.argmax(sizes)
+        selected = candidates[labels[candidates] == largest]
+        if selected.size == 0:
+            break
+        #fi
+        outlets.append(int(selected[np.argmin(np.abs(upstream_cells[selected] - 0.5 * sizes[largest]))]))
+        candidates = candidates[candidates != outlets[-1]]
+    #rof
+    return outlets
+#fed
+
+class RoutingDomain(object):
+    '''
+RoutingDomain: the routing of the water and the sediment over the cells of a
+topology, the whole LDD or a sub-basin.
+
+    Input:
+    ======
+    topology:               LddTopology of the domain;
+    alpha, beta:            parameters of the kinematic wave, see
+                            kinematic_wave;
+    channel_length:         channel length per cell [m];
+    half_discharge:         discharge [m3/s] per cell at which half of the
+                            sediment is transported;
+    discharge:              initial discharge [m3/s];
+    sediment:               initial sediment stock [kg].
+
+'''
+    def __init__(self, topology, alpha, beta, channel_length, half_discharge, discharge, sediment):
+        self.topology = topology
+        self.solver = KinematicWaveSolver(topology, alpha, beta, channel_length)
+        self.half_discharge = np.asarray(half_discharge, dtype = np.float64)
+        self.discharge = np.array(discharge, dtype = np.float64)
+        self.sediment = np.array(sediment, dtype = np.float64)
+    #fed
+
+    def step(self, lateral_inflow, sediment_input, timestep, boundary_water = None, boundary_sediment = None):
+        # routes the water and the sediment over a time step; returns the
+        # discharge and the sediment flux out of every cell
+        self.discharge = self.solver.route(self.discharge, lateral_inflow, timestep, \
+            boundary_inflow = boundary_water)
+        material = self.sediment + sediment_input
+        if boundary_sediment is not None:
+            material += boundary_sediment
+        #fi
+        fraction = self.discharge / (self.discharge + self.half_discharge)
+        flux, self.sediment = self.topology.accufractionflux(material, fraction)
+        return self.discharge, flux
+    #fed
+#ssalc
+
+class SubbasinDecomposition(object):
+    '''
+SubbasinDecomposition: the sub-basins of an LDD and the connections between
+them.
+
+    Input:
+    ======
+    topology:               LddTopology of the whole LDD;
+    outlets:                positions along the cells of the outlets of the
+                            sub-basins, see select_outlets; the remaining
+                            cells form the trunk, sub-basin zero.
+
+'''
+    def __init__(self, topology, outlets):
+        self.topology = topology
+        self.outlets = np.asarray(outlets, dtype = np.int64)
+        if np.any(topology.downstream_index[self.outlets] < 0):
+            sys.exit('Error: a pit cannot be the outlet of a sub-basin')
+        #fi
+        self.labels = subbasin_labels(topology, self.outlets)
+        self.nr_subbasins = len(self.outlets) + 1
+        self.cells = [np.flatnonzero(self.labels == label) for label in range(self.nr_subbasins)]
+        self.topologies = [topology.subset(cells) for cells in self.cells]
+        # per sub-basin, its receiving sub-basin and the position of the
+        # receiving cell in it, and the position of its outlet in its own cells
+        self.receiver = [None]
+        self.outlet_position = [None]
+        for label, outlet in enumerate(self.outlets, 1):
+            receiving_cell = topology.downstream_index[outlet]
+            receiver = self.labels[receiving_cell]
+            self.receiver.append((receiver, int(np.searchsorted(self.cells[receiver], receiving_cell))))
+            self.outlet_position.append(int(np.searchsorted(self.cells[label], outlet)))
+        #rof
+        self.upstream = [[(label, self.receiver[label][1]) for label in range(1, self.nr_subbasins) \
+            if self.receiver[label][0] == receiver] for receiver in range(self.nr_subbasins)]
+    #fed
+
+    def report(self):
+        # print the size of the sub-basins and the upper bound of the speed-up,
+        # the share of the largest sub-basin
+        sizes = np.array([cells.size for cells in self.cells])
+        print('Sub-basins: %d, %d cells; largest %d cells, speed-up at most %.1f' % \
+            (self.nr_subbasins, self.topology.nr_cells, sizes.max(), sizes.sum() / float(sizes.max())))
+        for label in range(self.nr_subbasins):
+            receiver = 'outlet' if self.receiver[label] is None else 'sub-basin %d' % self.receiver[label][0]
+            print('\tsub-basin %2d: %8d cells, %3d levels, drains to %s' % \
+                (label, sizes[label], self.topologies[label].nr_levels, receiver))
+        #rof
+    #fed
+#ssalc
+
+def route_serial(topology, parameters, forcing, nr_steps, timestep):
+    '''
+route_serial: routes the water and the sediment over the whole LDD; returns
+the discharge and the sediment stock at the end, the discharge and the
+sediment flux per time step at the given cells and the time spent.
+
+    Input:
+    ======
+    topology:               LddTopology of the LDD;
+    parameters:             dictionary with the arrays over the cells alpha,
+                            channel_length, half_discharge, discharge and
+                            sediment, see RoutingDomain, the exponent beta and
+                            the cells of which the fluxes are kept, 'gauges';
+    forcing:                function of the time step and the cells that
+                            returns the lateral inflow and sediment input;
+    nr_steps:               number of time steps;
+    timestep:               length of the time step [s].
+
+'''
+    start_time = time.time()
+    domain = RoutingDomain(topology, parameters['alpha'], parameters['beta'], parameters['channel_length'], \
+        parameters['half_discharge'], parameters['discharge'], parameters['sediment'])
+    gauges = parameters['gauges']
+    series = np.zeros((nr_steps, len(gauges), 2))
+    cells = np.arange(topology.nr_cells)
+    for step in range(nr_steps):
+        lateral_inflow, sediment_input = forcing(step, cells)
+        discharge, flux = domain.step(lateral_inflow, sediment_input, timestep)
+        series[step, :, 0] = discharge[gauges]
+        series[step, :, 1] = flux[gauges]
+    #rof
+    return domain.discharge, domain.sediment, series, time.time() - start_time
+#fed
+
+# interval [s] at which waiting processes check whether a worker has failed
+poll_interval = 0.2
+# time [s] that the workers get to stop after a failure before they are terminated
+abort_grace = 5.0
+
+def _acquire(semaphore, abort):
+    # acquires the semaphore of a ring buffer; gives up if a worker has failed
+    while not semaphore.acquire(timeout = poll_interval):
+        if abort.is_set():
+            sys.exit('Error: the sub-basin routing is aborted after a worker process failed')
+        #fi
+    #elihw
+#fed
+
+def _subbasin_worker(label, decomposition, parameters, forcing, nr_steps, timestep, ring_size, \
+        shared, filled, free, abort):
+    # routes a sub-basin in a worker process; if it fails, the other workers
+    # are told to stop, so that none waits for its outflow
+    try:
+        _route_subbasin(label, decomposition, parameters, forcing, nr_steps, timestep, ring_size, \
+            shared, filled, free, abort)
+    except BaseException:
+        abort.set()
+        raise
+    #yrt
+#fed
+
+def _route_subbasin(label, decomposition, parameters, forcing, nr_steps, timestep, ring_size, \
+        shared, filled, free, abort):
+    # routes a sub-basin; reads the outflow of the upstream sub-basins from
+    # and writes its own outflow to the ring buffers
+    nr_cells = decomposition.topology.nr_cells
+    nr_subbasins = decomposition.nr_subbasins
+    ring = map_shared_array(shared['ring'], (nr_subbasins, ring_size, 2))
+    discharge = map_shared_array(shared['discharge'], (nr_cells,))
+    sediment = map_shared_array(shared['sediment'], (nr_cells,))
+    gauges = parameters['gauges']
+    series = map_shared_array(shared['series'], (nr_steps, len(gauges), 2))
+    timing = map_shared_array(shared['timing'], (nr_subbasins, 2))
+    cells = decomposition.cells[label]
+    domain = RoutingDomain(decomposition.topologies[label], parameters['alpha'][cells], parameters['beta'], \
+        parameters['channel_length'][cells], parameters['half_discharge'][cells], \
+        parameters['discharge'][cells], parameters['sediment'][cells])
+    # the gauges in the sub-basin
+    in_subbasin = decomposition.labels[gauges] == label
+    gauge_positions = np.searchsorted(cells, gauges[in_subbasin])
+    upstream = decomposition.upstream[label]
+    receiver = decomposition.receiver[label]
+    outlet = decomposition.outlet_position[label]
+    busy_time = 0.0
+    wait_time = 0.0
+    for step in range(nr_steps):
+        slot = step % ring_size
+        boundary_water = None
+        boundary_sediment = None
+        if len(upstream) > 0:
+            start_time = time.time()
+            boundary_water = np.zeros(cells.size)
+            boundary_sediment = np.zeros(cells.size)
+            for upstream_label, position in upstream:
+                _acquire(filled[upstream_label], abort)
+                boundary_water[position] += ring[upstream_label, slot, 0]
+                boundary_sediment[position] += ring[upstream_label, slot, 1]
+                free[upstream_label].release()
+            #rof
+            wait_time += time.time() - start_time
+        #fi
+        start_time = time.time()
+        lateral_inflow, sediment_input = forcing(step, cells)
+        Q, flux = domain.step(lateral_inflow, sediment_input, timestep, boundary_water, boundary_sediment)
+        series[step, in_subbasin, 0] = Q[gauge_positions]
+        series[step, in_subbasin, 1] = flux[gauge_positions]
+        busy_time += time.time() - start_time
+        if receiver is not None:
+            start_time = time.time()
+            _acquire(free[label], abort)
+            wait_time += time.time() - start_time
+            ring[label, slot, 0] = Q[outlet]
+            ring[label, slot, 1] = flux[outlet]
+            filled[label].release()
+        #fi
+    #rof
+    discharge[cells] = domain.discharge
+    sediment[cells] = domain.sediment
+    timing[label] = busy_time, wait_time
+#fed
+
+def route_parallel(decomposition, parameters, forcing, nr_steps, timestep, ring_size = 8):
+    '''
+route_parallel: routes the water and the sediment over the sub-basins, each in
+its own worker process; returns the same as route_serial, and the time that
+every worker spent routing and waiting.
+
+    Input:
+    ======
+    decomposition:          SubbasinDecomposition of the LDD;
+    ring_size:              number of time steps that a sub-basin can run
+                            ahead of its receiving sub-basin;
+    see route_serial for the other input.
+
+'''
+    nr_cells = decomposition.topology.nr_cells
+    nr_subbasins = decomposition.nr_subbasins
+    nr_gauges = len(parameters['gauges'])
+    shared = {}
+    for name, shape in [('ring', (nr_subbasins, ring_size, 2)), ('discharge', (nr_cells,)), \
+            ('sediment', (nr_cells,)), ('series', (nr_steps, nr_gauges, 2)), ('timing', (nr_subbasins, 2))]:
+        shared[name] = shared_array(shape)[0]
+    #rof
+    filled = [multiprocessing.Semaphore(0) for label in range(nr_subbasins)]
+    free = [multiprocessing.Semaphore(ring_size) for label in range(nr_subbasins)]
+    abort = multiprocessing.Event()
+    start_time = time.time()
+    workers = [multiprocessing.Process(target = _subbasin_worker, args = (label, decomposition, \
+        parameters, forcing, nr_steps, timestep, ring_size, shared, filled, free, abort)) \
+        for label in range(nr_subbasins)]
+    for worker in workers:
+        worker.start()
+    #rof
+    # wait for the workers; as soon as one has failed, also if it was killed,
+    # the others are told to stop and terminated if they do not in time
+    while not abort.is_set():
+        if any(worker.exitcode not in (None, 0) for worker in workers):
+            abort.set()
+            break
+        #fi
+        alive = [worker for worker in workers if worker.is_alive()]
+        if len(alive) == 0:
+            break
+        #fi
+        alive[0].join(timeout = poll_interval)
+    #elihw
+    if abort.is_set():
+        deadline = time.time() + abort_grace
+        for worker in workers:
+            worker.join(timeout = max(0, deadline - time.time()))
+        #rof
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            #fi
+        #rof
+    #fi
+    wall_time = time.time() - start_time
+    if abort.is_set() or any(worker.exitcode != 0 for worker in workers):
+        sys.exit('Error: a worker process of the sub-basin routing failed')
+    #fi
+    return map_shared_array(shared['discharge'], (nr_cells,)).copy(), \
+        map_shared_array(shared['sediment'], (nr_cells,)).copy(), \
+        map_shared_array(shared['series'], (nr_steps, nr_gauges, 2)).copy(), wall_time, \
+        map_shared_array(shared['timing'], (nr_subbasins, 2)).copy()
+#fed
+
+def relative_difference(values, reference):
+    # the largest difference relative to the reference
+    return np.max(np.abs(values - reference) / np.maximum(np.abs(reference), 1.0e-30), initial = 0.0)
+#fed
+
+def report_scaling(decomposition, serial_time, wall_time, timing, differences):
+    # print the speed-up of the decomposed run with respect to the serial run,
+    # the time that every worker routed and waited, and the largest
+    # differences with the serial run
+    nr_workers = decomposition.nr_subbasins
+    speed_up = serial_time / max(wall_time, 1.0e-9)
+    print('Serial: %.2f s; %d sub-basin worker(s): %.2f s; speed-up %.2f, efficiency %.0f%%' % \
+        (serial_time, nr_workers, wall_time, speed_up, 100.0 * speed_up / nr_workers))
+    print('\t%9s %10s %10s %10s %8s' % ('sub-basin', 'cells', 'busy [s]', 'wait [s]', 'busy'))
+    for label in range(nr_workers):
+        print('\t%9d %10d %10.2f %10.2f %7.0f%%' % (label, decomposition.cells[label].size, \
+            timing[label, 0], timing[label, 1], 100.0 * timing[label, 0] / max(wall_time, 1.0e-9)))
+    #rof
+    for name, difference in differences:
+        print('Largest relative difference with the serial run, %s: %.2e' % (name, difference))
+    #rof
+#fed
+
+class SyntheticForcing(object):
+    '''
+SyntheticForcing: runoff with a seasonal cycle and a flood, and sediment input
+in proportion to the runoff, on cells with a random weight.
+'''
+    def __init__(self, channel_length, seed = 3):
+        random = np.random.RandomState(seed)
+        self.weight = random.uniform(0.5, 1.5, channel_length.size)
+        self.channel_length = channel_length
+    #fed
+
+    def __call__(self, step, cells):
+        depth = 1.0e-3 * (1 + 0.8 * np.sin(2 * np.pi * step / 365.0)) + \
+            8.0e-3 * np.exp(-((step - 60) / 4.0) ** 2)
+        runoff = depth * self.weight[cells] * 5.0e4 * 5.0e4
+        return runoff / 86400.0 / self.channel_length[cells], 10.0 * runoff
+    #fed
+#ssalc
+
+if __name__ == "__main__":
+    from benchmark_kinematic import synthetic_ldd
+    from kinematic_wave import channel_alpha
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--rows', type = int, default = 180, help = "Number of rows")
+    parser.add_argument('-c', '--cols', type = int, default = 240, help = "Number of columns")
+    parser.add_argument('-s', '--subbasins', type = int, default = 4, help = "Number of sub-basins")
+    parser.add_argument('-n', '--steps', type = int, default = 100, help = "Number of daily time steps")
+    parser.add_argument('-o', '--outlets', type = int, nargs = '*', default = None, \
+        help = "Outlets of the sub-basins as pairs of row and column, by default chosen automatically")
+    args = parser.parse_args()
+
+    ldd = synthetic_ldd((args.rows, args.cols))
+    topology = LddTopology(ldd)
+    if args.outlets is None:
+        outlets = select_outlets(topology, args.subbasins)
+    else:
+        if len(args.outlets) % 2 != 0:
+            sys.exit('Error: the outlets are given as pairs of row and column')
+        #fi
+        rows, cols = np.array(args.outlets[0::2]), np.array(args.outlets[1::2])
+        outlets = topology.cell_positions(rows * args.cols + cols)
+        if np.any(outlets < 0):
+            sys.exit('Error: an outlet lies outside the LDD')
+        #fi
+    #fi
+    decomposition = SubbasinDecomposition(topology, outlets)
+    decomposition.report()
+
+    random = np.random.RandomState(2)
+    nr_cells = topology.nr_cells
+    parameters = {'beta': 0.6, 'channel_length': random.uniform(4.0e4, 7.0e4, nr_cells)}
+    parameters['alpha'] = channel_alpha(0.04, random.uniform(10, 200, nr_cells), \
+        random.uniform(1.0e-5, 1.0e-3, nr_cells), parameters['beta'])
+    parameters['half_discharge'] = random.uniform(10, 100, nr_cells)
+    forcing = SyntheticForcing(parameters['channel_length'])
+    parameters['discharge'] = topology.accuflux(forcing(0, np.arange(nr_cells))[0] * parameters['channel_length'])
+    parameters['sediment'] = np.zeros(nr_cells)
+    # the pits and the outlets of the sub-basins are gauged
+    parameters['gauges'] = np.concatenate([np.flatnonzero(topology.downstream_index < 0), \
+        decomposition.outlets])
+
+    discharge, sediment, series, serial_time = route_serial(topology, parameters, forcing, args.steps, 86400.0)
+    parallel_discharge, parallel_sediment, parallel_series, wall_time, timing = \
+        route_parallel(decomposition, parameters, forcing, args.steps, 86400.0)
+    report_scaling(decomposition, serial_time, wall_time, timing, \
+        [('discharge', relative_difference(parallel_discharge, discharge)), \
+        ('sediment stock', relative_difference(parallel_sediment, sediment)), \
+        ('gauged discharge', relative_difference(parallel_series[..., 0], series[..., 0])), \
+        ('gauged sediment flux', relative_difference(parallel_series[..., 1], series[..., 1]))])
+#fi
@@ -0,0 +1,4 @@
+# the modules of the model are in the root of the repository
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
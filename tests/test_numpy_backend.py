@@ -0,0 +1,179 @@
+"""
+tests of the numpy backend of the factor functions in amazon_factors: the
+operations of numpy_pcr with missing values, the factor functions against
+hand-computed values and, if pcraster is installed, the numpy backend against
+the pcraster backend on synthetic grids.
+
+"""
+
+# modules
+import numpy as np
+import pytest
+
+import amazon_factors
+import numpy_pcr
+
+nan = np.nan
+
+@pytest.fixture
+def numpy_backend():
+    # run the test with the numpy backend and restore the active one after
+    backend = amazon_factors.get_backend()
+    amazon_factors.set_backend('numpy')
+    yield
+    amazon_factors.set_backend(backend)
+#fed
+
+def synthetic_grids(shape = (7, 9), seed = 1):
+    # returns grids of the input of the factor functions with a few missing
+    # values, within the ranges of the model
+    rng = np.random.RandomState(seed)
+    grids = {\
+        'slope_gradient': rng.uniform(0.0, 0.8, shape),
+        'slope_length': rng.uniform(10.0, 500.0, shape),
+        'rain_annual': rng.uniform(0.0, 3000.0, shape),
+        'rain_month': rng.uniform(0.0, 400.0, shape),
+        'cover_fraction': rng.uniform(0.0, 1.0, shape),
+        'tmin': rng.uniform(-20.0, 15.0, shape),
+        'tmax': rng.uniform(-5.0, 35.0, shape)}
+    grids['rain_annual'][0, :3] = 0.0
+    for grid in grids.values():
+        grid[1, 1] = nan
+    #rof
+    return grids
+#fed
+
+# numpy_pcr: missing values
+
+def test_ifthenelse_missing_condition_is_missing():
+    condition = numpy_pcr.to_field(np.array([1.0, nan, 3.0])) > 2.0
+    result = numpy_pcr.to_array(numpy_pcr.ifthenelse(condition, 1.0, 0.0))
+    np.testing.assert_array_equal(result, [0.0, nan, 1.0])
+#fed
+
+def test_ifthenelse_missing_branch_is_missing():
+    condition = numpy_pcr.to_field(np.array([1.0, 2.0, 3.0])) > 1.5
+    true_value = numpy_pcr.to_field(np.array([10.0, nan, nan]))
+    false_value = numpy_pcr.to_field(np.array([nan, 20.0, 30.0]))
+    result = numpy_pcr.to_array(numpy_pcr.ifthenelse(condition, true_value, false_value))
+    np.testing.assert_array_equal(result, [nan, nan, nan])
+    result = numpy_pcr.to_array(numpy_pcr.ifthenelse(~condition, true_value, false_value))
+    np.testing.assert_array_equal(result, [10.0, 20.0, 30.0])
+#fed
+
+def test_cover_fills_missing_values_in_order():
+    value = numpy_pcr.to_field(np.array([1.0, nan, nan, nan]))
+    first = numpy_pcr.to_field(np.array([5.0, 6.0, nan, nan]))
+    result = numpy_pcr.to_array(numpy_pcr.cover(value, first, 7.0))
+    np.testing.assert_array_equal(result, [1.0, 6.0, 7.0, 7.0])
+    result = numpy_pcr.to_array(numpy_pcr.cover(value, first))
+    np.testing.assert_array_equal(result, [1.0, 6.0, nan, nan])
+#fed
+
+def test_min_max_missing_if_any_is_missing():
+    first = numpy_pcr.to_field(np.array([1.0, nan, 3.0]))
+    second = numpy_pcr.to_field(np.array([2.0, 2.0, nan]))
+    np.testing.assert_array_equal(numpy_pcr.to_array(numpy_pcr.min(first, second)), [1.0, nan, nan])
+    np.testing.assert_array_equal(numpy_pcr.to_array(numpy_pcr.max(first, 0.5, second)), [2.0, nan, nan])
+#fed
+
+def test_lookupscalar_ranges(tmp_path):
+    table = tmp_path / 'table.txt'
+    table.write_text('<,2] 0.1\n<2,5> 0.2\n5 0.3\n[6,> 0.4\n')
+    key = numpy_pcr.to_field(np.array([-1.0, 2.0, 3.0, 5.0, 5.5, 6.0, nan]))
+    result = numpy_pcr.to_array(numpy_pcr.lookupscalar(str(table), key))
+    np.testing.assert_array_equal(result, [0.1, 0.1, 0.2, 0.3, nan, 0.4, nan])
+#fed
+
+# factor functions with the numpy backend against hand-computed values
+
+def test_annual_erosivity(numpy_backend):
+    rain_annual = np.array([0.0, 500.0, 850.0, 1000.0, nan])
+    expected = [0.0, 0.0483 * 500.0 ** 1.61, 0.0483 * 850.0 ** 1.61, \
+        587.8 - 1.219 * 1000.0 + 0.00415 * 1000.0 ** 2, nan]
+    np.testing.assert_allclose(amazon_factors.compute_annual_erosivity(rain_annual), expected)
+#fed
+
+def test_partition_erosivity(numpy_backend):
+    rain_month = np.array([100.0, 50.0, 10.0, nan])
+    rain_annual = np.array([1000.0, 0.0, 5.0, 1000.0])
+    result = amazon_factors.partition_erosivity(rain_month, rain_annual, 2000.0)
+    np.testing.assert_allclose(result, [200.0, 0.0, 2000.0, nan])
+#fed
+
+def test_slope_factor(numpy_backend):
+    slope_gradient = np.array([0.0, 0.1, 0.7])
+    slope_length = np.array([22.13, 44.26, 100.0])
+    gamma = np.minimum(1.0, 1.183156498 * slope_gradient ** 0.351920534)
+    steepness = -1.5 + 17.0 / (1 + np.exp(2.3 - 6.1 * np.sin(np.arctan(slope_gradient))))
+    expected = (slope_length / 22.13) ** gamma * steepness
+    np.testing.assert_allclose(amazon_factors.compute_slope_factor(slope_length, slope_gradient), expected)
+    # the power is capped at unity
+    assert gamma[-1] == 1.0
+#fed
+
+def test_vegcover_factor_covers_missing_values(numpy_backend):
+    cover_fraction = np.array([0.0, 0.5, nan])
+    result = amazon_factors.compute_vegcover_factor2(cover_fraction, \
+        np.array([10.0, 20.0, 10.0]), np.array([100.0, 100.0, 100.0]))
+    expected = [np.exp(-0.799) * 0.1, np.exp(-0.799 - 3.87 + 0.0449 * 0.25) * 0.2, \
+        amazon_factors.mv * 0.1]
+    np.testing.assert_allclose(result, expected)
+#fed
+
+def test_melt_time_fraction(numpy_backend):
+    tmin = np.array([-10.0, -5.0, 2.0, 0.0])
+    tmax = np.array([-2.0, 5.0, 10.0, 0.05])
+    result = amazon_factors.compute_melt_time_fraction(tmin, tmax)
+    np.testing.assert_allclose(result, [0.0, 0.5, 1.0, 0.5])
+#fed
+
+def test_conservation_factor_dictionaries(numpy_backend):
+    cover_fraction_info = {\
+        'croplands': np.array([0.5, 0.0, nan]),
+        'forest': np.array([0.5, 1.0, 1.0])}
+    P_factor_info = {'croplands': None, 'forest': 0.8}
+    selected_slope = np.array([0.2, 0.2, 0.2])
+    result = amazon_factors.compute_conservation_factor(cover_fraction_info, P_factor_info, selected_slope)
+    np.testing.assert_allclose(result, [0.5 * 0.26 + 0.4, 0.8, nan])
+#fed
+
+# numpy backend against the pcraster backend
+
+def pcraster_grids(grids):
+    # sets the clone to the shape of the grids and returns them as fields
+    pcr = pytest.importorskip('pcraster')
+    nr_rows, nr_cols = next(iter(grids.values())).shape
+    pcr.setclone(nr_rows, nr_cols, 1.0, 0.0, 0.0)
+    return dict((key, pcr.numpy2pcr(pcr.Scalar, grid, nan)) for key, grid in grids.items())
+#fed
+
+def pcraster_array(field):
+    pcr = pytest.importorskip('pcraster')
+    return pcr.pcr2numpy(field, nan)
+#fed
+
+@pytest.mark.parametrize('name, arguments', [\
+    ('compute_slope_factor', ['slope_length', 'slope_gradient']),
+    ('compute_annual_erosivity', ['rain_annual']),
+    ('partition_erosivity', ['rain_month', 'rain_annual', 'rain_annual']),
+    ('compute_vegcover_factor2', ['cover_fraction', 'rain_month', 'rain_annual']),
+    ('compute_melt_time_fraction', ['tmin', 'tmax']),
+    ])
+def test_numpy_backend_matches_pcraster(name, arguments):
+    grids = synthetic_grids()
+    fields = pcraster_grids(grids)
+    backend = amazon_factors.get_backend()
+    func = getattr(amazon_factors, name)
+    try:
+        amazon_factors.set_backend('pcraster')
+        expected = pcraster_array(func(*[fields[key] for key in arguments]))
+        amazon_factors.set_backend('numpy')
+        result = func(*[grids[key] for key in arguments])
+    finally:
+        amazon_factors.set_backend(backend)
+    #yrt
+    # PCRaster computes in single precision
+    np.testing.assert_allclose(result, expected, rtol = 1.0e-5, atol = 1.0e-6)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+#fed
@@ -0,0 +1,135 @@
+"""
+tests of the split factor functions in amazon_factors: the prefactor and the
+monthly part of every split factor against the unsplit function, with the
+numpy backend, including missing input and the cells that are covered with
+the missing value -999.9, and the diagnostics of the split vegetation cover
+factor.
+
+"""
+
+# modules
+import numpy as np
+import pytest
+
+import amazon_factors
+import diagnostics
+import numpy_pcr
+
+nan = np.nan
+mv = amazon_factors.mv
+
+@pytest.fixture
+def numpy_backend():
+    # run the test with the numpy backend and restore the active one after
+    backend = amazon_factors.get_backend()
+    amazon_factors.set_backend('numpy')
+    yield
+    amazon_factors.set_backend(backend)
+#fed
+
+def assert_split_matches(split, unsplit):
+    # the split function equals the unsplit one up to rounding, with missing
+    # values and covered values at the same cells
+    split = numpy_pcr.to_array(split)
+    unsplit = numpy_pcr.to_array(unsplit)
+    np.testing.assert_array_equal(np.isnan(split), np.isnan(unsplit))
+    np.testing.assert_array_equal(split == mv, unsplit == mv)
+    np.testing.assert_allclose(split, unsplit, rtol = 1.0e-12)
+#fed
+
+def test_split_erosivity_matches(numpy_backend):
+    # no, little and much annual rain, monthly rain above the annual rain and
+    # missing monthly or annual rain
+    rain_month = np.array([100.0, 50.0, 10.0, 0.0, 30.0, nan, 20.0])
+    rain_annual = np.array([1000.0, 0.0, 5.0, 800.0, 1.0e-3, 1000.0, nan])
+    eros_annual = np.array([2000.0, 2000.0, 2000.0, 500.0, 10.0, 2000.0, 2000.0])
+    unsplit = amazon_factors.partition_erosivity(rain_month, rain_annual, eros_annual)
+    split = amazon_factors.partition_erosivity_monthly(rain_month, \
+        amazon_factors.erosivity_prefactor(rain_annual), eros_annual)
+    assert_split_matches(split, unsplit)
+#fed
+
+def test_split_kfact_matches(numpy_backend):
+    kfact_annual = np.array([0.02, 0.035, 0.0, nan, 0.03])
+    kfact_seasonal = np.array([1.5, 1.0, 2.0, 1.5, nan])
+    melt_time_fraction = np.array([0.0, 0.5, 1.0, 0.3, 0.7])
+    unsplit = amazon_factors.compute_kfact_monthly(kfact_annual, kfact_seasonal, melt_time_fraction)
+    split = amazon_factors.compute_kfact_monthly_split(kfact_annual, \
+        amazon_factors.kfact_prefactor(kfact_annual, kfact_seasonal), melt_time_fraction)
+    assert_split_matches(split, unsplit)
+#fed
+
+@pytest.mark.parametrize('R_year', [\
+    np.array([100.0, 100.0, 100.0, 100.0, 50.0]),
+    # annual erosivity of -999.9 as covered by the model, zero or missing
+    np.array([mv, 0.0, nan, 100.0, 50.0])])
+def test_split_vegcover_factor_matches(numpy_backend, R_year):
+    # missing cover fraction is covered with -999.9, as is missing erosivity
+    ground_cover_fraction = np.array([0.0, 0.5, 1.0, nan, 0.2])
+    R_month = np.array([10.0, 20.0, 10.0, 10.0, nan])
+    unsplit = amazon_factors.compute_vegcover_factor2(ground_cover_fraction, R_month, R_year)
+    split = amazon_factors.compute_vegcover_factor_monthly(ground_cover_fraction, R_month, \
+        amazon_factors.vegcover_prefactor(R_year))
+    assert_split_matches(split, unsplit)
+    assert np.any(numpy_pcr.to_array(split) == mv)
+#fed
+
+def test_split_soil_loss_matches(numpy_backend):
+    # a vegetation cover factor of -999.9 passes through both functions alike
+    erosivity_period = np.array([200.0, 0.0, 50.0, nan, 100.0])
+    erodibility_period = np.array([0.02, 0.03, 0.025, 0.02, 0.03])
+    slope_factor = np.array([1.5, 3.0, 0.2, 1.0, nan])
+    vegcover_factor = np.array([0.1, 0.05, mv, 0.2, 0.1])
+    conservation_factor = np.array([1.0, 0.8, 0.5, 1.0, 1.0])
+    CellArea = np.full(5, 8.5e7)
+    unsplit = amazon_factors.compute_soil_loss(erosivity_period, erodibility_period, \
+        slope_factor, vegcover_factor, conservation_factor, CellArea)
+    split = amazon_factors.compute_soil_loss_monthly(erosivity_period, erodibility_period, \
+        vegcover_factor, amazon_factors.soil_loss_prefactor(slope_factor, conservation_factor, CellArea))
+    assert_split_matches(split, unsplit)
+#fed
+
+def test_split_Manning_matches(numpy_backend):
+    Mn1 = np.array([0.01, 0.02, 0.0, nan, 0.015])
+    Mn4 = np.array([0.1, 0.3, 0.2, 0.1, 0.25])
+    ndvi = np.array([0.1, 0.5, 0.9, 0.4, nan])
+    unsplit = amazon_factors.compute_Manning(Mn1, Mn4, ndvi)
+    split = amazon_factors.compute_Manning_monthly(amazon_factors.manning_prefactor(Mn1), Mn4, ndvi)
+    assert_split_matches(split, unsplit)
+#fed
+
+def test_split_delivery_ratio_matches(numpy_backend):
+    # ratios that are clipped to zero and unity and missing input
+    HydroCoeff = np.array([0.2, 0.0, 50.0, 0.1, nan, 0.3])
+    slope_gradient = np.array([0.05, 0.1, 0.5, 0.0, 0.1, nan])
+    Manning = np.array([0.2, 0.3, 0.05, 0.2, 0.2, 0.2])
+    slope_length = np.array([100.0, 200.0, 10.0, 50.0, 100.0, 100.0])
+    unsplit = amazon_factors.compute_delivery_ratio(HydroCoeff, slope_gradient, Manning, slope_length)
+    split = amazon_factors.compute_delivery_ratio_monthly(HydroCoeff, \
+        amazon_factors.delivery_ratio_prefactor(slope_gradient, slope_length), Manning)
+    assert_split_matches(split, unsplit)
+#fed
+
+def test_split_vegcover_factor_emits_the_same_diagnostics(numpy_backend):
+    cover_fraction = np.array([0.0, 0.5, nan])
+    R_month = np.array([10.0, 20.0, 10.0])
+    R_year = np.array([100.0, 100.0, 100.0])
+    emitted = {}
+    def sink(name, timestep, value):
+        emitted.setdefault(name, []).append(numpy_pcr.to_array(value))
+    #fed
+    diagnostics.configure(enabled = True, sink = sink)
+    try:
+        unsplit = amazon_factors.compute_vegcover_factor2(cover_fraction, R_month, R_year)
+        split = amazon_factors.compute_vegcover_factor_monthly(cover_fraction, R_month, \
+            amazon_factors.vegcover_prefactor(R_year))
+    finally:
+        diagnostics.configure(enabled = False)
+    #yrt
+    np.testing.assert_allclose(split, unsplit)
+    assert sorted(emitted) == ['c_ex_tmp', 'c_factor', 'c_tmp', 'gc_tmp', 'gcf_tmp']
+    for name, values in emitted.items():
+        assert len(values) == 2
+        np.testing.assert_allclose(values[1], values[0])
+    #rof
+#fed
@@ -0,0 +1,341 @@
+"""
+tiled_production: out-of-core execution of the Amazon Sediment Production
+Model for grids that do not fit in memory, e.g., 30 arc-second grids. The
+domain is processed in tiles of full rows; for every tile, only the windows
+of the input maps are read, the static factors are computed for the tile and
+all months of the run are evaluated with the fused kernel, after which the
+output of the tile is written directly to the chunked NetCDF files. The
+number of rows per tile follows from a memory budget, so that the peak memory
+does not depend on the size of the grid.
+
+All computations are per cell, except the filling of the missing NDVI with
+the value of the nearest valid cell; for this, the windows of the filled maps
+are extended by a halo of rows. Cells of which the nearest donor may lie
+beyond the halo are counted and reported.
+
+Input maps are read with GDAL, which reads PCRaster maps; tiled runs only
+write the NetCDF output, not the maps, checkpoints or diagnostics.
+
+"""
+
+# modules
+import os, sys, time
+import numpy as np
+from osgeo import gdal
+
+import amazon_factors
+from amazon_factors import mv
+from rusle_kernel import compute_monthly_sediment, static_inputs, kernel_outputs
+from landcover_stack import CoverFractionStack, compute_conservation_factor_stack, \
+    compute_interception_fraction_stack, Manning_n4_stack
+from netcdf_writer import BufferedNetCDFWriter
+
+def read_window(pathname, rows):
+    '''
+read_window: returns the rows of the first band of a map as an array with NaN
+for missing values.
+
+    Input:
+    ======
+    pathname:               name of the map;
+    rows:                   slice of the rows that are read.
+
+'''
+    dataset = gdal.Open(pathname)
+    if dataset is None:
+        sys.exit('Error: cannot open map %s' % pathname)
+    #fi
+    band = dataset.GetRasterBand(1)
+    data = band.ReadAsArray(0, rows.start, dataset.RasterXSize, \
+        rows.stop - rows.start).astype(np.float32)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        data[data == np.float32(nodata)] = np.nan
+    #fi
+    return data
+#fed
+
+def grid_coordinates(pathname):
+    # returns the latitudes of the rows and the longitudes of the columns of
+    # the cell centres of the map
+    dataset = gdal.Open(pathname)
+    if dataset is None:
+        sys.exit('Error: cannot open map %s' % pathname)
+    #fi
+    x0, dx, rx, y0, ry, dy = dataset.GetGeoTransform()
+    latitudes = y0 + (np.arange(dataset.RasterYSize) + 0.5) * dy
+    longitudes = x0 + (np.arange(dataset.RasterXSize) + 0.5) * dx
+    return latitudes, longitudes
+#fed
+
+def fill_window(filler, data, core, open_top, open_bottom):
+    '''
+fill_window: fills the missing values of a window with the value of the
+nearest valid cell within the window.
+
+    Input:
+    ======
+    filler:                 NearestValidFiller;
+    data:                   array of the window, with a halo of rows around
+                            the rows of the tile;
+    core:                   slice of the rows of the tile within the window;
+    open_top, open_bottom:  True if the grid continues above or below the
+                            window.
+
+    Output:
+    =======
+    filled_data:            the rows of the tile with the missing values filled;
+    nr_uncertain:           number of filled cells of the tile of which a
+                            nearer donor may lie outside the window.
+
+'''
+    missing, donors = filler.donor_index(np.isnan(data))
+    filled_data = data.copy()
+    filled_data.flat[missing] = data.flat[donors]
+    nr_rows, nr_cols = data.shape
+    missing_rows, missing_cols = np.divmod(missing, nr_cols)
+    donor_rows, donor_cols = np.divmod(donors, nr_cols)
+    distance = np.hypot(missing_rows - donor_rows, missing_cols - donor_cols)
+    boundary = np.full(distance.shape, np.inf)
+    if open_top:
+        boundary = np.minimum(boundary, missing_rows + 1)
+    #fi
+    if open_bottom:
+        boundary = np.minimum(boundary, nr_rows - missing_rows)
+    #fi
+    in_core = (missing_rows >= core.start) & (missing_rows < core.stop)
+    nr_uncertain = int(np.count_nonzero(in_core & (distance > boundary)))
+    return filled_data[core], nr_uncertain
+#fed
+
+class TiledProduction(object):
+    '''
+TiledProduction: runs the production model tile by tile.
+
+    Input:
+    ======
+    model:                  configured RUSLE instance (config_model has been
+                            called) that provides the input directories, the
+                            naming of the input maps, the output products and
+                            the NetCDF settings;
+    memory_budget:          approximate memory budget in MB for the arrays of
+                            a tile;
+    fill_halo_rows:         number of rows by which the windows of the filled
+                            input are extended on either side.
+
+'''
+    def __init__(self, model, memory_budget = 1024, fill_halo_rows = 64):
+        self.model = model
+        self.fill_halo_rows = max(0, fill_halo_rows)
+        self.clone_pathname = model.clone_pathname
+        dataset = gdal.Open(self.clone_pathname)
+        if dataset is None:
+            sys.exit('Error: cannot open map %s' % self.clone_pathname)
+        #fi
+        self.shape = (dataset.RasterYSize, dataset.RasterXSize)
+
+        # land cover tables
+        self.manning_n_info = model.load_landcoverdata(model.check_txtfile("Landcover_n4.txt"))
+        self.P_factor_info = model.load_landcoverdata(model.check_txtfile("P_factor.txt"))
+        self.part_interception_info = \
+            model.load_landcoverdata(model.check_txtfile("part_interception.txt"))
+        self.Manning_n1_TBL = model.check_txtfile('ManningN1.txt')
+        self.classes = list(self.manning_n_info.keys())
+
+        # time steps per written block: the time dimension of the NetCDF chunks
+        self.time_block = max(1, model.netcdf_chunk_shape[0])
+        self.tile_rows = self.rows_per_tile(memory_budget)
+        self.nr_uncertain = 0
+    #fed
+
+    def rows_per_tile(self, memory_budget):
+        '''
+rows_per_tile: returns the number of rows per tile within the memory budget; it
+is a multiple of the rows of the NetCDF chunks, so that tiles write full chunks.
+'''
+        # arrays per row: the static input and factors, computed in double
+        # precision, the land cover fractions, the monthly input, the kernel
+        # output and buffers and the output of a block of time steps
+        nr_static = len(static_inputs) + 5 + len(self.classes)
+        nr_monthly = len(self.model.dynamic_mapnames) + 2 * len(kernel_outputs) + \
+            len(kernel_outputs) * self.time_block
+        bytes_per_row = self.shape[1] * (8 * nr_static + 4 * nr_monthly)
+        chunk_rows = max(1, min(self.model.netcdf_chunk_shape[1], self.shape[0]))
+        tile_rows = (int(memory_budget * 1024 ** 2) // bytes_per_row) // chunk_rows * chunk_rows
+        if tile_rows < chunk_rows:
+            print('Warning: the memory budget of %.0f MB is less than needed for %d rows; using %d rows' % \
+                (memory_budget, chunk_rows, chunk_rows))
+            tile_rows = chunk_rows
+        #fi
+        return min(tile_rows, self.shape[0])
+    #fed
+
+    def read_map(self, mapname, rows):
+        return read_window(self.model.map_pathname(mapname), rows)
+    #fed
+
+    def compute_static_tile(self, rows):
+        # computes the static factors of the tile as in RUSLE.load_input_initial
+        # and RUSLE.setup_model, with the numpy backend of the factor functions
+        slope_length = self.read_map('globalbcat', rows)
+        slope_gradient = self.read_map('slope05min_avgFrom30sec', rows)
+        selected_slope = self.read_map('sel_slope', rows)
+        selected_slope[np.isnan(selected_slope)] = mv
+        rain_annual = self.read_map('Pan_90', rows)
+        rain_annual[np.isnan(rain_annual)] = mv
+        mass_fraction_sand = self.read_map('fsand_05deg', rows) / 100
+        mass_fraction_silt = self.read_map('fsilt_05deg', rows) / 100
+        mass_fraction_clay = self.read_map('fclay_05deg', rows) / 100
+        cover_stack = CoverFractionStack(self.classes, slope_length.shape)
+        for key in self.classes:
+            cover_stack.set_fraction(key, self.read_map(key, rows))
+        #rof
+        cover_stack.normalise()
+
+        static_data = {'slope_length': slope_length, 'slope_gradient': slope_gradient, \
+            'rain_annual': rain_annual, 'CellArea': self.read_map('cellarea_05min', rows)}
+        static_data['interception_fraction'] = compute_interception_fraction_stack( \
+            cover_stack, self.part_interception_info)
+        backend = amazon_factors.get_backend()
+        amazon_factors.set_backend('numpy')
+        try:
+            static_data['LS'] = amazon_factors.compute_slope_factor(slope_length, slope_gradient)
+            static_data['K_year'] = amazon_factors.return_default_soil_erodibility( \
+                mass_fraction_sand, mass_fraction_silt, mass_fraction_clay, 1.0)
+            static_data['kfact_seasonal'] = amazon_factors.return_soil_erodibility_seasonality( \
+                mass_fraction_sand, mass_fraction_silt, mass_fraction_clay)
+            static_data['R_year'] = self.compute_R_year(static_data['interception_fraction'], \
+                rain_annual)
+            static_data['Manning_n1'] = amazon_factors.Manning_n1(slope_gradient, self.Manning_n1_TBL)
+        finally:
+            amazon_factors.set_backend(backend)
+        #yrt
+        static_data['P_month'] = compute_conservation_factor_stack(cover_stack, \
+            self.P_factor_info, selected_slope)
+        static_data['Manning_n4'] = Manning_n4_stack(cover_stack, self.manning_n_info)
+        return static_data
+    #fed
+
+    def compute_R_year(self, interception_fraction, rain_annual):
+        # annual erosivity with the missing values covered, as in RUSLE.setup_model
+        backend = amazon_factors.get_backend()
+        amazon_factors.set_backend('numpy')
+        try:
+            R_year = amazon_factors.compute_annual_erosivity((1.0 - interception_fraction) * rain_annual)
+        finally:
+            amazon_factors.set_backend(backend)
+        #yrt
+        return np.where(np.isnan(R_year), mv, R_year)
+    #fed
+
+    def update_annual_tile(self, static_data, rows, year):
+        # the annual rainfall and R_year of the year, if the naming scheme
+        # provides annual rainfall maps per year (RUSLE.update_annual_factors)
+        mapname = self.model.input_naming.annual('rain_annual', 'Pan_90', year)
+        if mapname is None:
+            return
+        #fi
+        pathname = os.path.join(self.model.mapdir, mapname)
+        if not os.path.isfile(pathname):
+            sys.exit("Error: map %s in %s does not exist" % (mapname, self.model.mapdir))
+        #fi
+        rain_annual = read_window(pathname, rows)
+        rain_annual[np.isnan(rain_annual)] = mv
+        static_data['rain_annual'] = rain_annual
+        static_data['R_year'] = self.compute_R_year(static_data['interception_fraction'], rain_annual)
+    #fed
+
+    def read_input_tile(self, rows, timestep):
+        # reads the monthly input of the tile as RUSLE.read_input_dynamic
+        model = self.model
+        date = model.date_of_timestep(timestep)
+        input_data = {}
+        for name, mapname in model.dynamic_mapnames.items():
+            pathname = os.path.join(model.mapdir, model.input_naming.monthly(name, mapname, date, timestep))
+            if not os.path.isfile(pathname):
+                sys.exit("Error: map %s in %s does not exist" % (os.path.basename(pathname), model.mapdir))
+            #fi
+            if name in model.nearest_fill_inputs:
+                window = slice(max(0, rows.start - self.fill_halo_rows), \
+                    min(self.shape[0], rows.stop + self.fill_halo_rows))
+                input_data[name], nr_uncertain = fill_window(model.gap_fillers[name], \
+                    read_window(pathname, window), \
+                    slice(rows.start - window.start, rows.stop - window.start), \
+                    window.start > 0, window.stop < self.shape[0])
+                self.nr_uncertain += nr_uncertain
+            else:
+                input_data[name] = read_window(pathname, rows)
+            #fi
+        #rof
+        return model.prepare_input_dynamic(input_data)
+    #fed
+
+    def open_output(self):
+        # one NetCDF writer per product; only windows are written
+        model = self.model
+        latitudes, longitudes = grid_coordinates(self.clone_pathname)
+        self.netcdf_writers = {}
+        for key in model.dataProducts.keys():
+            varName = model.dataProducts[key]['variable']
+            self.netcdf_writers[key] = BufferedNetCDFWriter( \
+                os.path.join(model.outputdir, '%s.nc' % varName), varName, \
+                model.dataProducts[key]['unit'], longitudes, latitudes, \
+                chunk_shape = model.netcdf_chunk_shape, complevel = model.netcdf_complevel, \
+                shuffle = model.netcdf_shuffle, MV = mv)
+        #rof
+    #fed
+
+    def run(self, nrOfTimeSteps):
+        '''
+run: runs the model for all tiles and the given number of monthly time steps.
+'''
+        model = self.model
+        nr_tiles = (self.shape[0] + self.tile_rows - 1) // self.tile_rows
+        print('Tiled run: %d x %d cells in %d tile(s) of %d rows, %d time step(s)' % \
+            (self.shape[0], self.shape[1], nr_tiles, self.tile_rows, nrOfTimeSteps))
+        self.open_output()
+        start_time = time.time()
+        for itile, row_start in enumerate(range(0, self.shape[0], self.tile_rows)):
+            rows = slice(row_start, min(row_start + self.tile_rows, self.shape[0]))
+            print('Tile %d of %d: rows %d to %d' % (itile + 1, nr_tiles, rows.start, rows.stop - 1))
+            static_data = self.compute_static_tile(rows)
+            kernel_output = None
+            current_year = None
+            output = dict((key, np.empty((self.time_block, rows.stop - rows.start, self.shape[1]), \
+                dtype = np.float32)) for key in model.dataProducts.keys())
+            timestamps = []
+            for timestep in range(1, nrOfTimeSteps + 1):
+                date = model.date_of_timestep(timestep)
+                if date.year != current_year:
+                    current_year = date.year
+                    self.update_annual_tile(static_data, rows, current_year)
+                #fi
+                input_data = self.read_input_tile(rows, timestep)
+                kernel_output = compute_monthly_sediment(input_data, static_data, \
+                    block_rows = model.kernel_block_rows, out = kernel_output)
+                for key in model.dataProducts.keys():
+                    output[key][len(timestamps)] = kernel_output[key]
+                #rof
+                timestamps.append(date)
+                if len(timestamps) == self.time_block or timestep == nrOfTimeSteps:
+                    for key, writer in self.netcdf_writers.items():
+                        writer.write_window(output[key][:len(timestamps)], \
+                            timestep - len(timestamps), rows, timestamps)
+                    #rof
+                    timestamps = []
+                #fi
+            #rof
+        #rof
+        for writer in self.netcdf_writers.values():
+            writer.close()
+        #rof
+        print('Tiled run finished in %.1f s' % (time.time() - start_time))
+        for name in model.nearest_fill_inputs:
+            model.gap_fillers[name].report(name)
+        #rof
+        if self.nr_uncertain > 0:
+            print('Warning: %d filled cell(s) may have a nearer donor beyond the halo of %d rows' % \
+                (self.nr_uncertain, self.fill_halo_rows))
+        #fi
+    #fed
+#ssalc